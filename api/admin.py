@@ -1,24 +1,42 @@
 from __future__ import annotations
 
-import json
-from pathlib import Path
 from typing import Any
 
 from fastapi import APIRouter, Query
 
+from core.conv_state import aload_turn_history, get_state_cache_stats
+from core.llm_client import get_llm_client_stats
+from core.llm_router import get_router_stats
+from core.llm_usage import aggregate_usage, get_prompt_cache_stats, get_usage_stats, recent_usage
+from core.lock_manager import get_lock_stats
 from core.log_buffer import get_logs
+from core.loop_monitor import get_loop_lag_stats
+from core.resilience import get_upstream_stats
+from core.response_cache import get_response_cache_stats
+from core.single_flight import get_single_flight_stats
+from core.stream_cancel import get_stream_cancel_stats
+from core.stream_frames import get_stream_frame_stats
+from core.stream_pacing import get_pacing_stats
+from core.stream_protocol import get_stream_protocol_stats
+from core.summarizer import get_summarizer_stats
+from core.turn_archive import get_turn_archive_stats
+from data_store import (
+    get_process_lock_stats,
+    get_storage_io_stats,
+    get_turn_journal_stats,
+    get_user_cache_stats,
+    load_all_user_data,
+    load_user_data,
+)
+from relationship.emotion_client import get_relationship_batch_stats
+from routers.session import get_session_stats
 
 router = APIRouter()
 
-BASE_DIR = Path(__file__).resolve().parent.parent
-USER_DATA_FILE = BASE_DIR / "user_data.json"
-
 
 def _load_all_users() -> dict[str, Any]:
-    if not USER_DATA_FILE.exists():
-        return {}
     try:
-        return json.loads(USER_DATA_FILE.read_text(encoding="utf-8"))
+        return load_all_user_data()
     except Exception:
         return {}
 
@@ -55,8 +73,7 @@ def list_users() -> dict[str, Any]:
 
 @router.get("/api/admin/user/{user_id}")
 def get_user(user_id: str) -> dict[str, Any]:
-    data = _load_all_users()
-    user = data.get(user_id, {})
+    user = load_user_data(user_id)
     profile = user.get("profile") if isinstance(user, dict) and isinstance(user.get("profile"), dict) else {}
     history = user.get("history") if isinstance(user, dict) and isinstance(user.get("history"), list) else []
     relationships = user.get("relationships") if isinstance(user, dict) and isinstance(user.get("relationships"), dict) else {}
@@ -75,8 +92,7 @@ def get_user(user_id: str) -> dict[str, Any]:
 
 @router.get("/api/admin/user/{user_id}/characters")
 def get_user_characters(user_id: str) -> dict[str, Any]:
-    data = _load_all_users()
-    user = data.get(user_id, {})
+    user = load_user_data(user_id)
     relationships = user.get("relationships") if isinstance(user, dict) else {}
     if not isinstance(relationships, dict):
         relationships = {}
@@ -97,6 +113,13 @@ def get_user_characters(user_id: str) -> dict[str, Any]:
     return {"ok": True, "count": len(items), "items": items}
 
 
+@router.get("/api/admin/user/{user_id}/turns")
+async def get_user_turns(user_id: str, conv_key: str = Query(...), limit: int = Query(default=50)) -> dict[str, Any]:
+    turns = await aload_turn_history(user_id, conv_key, limit=limit)
+    items = [turn.model_dump() if hasattr(turn, "model_dump") else turn.dict() for turn in turns]
+    return {"ok": True, "user_id": user_id, "conv_key": conv_key, "count": len(items), "items": items}
+
+
 @router.get("/api/admin/relationship")
 def list_relationship() -> dict[str, Any]:
     data = _load_all_users()
@@ -128,3 +151,45 @@ def list_admin_logs(category: str | None = Query(default=None), limit: int = Que
         needle = category.lower()
         items = [item for item in items if needle in str(item.get("source", "")).lower()]
     return {"ok": True, "count": len(items), "items": items}
+
+
+@router.get("/api/admin/usage")
+def list_usage(
+    window: int = Query(default=3600),
+    group_by: str = Query(default="stage"),
+    recent: int = Query(default=0),
+) -> dict[str, Any]:
+    """按时间窗口（秒，0 表示环形缓冲内全部记录）聚合上游用量；group_by 逗号分隔，可选 stage,user_id,character,tier。"""
+    fields = [f.strip() for f in group_by.split(",") if f.strip()]
+    items = aggregate_usage(window_seconds=window or None, group_by=fields)
+    return {"ok": True, "window": window, "group_by": fields, "items": items, "recent": recent_usage(recent)}
+
+
+@router.get("/api/admin/metrics")
+async def get_metrics() -> dict[str, Any]:
+    # async 路由：会话锁、状态缓存等统计读取的是事件循环上的数据结构，须在事件循环上读
+    return {
+        "ok": True,
+        "user_cache": get_user_cache_stats(),
+        "turn_journal": get_turn_journal_stats(),
+        "storage_io": get_storage_io_stats(),
+        "process_locks": get_process_lock_stats(),
+        "conv_state_cache": get_state_cache_stats(),
+        "conv_locks": get_lock_stats(),
+        "conv_archive": get_turn_archive_stats(),
+        "summarizer": get_summarizer_stats(),
+        "llm_client": get_llm_client_stats(),
+        "llm_router": get_router_stats(),
+        "upstreams": get_upstream_stats(),
+        "response_cache": get_response_cache_stats(),
+        "single_flight": get_single_flight_stats(),
+        "relationship_batch": get_relationship_batch_stats(),
+        "prompt_cache": get_prompt_cache_stats(),
+        "usage": get_usage_stats(),
+        "stream_pacing": get_pacing_stats(),
+        "stream_frames": get_stream_frame_stats(),
+        "stream_protocol": get_stream_protocol_stats(),
+        "ws_session": get_session_stats(),
+        "stream_cancel": get_stream_cancel_stats(),
+        "event_loop": get_loop_lag_stats(),
+    }
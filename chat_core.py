@@ -1,31 +1,28 @@
-import requests
 import json
-import time
 import os
 import logging
 from datetime import datetime, timedelta
 from typing import Generator, Optional
 
 from config import (
-    DEEPSEEK_API_KEY,
-    DEEPSEEK_MODEL,
-    DEEPSEEK_API_URL,
     MAX_HISTORY,
     SENSITIVE_WORDS,
-    STREAM_DELAY
 )
 
 from data_store import (
     load_user_data,
-    save_user_data,
     add_user_memory,
+    append_chat_turn,
     get_user_memory_text,
     append_affinity_eval_log,
     get_relationship_state,
     increment_user_msg_count,
     reset_user_msg_count,
     save_relationship_state,
+    transaction,
 )
+from core.llm_client import llm_stream
+from core.stream_pacing import notice_pace, pace_for, paced_sync
 from relationship.emotion_client import analyze_relationship
 from relationship.judge import evaluate_affinity_delta
 
@@ -227,39 +224,8 @@ def build_messages(
 # =========================================================
 
 def call_deepseek_stream(messages):
-    payload = {
-        "model": DEEPSEEK_MODEL,
-        "messages": messages,
-        "stream": True,
-        "temperature": 1.3
-    }
-
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    with requests.post(
-        DEEPSEEK_API_URL,
-        headers=headers,
-        json=payload,
-        stream=True,
-        timeout=60
-    ) as resp:
-        resp.raise_for_status()
-        for line in resp.iter_lines():
-            if not line:
-                continue
-            line = line.decode("utf-8")
-            if not line.startswith("data:"):
-                continue
-
-            data = line.replace("data:", "").strip()
-            if data == "[DONE]":
-                break
-
-            chunk = json.loads(data)
-            yield chunk["choices"][0]["delta"].get("content", "")
+    # 走 core.llm_client 的共享连接池，不再每轮新建连接
+    yield from llm_stream(messages)
 
 # =========================================================
 # 后处理（记忆 / 情绪等扩展口）
@@ -278,13 +244,12 @@ def stream_chat_with_deepseek(
     user_input: str,
     character_id: Optional[str] = None,
 ) -> Generator[str, None, None]:
+    # 打字效果沿用 core.stream_pacing 的间隔配置（提示语 STREAM_PACE_MS_NOTICE，回复按角色/档位）
 
     # 1. 安全检测
     unsafe, warning = check_sensitive(user_input)
     if unsafe:
-        for c in warning:
-            yield c
-            time.sleep(STREAM_DELAY)
+        yield from paced_sync(warning, notice_pace())
         return
 
     # 2. 读取用户数据
@@ -308,9 +273,12 @@ def stream_chat_with_deepseek(
 
     # 4.5 关系评估（仅虚拟IP）
     if character_id:
-        increment_user_msg_count(user_id, character_id)
-        state = get_relationship_state(user_id, character_id)
-        trigger_info = evaluate_affinity_trigger(state, user_input)
+        # 计数与触发判断在一个短事务里完成；标注要请求上游（批量模式下还会等批次窗口），
+        # 期间不持有用户锁，拿到结果后再开一个短事务重新读取状态、写入增量与日志
+        with transaction(user_id):
+            increment_user_msg_count(user_id, character_id)
+            state = get_relationship_state(user_id, character_id)
+            trigger_info = evaluate_affinity_trigger(state, user_input)
         trigger_reason = trigger_info.get("trigger_reason")
 
         if trigger_reason and not trigger_info.get("should_eval", False):
@@ -330,18 +298,21 @@ def stream_chat_with_deepseek(
                 character_id=character_id,
                 character_name=CHARACTER_NAME_MAP.get(character_id, character_id),
                 messages=recent_messages,
+                user_id=user_id,
             )
             signals = result.get("signals", ["neutral_interaction"])
             confidence = result.get("confidence", "low")
-            score_before = float(state.get("affinity_score", 50))
-            stable_streak_before = int(state.get("stable_streak", 0))
-            delta, note = evaluate_affinity_delta(state, signals, confidence)
-            state["affinity_score"] = max(0.0, min(100.0, score_before + delta))
-            score_after = float(state.get("affinity_score", 50))
-            stable_streak_after = int(state.get("stable_streak", 0))
-            save_relationship_state(user_id, character_id, state)
-            append_affinity_eval_log(user_id, character_id, signals, confidence, delta, note)
-            reset_user_msg_count(user_id, character_id)
+            with transaction(user_id):
+                state = get_relationship_state(user_id, character_id)
+                score_before = float(state.get("affinity_score", 50))
+                stable_streak_before = int(state.get("stable_streak", 0))
+                delta, note = evaluate_affinity_delta(state, signals, confidence)
+                state["affinity_score"] = max(0.0, min(100.0, score_before + delta))
+                score_after = float(state.get("affinity_score", 50))
+                stable_streak_after = int(state.get("stable_streak", 0))
+                save_relationship_state(user_id, character_id, state)
+                append_affinity_eval_log(user_id, character_id, signals, confidence, delta, note)
+                reset_user_msg_count(user_id, character_id)
 
             risk_buffer = state.get("risk_buffer", {}) if isinstance(state, dict) else {}
             logger.info(json.dumps({
@@ -368,27 +339,22 @@ def stream_chat_with_deepseek(
     # 5. 调模型
     full_reply = ""
     try:
-        for delta in call_deepseek_stream(messages):
+        for delta in paced_sync(call_deepseek_stream(messages), pace_for(None, character_id)):
             if delta:
                 full_reply += delta
                 yield delta
-                time.sleep(STREAM_DELAY)
     except Exception:
-        err = "（对话异常，请稍后再试）"
-        for c in err:
-            yield c
-            time.sleep(STREAM_DELAY)
+        yield from paced_sync("（对话异常，请稍后再试）", notice_pace())
         return
 
-    # 6. 写回历史
-    history.append({"role": "user", "content": user_input})
-    history.append({"role": "assistant", "content": full_reply})
-    if character_id:
-        user_info.setdefault("character_histories", {})[history_key] = history[-MAX_HISTORY * 2:]
-    else:
-        user_info["history"] = history[-MAX_HISTORY * 2:]
-
-    # 7. 后处理
-    post_process(user_id, user_info, user_input, full_reply)
-
-    save_user_data(user_id, user_info)
+    # 6. 写回历史（追加到轮次日志）+ 7. 后处理，同一事务内完成
+    with transaction(user_id):
+        user_info = append_chat_turn(
+            user_id,
+            user_input,
+            full_reply,
+            history_key=history_key if character_id else None,
+            fallback_key=character_id,
+            max_messages=MAX_HISTORY * 2,
+        )
+        post_process(user_id, user_info, user_input, full_reply)
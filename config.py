@@ -24,11 +24,19 @@ def get_port():
 
 PORT = get_port()
 
+# worker 进程数（与 uvicorn/gunicorn 的 WEB_CONCURRENCY 约定一致），>1 时存储层切换到跨进程模式
+def get_workers():
+    try:
+        return max(1, int(os.getenv("WEB_CONCURRENCY") or 1))
+    except (ValueError, TypeError):
+        return 1
+
+WORKERS = get_workers()
+
 # 自定义配置
 MAX_HISTORY = 8  # 最多保留8轮对话历史
 MAX_MEMORY_LEN = 500  # 用户记忆最大长度
 SENSITIVE_WORDS = ["自杀", "自残", "暴力", "色情"]
-STREAM_DELAY = 0.09  # 流式输出字间隔（秒）
 
 # 关键：新增进度存储全局字典（修复导入错误的核心）
 customize_progress = {}
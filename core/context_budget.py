@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import re
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# =========================================================
+# 上下文 token 预算：本地估算 token 数（不走网络），按档位给每轮提示词一个总预算；
+# system prompt、控制块、提示与本轮输入是固定开销，剩余预算先给长期记忆，
+# 再从最新一条开始倒序装入历史，装不下的那一条截取结尾后停止
+# 估算口径（DeepSeek 文档）：1 个中文字符约 0.6 token，1 个英文字符约 0.3 token
+# =========================================================
+
+CONTEXT_TOKENS_PLUS = int(os.getenv("CONTEXT_TOKENS_PLUS", "3000"))
+CONTEXT_TOKENS_PRO = int(os.getenv("CONTEXT_TOKENS_PRO", "3500"))
+CONTEXT_TOKENS_IP = int(os.getenv("CONTEXT_TOKENS_IP", "4000"))
+CONTEXT_TOKENS_ANALYSIS = int(os.getenv("CONTEXT_TOKENS_ANALYSIS", "1500"))
+
+_CJK_TOKENS_PER_CHAR = 0.6
+_OTHER_TOKENS_PER_CHAR = 0.3
+_MESSAGE_OVERHEAD = 4
+_TRUNCATED_PREFIX = "…"
+_MIN_TRUNCATED_TOKENS = 32
+_CJK = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return math.ceil(cjk * _CJK_TOKENS_PER_CHAR + (len(text) - cjk) * _OTHER_TOKENS_PER_CHAR)
+
+
+def message_tokens(messages: list[dict]) -> int:
+    return sum(estimate_tokens(str(m.get("content", ""))) + _MESSAGE_OVERHEAD for m in messages)
+
+
+def budget_for(tier: str | None, character_id: str | None = None) -> int:
+    if character_id:
+        return CONTEXT_TOKENS_IP
+    return CONTEXT_TOKENS_PRO if (tier or "").lower() == "pro" else CONTEXT_TOKENS_PLUS
+
+
+def _tail_to_fit(text: str, budget: int) -> str:
+    """保留文本结尾、估算不超过 budget 的部分。"""
+    if budget <= 0:
+        return ""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if estimate_tokens(_TRUNCATED_PREFIX + text[mid:]) <= budget:
+            hi = mid
+        else:
+            lo = mid + 1
+    return _TRUNCATED_PREFIX + text[lo:] if lo < len(text) else ""
+
+
+class ContextBudget:
+    """一轮提示词的 token 预算；构造提示词时依次记入各部分，最后 report() 给出用量。"""
+
+    def __init__(self, total: int, label: str = ""):
+        self.total = max(0, total)
+        self.label = label
+        self.parts: dict[str, int] = {}
+        self.history_messages = 0
+        self.history_dropped = 0
+        self.history_truncated = False
+        self.nuggets_dropped = 0
+
+    @property
+    def used(self) -> int:
+        return sum(self.parts.values())
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.total - self.used)
+
+    def add(self, part: str, *texts: str) -> None:
+        tokens = sum(estimate_tokens(t) + _MESSAGE_OVERHEAD for t in texts)
+        self.parts[part] = self.parts.get(part, 0) + tokens
+
+    def take_nuggets(self, nuggets: list[str], max_items: int, share: float = 0.25) -> list[str]:
+        """从最新的记忆开始取，最多 max_items 条、不超过剩余预算的 share。"""
+        limit = int(self.remaining * share)
+        taken: list[str] = []
+        used = 0
+        for nugget in reversed(nuggets[-max_items:] if max_items > 0 else []):
+            cost = estimate_tokens(nugget) + 1
+            if used + cost > limit:
+                break
+            taken.append(nugget)
+            used += cost
+        self.nuggets_dropped = min(len(nuggets), max_items) - len(taken)
+        self.parts["memory"] = self.parts.get("memory", 0) + used
+        return list(reversed(taken))
+
+    def _select_history(
+        self, history: list[dict], limit_rounds: int | None, budget: int, fmt: str, overhead: int
+    ) -> tuple[list[tuple[str, str]], int]:
+        """从最新一条开始倒序挑选历史，返回按时间顺序的 (role, content) 与用量。"""
+        candidates = history[-(limit_rounds * 2) :] if limit_rounds else history
+        picked: list[tuple[str, str]] = []
+        used = 0
+        for item in reversed(candidates):
+            role = item.get("role", "user")
+            content = str(item.get("content", ""))
+            cost = estimate_tokens(fmt.format(role=role, content=content)) + overhead
+            if used + cost > budget:
+                # 装不下的这一条（通常是一大段倾诉）保留结尾，剩余太少就不截了
+                if budget - used > _MIN_TRUNCATED_TOKENS:
+                    frame = estimate_tokens(fmt.format(role=role, content="")) + overhead
+                    content = _tail_to_fit(content, budget - used - frame)
+                    if content:
+                        picked.append((role, content))
+                        used += estimate_tokens(fmt.format(role=role, content=content)) + overhead
+                        self.history_truncated = True
+                break
+            picked.append((role, content))
+            used += cost
+        self.history_messages = len(picked)
+        self.history_dropped = len(candidates) - len(picked)
+        picked.reverse()
+        return picked, used
+
+    def pack_history(self, summary: str, history: list[dict], limit_rounds: int | None = None) -> str:
+        """摘要 + 最近的历史，按剩余预算从新到旧装入；每行 "summary: ..." 或 "role: content"。"""
+        lines = [f"summary: {summary}"] if summary else []
+        summary_cost = estimate_tokens(lines[0]) + 1 if lines else 0
+        picked, used = self._select_history(history, limit_rounds, self.remaining - summary_cost, "{role}: {content}", 1)
+        lines.extend(f"{role}: {content}" for role, content in picked)
+        self.parts["history"] = self.parts.get("history", 0) + used + summary_cost
+        return "\n".join(lines)
+
+    def pack_history_messages(self, history: list[dict], limit_rounds: int | None = None) -> list[dict]:
+        """同 pack_history，但每条历史保留为独立的 user/assistant 消息（摘要由调用方单独放置）。"""
+        picked, used = self._select_history(history, limit_rounds, self.remaining, "{content}", _MESSAGE_OVERHEAD)
+        self.parts["history"] = self.parts.get("history", 0) + used
+        return [{"role": role, "content": content} for role, content in picked]
+
+    def report(self) -> dict[str, Any]:
+        return {
+            "label": self.label,
+            "budget": self.total,
+            "used": self.used,
+            "parts": dict(self.parts),
+            "history_messages": self.history_messages,
+            "history_dropped": self.history_dropped,
+            "history_truncated": self.history_truncated,
+            "nuggets_dropped": self.nuggets_dropped,
+        }
+
+
+def log_context_budget(budget: ContextBudget, **fields: Any) -> None:
+    logger.info(json.dumps({"event": "context_budget", **fields, **budget.report()}, ensure_ascii=False))
@@ -1,10 +1,25 @@
 from __future__ import annotations
 
-from core.schemas import ConversationState
-from data_store import load_user_data, save_user_data
+import asyncio
+import atexit
+import os
+import time
+from collections import OrderedDict
+from typing import Any
+
+from core.lock_manager import get_lock
+from core.schemas import ConversationState, TurnRecord
+from core.turn_archive import archive_turns, load_archived_turns
+from data_store import DATA_STORE_MULTI_PROCESS, load_user_data, run_storage_io, transaction
 
 
 CONV_STATE_KEY = "conv_states"
+# 每个会话状态里保留的最近轮数；超出 CONV_STATE_ARCHIVE_BATCH 轮后，把较早的轮次批量移入归档
+CONV_STATE_MAX_TURNS = int(os.getenv("CONV_STATE_MAX_TURNS", "20"))
+CONV_STATE_ARCHIVE_BATCH = int(os.getenv("CONV_STATE_ARCHIVE_BATCH", "10"))
+CONV_STATE_CACHE_MAX = int(os.getenv("CONV_STATE_CACHE_MAX", "1024"))
+CONV_STATE_CACHE_IDLE_SECONDS = float(os.getenv("CONV_STATE_CACHE_IDLE_SECONDS", "600"))
+CONV_STATE_FLUSH_INTERVAL = float(os.getenv("CONV_STATE_FLUSH_INTERVAL", "2"))
 
 
 def _state_validate(raw: dict) -> ConversationState:
@@ -13,7 +28,13 @@ def _state_validate(raw: dict) -> ConversationState:
     return ConversationState.parse_obj(raw)
 
 
-def _state_dump(state: ConversationState) -> dict:
+def _turn_validate(raw: dict) -> TurnRecord:
+    if hasattr(TurnRecord, "model_validate"):
+        return TurnRecord.model_validate(raw)
+    return TurnRecord.parse_obj(raw)
+
+
+def _state_dump(state: ConversationState | TurnRecord) -> dict:
     if hasattr(state, "model_dump"):
         return state.model_dump()
     return state.dict()
@@ -31,20 +52,280 @@ def load_state(user_id: str, conv_key: str) -> ConversationState | None:
     return _state_validate(raw)
 
 
+def _take_overflow(state: ConversationState) -> list[TurnRecord]:
+    """超出保留轮数时，从状态中摘下较早的轮次（待归档）。"""
+    if CONV_STATE_MAX_TURNS <= 0 or len(state.turns) < CONV_STATE_MAX_TURNS + max(1, CONV_STATE_ARCHIVE_BATCH):
+        return []
+    overflow = state.turns[:-CONV_STATE_MAX_TURNS]
+    state.turns = state.turns[-CONV_STATE_MAX_TURNS:]
+    return overflow
+
+
 def save_state(user_id: str, state: ConversationState) -> None:
-    user_info = load_user_data(user_id)
-    conv_states = user_info.setdefault(CONV_STATE_KEY, {})
-    conv_states[state.conv_key] = _state_dump(state)
-    save_user_data(user_id, user_info)
+    with transaction(user_id) as user_info:
+        overflow = _take_overflow(state)
+        if overflow:
+            try:
+                archive_turns(user_id, state.conv_key, [_state_dump(turn) for turn in overflow])
+            except OSError:
+                # 归档失败时先留在状态里，下次保存再试
+                state.turns = overflow + state.turns
+        conv_states = user_info.setdefault(CONV_STATE_KEY, {})
+        conv_states[state.conv_key] = _state_dump(state)
+
+
+def _persist_state(user_id: str, conv_key: str, raw: dict, archived: list[dict]) -> None:
+    with transaction(user_id) as user_info:
+        archive_turns(user_id, conv_key, archived)
+        user_info.setdefault(CONV_STATE_KEY, {})[conv_key] = raw
 
 
 def ensure_state(user_id: str, conv_key: str) -> ConversationState:
-    state = load_state(user_id, conv_key)
-    if state is not None:
+    with transaction(user_id):
+        state = load_state(user_id, conv_key)
+        if state is not None:
+            return state
+        state = ConversationState(conv_key=conv_key)
+        save_state(user_id, state)
         return state
-    state = ConversationState(conv_key=conv_key)
-    save_state(user_id, state)
-    return state
+
+
+async def aload_turn_history(user_id: str, conv_key: str, limit: int | None = None) -> list[TurnRecord]:
+    """会话的完整轮次记录（归档 + 状态中的最近轮次），按需读取归档。
+    缓存只在事件循环上读：先同步取一份快照（含已移出状态、尚未写入归档的轮次），再到存储线程读归档。"""
+    entry = _state_cache.entries.get(conv_key)
+    if entry is not None:
+        hot = [_state_dump(turn) for turn in entry.state.turns]
+        pending = list(entry.pending_archive)
+    else:
+        state = await aload_state(user_id, conv_key)
+        hot = [_state_dump(turn) for turn in state.turns] if state else []
+        pending = []
+    if limit is not None and len(hot) >= limit:
+        return [_turn_validate(raw) for raw in hot[-limit:]] if limit > 0 else []
+    first_hot = hot[0]["round_id"] if hot else None
+    by_round = {
+        raw["round_id"]: raw
+        for raw in await run_storage_io(load_archived_turns, user_id, conv_key) + pending
+        if first_hot is None or raw["round_id"] < first_hot
+    }
+    turns = [by_round[round_id] for round_id in sorted(by_round)] + hot
+    if limit is not None:
+        turns = turns[-limit:] if limit > 0 else []
+    return [_turn_validate(raw) for raw in turns]
+
+
+async def aload_state(user_id: str, conv_key: str) -> ConversationState | None:
+    return await run_storage_io(load_state, user_id, conv_key)
+
+
+async def asave_state(user_id: str, state: ConversationState) -> None:
+    await run_storage_io(save_state, user_id, state)
+
+
+async def aensure_state(user_id: str, conv_key: str) -> ConversationState:
+    return await run_storage_io(ensure_state, user_id, conv_key)
+
+
+# =========================================================
+# 会话状态缓存：按 conv_key 缓存活动的 ConversationState 对象，
+# 调用方需持有 core.lock_manager 的会话锁；修改后只标脏，
+# 由事件循环上的后台任务定期写回（write-behind），空闲或超出容量时淘汰。
+# 多进程模式下其他 worker 可能处理同一会话，缓存关闭，直接读写存储
+# =========================================================
+
+class _StateEntry:
+    __slots__ = ("user_id", "state", "dirty", "last_used", "pending_archive")
+
+    def __init__(self, user_id: str, state: ConversationState):
+        self.user_id = user_id
+        self.state = state
+        self.dirty = False
+        self.last_used = time.monotonic()
+        # 已从状态摘下、尚未成功写入归档的轮次
+        self.pending_archive: list[dict] = []
+
+
+class _StateCache:
+    def __init__(self, max_entries: int, idle_seconds: float, flush_interval: float, enabled: bool):
+        self.max_entries = max(1, max_entries)
+        self.idle_seconds = idle_seconds
+        self.flush_interval = max(0.05, flush_interval)
+        self.enabled = enabled
+        self.entries: OrderedDict[str, _StateEntry] = OrderedDict()
+        self._flush_lock: asyncio.Lock | None = None
+        self._task: asyncio.Task | None = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "puts": 0,
+            "flushes": 0,
+            "flushed_states": 0,
+            "flush_errors": 0,
+            "skipped_locked": 0,
+            "evictions": 0,
+        }
+
+    async def get(self, user_id: str, conv_key: str) -> ConversationState:
+        if not self.enabled:
+            return await aensure_state(user_id, conv_key)
+        self._ensure_flusher()
+        entry = self.entries.get(conv_key)
+        if entry is not None:
+            self._stats["hits"] += 1
+            entry.last_used = time.monotonic()
+            self.entries.move_to_end(conv_key)
+            return entry.state
+        self._stats["misses"] += 1
+        state = await aensure_state(user_id, conv_key)
+        entry = self.entries.get(conv_key)
+        if entry is None:
+            entry = _StateEntry(user_id, state)
+            self.entries[conv_key] = entry
+        return entry.state
+
+    async def put(self, user_id: str, state: ConversationState) -> None:
+        if not self.enabled:
+            await asave_state(user_id, state)
+            return
+        self._stats["puts"] += 1
+        entry = self.entries.get(state.conv_key)
+        if entry is None:
+            entry = _StateEntry(user_id, state)
+            self.entries[state.conv_key] = entry
+        entry.state = state
+        entry.dirty = True
+        entry.last_used = time.monotonic()
+        self.entries.move_to_end(state.conv_key)
+        self._ensure_flusher()
+
+    async def flush(self, wait: bool = False) -> int:
+        """写回脏状态。默认跳过锁正被占用的会话（如正在做情绪分析），下一轮再写，
+        避免一个会话拖住其他会话的写回与淘汰；wait=True（退出时）逐个等锁，全部写完。"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            written = 0
+            for conv_key, entry in list(self.entries.items()):
+                if not entry.dirty:
+                    continue
+                lock = get_lock(conv_key)
+                if not wait and lock.locked():
+                    self._stats["skipped_locked"] += 1
+                    continue
+                async with lock:
+                    overflow = _take_overflow(entry.state)
+                    entry.pending_archive.extend(_state_dump(turn) for turn in overflow)
+                    raw = _state_dump(entry.state)
+                    archived = list(entry.pending_archive)
+                    entry.dirty = False
+                try:
+                    await run_storage_io(_persist_state, entry.user_id, conv_key, raw, archived)
+                except Exception:
+                    entry.dirty = True
+                    self._stats["flush_errors"] += 1
+                    continue
+                del entry.pending_archive[: len(archived)]
+                written += 1
+            self._stats["flushes"] += 1
+            self._stats["flushed_states"] += written
+            self._evict()
+            return written
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for conv_key, entry in list(self.entries.items()):
+            over = len(self.entries) > self.max_entries
+            idle = now - entry.last_used > self.idle_seconds
+            if not over and not idle:
+                break
+            if entry.dirty or entry.pending_archive or get_lock(conv_key).locked():
+                continue
+            del self.entries[conv_key]
+            self._stats["evictions"] += 1
+
+    def flush_sync(self) -> int:
+        """进程退出时（事件循环已停止）同步写回剩余的脏状态。"""
+        written = 0
+        for conv_key, entry in list(self.entries.items()):
+            if not entry.dirty and not entry.pending_archive:
+                continue
+            overflow = _take_overflow(entry.state)
+            entry.pending_archive.extend(_state_dump(turn) for turn in overflow)
+            try:
+                _persist_state(entry.user_id, conv_key, _state_dump(entry.state), entry.pending_archive)
+            except Exception:
+                self._stats["flush_errors"] += 1
+                continue
+            entry.dirty = False
+            entry.pending_archive = []
+            written += 1
+        return written
+
+    def _ensure_flusher(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+            return
+        self._flush_lock = asyncio.Lock()
+        self._task = loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                continue
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.enabled:
+            await self.flush(wait=True)
+
+    def stats(self) -> dict[str, Any]:
+        stats = dict(self._stats)
+        stats["size"] = len(self.entries)
+        stats["dirty"] = sum(1 for entry in self.entries.values() if entry.dirty)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["max_entries"] = self.max_entries
+        stats["idle_seconds"] = self.idle_seconds
+        stats["flush_interval"] = self.flush_interval
+        stats["enabled"] = self.enabled
+        return stats
+
+
+_state_cache = _StateCache(
+    CONV_STATE_CACHE_MAX,
+    CONV_STATE_CACHE_IDLE_SECONDS,
+    CONV_STATE_FLUSH_INTERVAL,
+    enabled=CONV_STATE_CACHE_MAX > 0 and not DATA_STORE_MULTI_PROCESS,
+)
+atexit.register(_state_cache.flush_sync)
+
+
+async def aget_state(user_id: str, conv_key: str) -> ConversationState:
+    """取会话的活动状态（不存在则创建）。调用方需持有该 conv_key 的会话锁。"""
+    return await _state_cache.get(user_id, conv_key)
+
+
+async def aput_state(user_id: str, state: ConversationState) -> None:
+    """标记会话状态已修改，稍后写回存储。调用方需持有该 conv_key 的会话锁。"""
+    await _state_cache.put(user_id, state)
+
+
+async def flush_state_cache() -> int:
+    return await _state_cache.flush()
+
+
+async def close_state_cache() -> None:
+    await _state_cache.close()
+
+
+def get_state_cache_stats() -> dict[str, Any]:
+    return _state_cache.stats()
 
 
 def next_round_id(state: ConversationState) -> int:
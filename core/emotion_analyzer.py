@@ -2,8 +2,11 @@ from __future__ import annotations
 
 import json
 
-from core.llm_client import llm_complete
+from config import DEEPSEEK_MODEL
+from core.llm_client import allm_complete, llm_complete
+from core.response_cache import cache_key, get_response_cache
 from core.schemas import EmotionAnalysis
+from core.single_flight import get_single_flight
 
 
 class EmotionAnalyzerError(Exception):
@@ -28,24 +31,93 @@ def _extract_json(text: str) -> dict:
         raise
 
 
-def analyze_emotion(history_text: str, user_text: str) -> EmotionAnalysis:
+def _build_messages(history_text: str, user_text: str) -> list[dict]:
     prompt = (
         f"历史对话:\n{history_text}\n\n"
         f"用户本轮输入:\n{user_text}\n"
         "请给出情绪/意图/风险评分，评分范围 0~1，valence 范围 -1~1。"
     )
-    messages = [
+    return [
         {"role": "system", "content": _ANALYSIS_SYSTEM},
         {"role": "user", "content": prompt},
     ]
 
+
+_CACHE = get_response_cache("emotion_analyzer")
+_FLIGHT = get_single_flight("emotion_analyzer")
+
+
+def _parse(raw: str | None) -> EmotionAnalysis | None:
+    if raw is None:
+        return None
+    try:
+        return EmotionAnalysis.model_validate(_extract_json(raw))
+    except Exception:
+        return None
+
+
+def _validate(raw: str | None) -> None:
+    # 上游可能返回 content 为 null，按输出不合法处理（再要一次）
+    if not isinstance(raw, str):
+        raise ValueError(f"non-text output: {type(raw).__name__}")
+    EmotionAnalysis.model_validate(_extract_json(raw))
+
+
+def _fetch(messages: list[dict], key: str, meta: dict | None) -> str:
+    """调用上游直到拿到可解析的输出，返回原始文本（同一输入的并发调用经 single-flight 只执行一次）。
+    重试、对冲与换端点已由 llm_complete 完成，这里只在输出不是合法 JSON / 字段不合法时再要一次；
+    超时、熔断等上游错误直接交给调用方兜底。"""
     last_error: Exception | None = None
     for _ in range(2):
         try:
-            raw = llm_complete(messages, temperature=0.0)
-            data = _extract_json(raw)
-            return EmotionAnalysis.model_validate(data)
+            raw = llm_complete(messages, temperature=0.0, stage="emotion_analyzer", meta=meta)
         except Exception as exc:
+            raise EmotionAnalyzerError(f"emotion_analyzer_failed: {exc}") from exc
+        try:
+            _validate(raw)
+        except ValueError as exc:
             last_error = exc
+            continue
+        _CACHE.put(key, raw)
+        return raw
 
     raise EmotionAnalyzerError(f"emotion_analyzer_failed: {last_error}")
+
+
+async def _afetch(messages: list[dict], key: str, meta: dict | None) -> str:
+    last_error: Exception | None = None
+    for _ in range(2):
+        try:
+            raw = await allm_complete(messages, temperature=0.0, stage="emotion_analyzer", meta=meta)
+        except Exception as exc:
+            raise EmotionAnalyzerError(f"emotion_analyzer_failed: {exc}") from exc
+        try:
+            _validate(raw)
+        except ValueError as exc:
+            last_error = exc
+            continue
+        await _CACHE.aput(key, raw)
+        return raw
+
+    raise EmotionAnalyzerError(f"emotion_analyzer_failed: {last_error}")
+
+
+def analyze_emotion(history_text: str, user_text: str, meta: dict | None = None) -> EmotionAnalysis:
+    messages = _build_messages(history_text, user_text)
+    key = cache_key(DEEPSEEK_MODEL, messages, temperature=0.0)
+    cached = _parse(_CACHE.get(key))
+    if cached is not None:
+        return cached
+    # 每个调用方各自解析一份，避免共享同一个可变对象
+    return _parse(_FLIGHT.do(key, lambda: _fetch(messages, key, meta)))
+
+
+async def aanalyze_emotion(history_text: str, user_text: str, meta: dict | None = None) -> EmotionAnalysis:
+    """analyze_emotion 的 async 版本，供 async 路由使用，等待上游时不阻塞事件循环。
+    meta（user_id / character / tier）用于用量计量。"""
+    messages = _build_messages(history_text, user_text)
+    key = cache_key(DEEPSEEK_MODEL, messages, temperature=0.0)
+    cached = _parse(await _CACHE.aget(key))
+    if cached is not None:
+        return cached
+    return _parse(await _FLIGHT.ado(key, lambda: _afetch(messages, key, meta)))
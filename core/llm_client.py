@@ -1,27 +1,445 @@
 from __future__ import annotations
 
-import requests
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Iterator
 
-from chat_core import call_deepseek_stream
-from config import DEEPSEEK_API_KEY, DEEPSEEK_API_URL, DEEPSEEK_MODEL
+import httpx
 
+from core.llm_usage import record_usage
+from core.llm_router import Endpoint, Route
+from core.resilience import CircuitOpenError
 
-def llm_complete(messages: list[dict], temperature: float = 0.0, timeout: int = 60) -> str:
+logger = logging.getLogger(__name__)
+
+# =========================================================
+# LLM HTTP 客户端：进程内共享的 keep-alive 连接池，
+# async 路由用 allm_stream / allm_complete（httpx.AsyncClient，按事件循环创建），
+# 同步调用方用 llm_stream / llm_complete（httpx.Client，线程安全），不再每轮新建 TCP+TLS 连接
+# 发往哪个端点（DeepSeek / Ark）由 core.llm_router 按实测 TTFT 与错误率决定；
+# 期限、重试、对冲与熔断由 core.resilience 按端点处理；流式调用只在首个 token 之前重试或切换端点
+# =========================================================
+
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "0") == "1"
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+LLM_STREAM_TEMPERATURE = 1.3
+
+_STATS_LOCK = threading.Lock()
+_STATS = {
+    "requests": 0,
+    "streams": 0,
+    "errors": 0,
+    "http2_responses": 0,
+    "clients_created": 0,
+    "first_tokens": 0,
+    "first_token_ms_total": 0.0,
+    "first_token_ms_max": 0.0,
+}
+
+_async_client: httpx.AsyncClient | None = None
+_async_client_loop: asyncio.AbstractEventLoop | None = None
+_sync_client: httpx.Client | None = None
+_sync_client_lock = threading.Lock()
+
+
+def _client_kwargs() -> dict[str, Any]:
+    kwargs: dict[str, Any] = {
+        "limits": httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        "headers": {"Content-Type": "application/json"},
+    }
+    if LLM_HTTP2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("LLM_HTTP2=1 but the h2 package is not installed, falling back to HTTP/1.1")
+        else:
+            kwargs["http2"] = True
+    return kwargs
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    """当前事件循环共享的 AsyncClient；连接绑定事件循环，循环变化（脚本里多次 asyncio.run）时重建。"""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(**_client_kwargs())
+        _async_client_loop = loop
+        with _STATS_LOCK:
+            _STATS["clients_created"] += 1
+    return _async_client
+
+
+def _get_sync_client() -> httpx.Client:
+    global _sync_client
+    with _sync_client_lock:
+        if _sync_client is None or _sync_client.is_closed:
+            _sync_client = httpx.Client(**_client_kwargs())
+            with _STATS_LOCK:
+                _STATS["clients_created"] += 1
+        return _sync_client
+
+
+def _auth_headers(endpoint: Endpoint) -> dict[str, str]:
+    return {"Authorization": f"Bearer {endpoint.api_key}"}
+
+
+def _payload(messages: list[dict], temperature: float, stream: bool, model: str) -> dict[str, Any]:
     payload = {
-        "model": DEEPSEEK_MODEL,
+        "model": model,
         "messages": messages,
-        "stream": False,
+        "stream": stream,
         "temperature": temperature,
     }
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    resp = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=timeout)
-    resp.raise_for_status()
-    data = resp.json()
-    return data["choices"][0]["message"]["content"]
+    if stream:
+        # 流的最后一个 chunk 带上 usage（含 prompt_cache_hit_tokens / prompt_cache_miss_tokens）
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+
+UsageCallback = Callable[[dict], None]
+
+
+def _sse_delta(line: str, on_usage: UsageCallback | None = None) -> str | None:
+    """解析一行 SSE：返回本行的增量文本（非 data 行为空串），遇到 [DONE] 返回 None。
+    带 usage 的 chunk（choices 为空）交给 on_usage。"""
+    if not line.startswith("data:"):
+        return ""
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return None
+    chunk = json.loads(data)
+    usage = chunk.get("usage")
+    if usage and on_usage is not None:
+        try:
+            on_usage(usage)
+        except Exception:
+            logger.exception("usage callback failed")
+    choices = chunk.get("choices") or []
+    if not choices:
+        return ""
+    return (choices[0].get("delta") or {}).get("content") or ""
+
+
+def _record_response(resp: httpx.Response, stream: bool) -> None:
+    with _STATS_LOCK:
+        _STATS["streams" if stream else "requests"] += 1
+        if resp.http_version == "HTTP/2":
+            _STATS["http2_responses"] += 1
+
+
+def _record_first_token(elapsed_ms: float) -> None:
+    with _STATS_LOCK:
+        _STATS["first_tokens"] += 1
+        _STATS["first_token_ms_total"] += elapsed_ms
+        _STATS["first_token_ms_max"] = max(_STATS["first_token_ms_max"], elapsed_ms)
+
+
+def _record_error() -> None:
+    with _STATS_LOCK:
+        _STATS["errors"] += 1
+
+
+class _CallMeter:
+    """一次上游调用的计时与 usage；给了 stage 时结束后写入 core.llm_usage 的逐次计量。"""
+
+    def __init__(self, stage: str | None, meta: dict | None, on_usage: UsageCallback | None = None):
+        self.stage = stage
+        self.meta = meta or {}
+        self.on_usage = on_usage
+        self.start = time.perf_counter()
+        self.ttft_ms: float | None = None
+        self.usage: dict | None = None
+        self.ok = False
+
+    def capture_usage(self, usage: dict) -> None:
+        self.usage = usage
+        if self.on_usage is not None:
+            self.on_usage(usage)
+
+    def first_token(self) -> None:
+        if self.ttft_ms is None:
+            self.ttft_ms = (time.perf_counter() - self.start) * 1000
+            _record_first_token(self.ttft_ms)
+
+    def finish(self) -> None:
+        if self.stage:
+            record_usage(
+                self.stage,
+                self.usage,
+                (time.perf_counter() - self.start) * 1000,
+                ttft_ms=self.ttft_ms,
+                ok=self.ok,
+                **self.meta,
+            )
+
+
+def _stream_timeout(budget: float) -> httpx.Timeout:
+    return httpx.Timeout(min(LLM_READ_TIMEOUT, budget), connect=min(LLM_CONNECT_TIMEOUT, budget))
+
+
+def _ms_since(start: float) -> float:
+    return (time.perf_counter() - start) * 1000
+
+
+def llm_complete(
+    messages: list[dict],
+    temperature: float = 0.0,
+    timeout: float | None = None,
+    stage: str | None = None,
+    meta: dict | None = None,
+) -> str:
+    """stage / meta（user_id、character、tier）用于逐次计量，见 core.llm_usage；
+    timeout 为单次尝试的上限，默认取上游策略。端点由 core.llm_router 选择，失败后换下一个。"""
+    meter = _CallMeter(stage, meta)
+    route = Route(retry=False)
+    try:
+        while True:
+            endpoint, _ = route.next()
+            payload = _payload(messages, temperature, stream=False, model=endpoint.model)
+
+            def send(attempt_timeout: float) -> dict:
+                resp = _get_sync_client().post(
+                    endpoint.url,
+                    headers=_auth_headers(endpoint),
+                    json=payload,
+                    timeout=attempt_timeout,
+                )
+                _record_response(resp, stream=False)
+                resp.raise_for_status()
+                return resp.json()
+
+            endpoint.begin()
+            started = time.perf_counter()
+            try:
+                data = endpoint.upstream.call(send, timeout=timeout)
+            except Exception as exc:
+                endpoint.end(None, ok=False)
+                route.failed(endpoint, exc)
+                continue
+            endpoint.end(None, ok=True, complete_ms=_ms_since(started))
+            break
+        meter.usage = data.get("usage")
+        content = data["choices"][0]["message"]["content"]
+        meter.ok = True
+        return content
+    except Exception:
+        _record_error()
+        raise
+    finally:
+        meter.finish()
+
+
+def llm_stream(
+    messages: list[dict],
+    temperature: float = LLM_STREAM_TEMPERATURE,
+    on_usage: UsageCallback | None = None,
+    stage: str | None = None,
+    meta: dict | None = None,
+) -> Iterator[str]:
+    meter = _CallMeter(stage, meta, on_usage)
+    route = Route()
+    try:
+        while True:
+            endpoint, wait_s = route.next()
+            if wait_s:
+                time.sleep(wait_s)
+            upstream = endpoint.upstream
+            try:
+                upstream.before_attempt()
+            except CircuitOpenError as exc:
+                route.failed(endpoint, exc)
+                continue
+            timeout = _stream_timeout(route.budget(endpoint))
+            endpoint.begin()
+            started = time.perf_counter()
+            ttft_ms: float | None = None
+            failed = False
+            try:
+                with _get_sync_client().stream(
+                    "POST",
+                    endpoint.url,
+                    headers=_auth_headers(endpoint),
+                    json=_payload(messages, temperature, stream=True, model=endpoint.model),
+                    timeout=timeout,
+                ) as resp:
+                    _record_response(resp, stream=True)
+                    resp.raise_for_status()
+                    for line in resp.iter_lines():
+                        delta = _sse_delta(line, meter.capture_usage)
+                        if delta is None:
+                            break
+                        if delta:
+                            if ttft_ms is None:
+                                ttft_ms = _ms_since(started)
+                            meter.first_token()
+                            yield delta
+            except Exception as exc:
+                failed = True
+                upstream.record_failure(exc)
+                if meter.ttft_ms is not None:
+                    raise
+                route.failed(endpoint, exc)
+                continue
+            finally:
+                endpoint.end(ttft_ms, ok=not failed, sample=failed or ttft_ms is not None)
+            upstream.record_success()
+            break
+        meter.ok = True
+    except Exception:
+        _record_error()
+        raise
+    finally:
+        meter.finish()
+
+
+async def allm_complete(
+    messages: list[dict],
+    temperature: float = 0.0,
+    timeout: float | None = None,
+    stage: str | None = None,
+    meta: dict | None = None,
+) -> str:
+    meter = _CallMeter(stage, meta)
+    route = Route(retry=False)
+    try:
+        while True:
+            endpoint, _ = route.next()
+            payload = _payload(messages, temperature, stream=False, model=endpoint.model)
+
+            async def send(attempt_timeout: float) -> dict:
+                resp = await _get_async_client().post(
+                    endpoint.url,
+                    headers=_auth_headers(endpoint),
+                    json=payload,
+                    timeout=attempt_timeout,
+                )
+                _record_response(resp, stream=False)
+                resp.raise_for_status()
+                return resp.json()
+
+            endpoint.begin()
+            started = time.perf_counter()
+            try:
+                data = await endpoint.upstream.acall(send, timeout=timeout)
+            except Exception as exc:
+                endpoint.end(None, ok=False)
+                route.failed(endpoint, exc)
+                continue
+            except BaseException:
+                endpoint.end(None, ok=False, sample=False)
+                raise
+            endpoint.end(None, ok=True, complete_ms=_ms_since(started))
+            break
+        meter.usage = data.get("usage")
+        content = data["choices"][0]["message"]["content"]
+        meter.ok = True
+        return content
+    except Exception:
+        _record_error()
+        raise
+    finally:
+        meter.finish()
+
+
+async def allm_stream(
+    messages: list[dict],
+    temperature: float = LLM_STREAM_TEMPERATURE,
+    on_usage: UsageCallback | None = None,
+    stage: str | None = None,
+    meta: dict | None = None,
+) -> AsyncIterator[str]:
+    """流式返回增量文本；读取上游时让出事件循环，多个并发流共用一个循环与连接池。
+    on_usage 在收到上游的 usage 时调用；中途被关闭（客户端断开）时计量记为 ok=False。
+    首个 token 之前失败会切到下一个端点，已经输出过内容就不再重试（否则客户端会看到重复的开头）。"""
+    meter = _CallMeter(stage, meta, on_usage)
+    route = Route()
+    try:
+        while True:
+            endpoint, wait_s = route.next()
+            if wait_s:
+                await asyncio.sleep(wait_s)
+            upstream = endpoint.upstream
+            try:
+                upstream.before_attempt()
+            except CircuitOpenError as exc:
+                route.failed(endpoint, exc)
+                continue
+            timeout = _stream_timeout(route.budget(endpoint))
+            endpoint.begin()
+            started = time.perf_counter()
+            ttft_ms: float | None = None
+            failed = False
+            try:
+                async with _get_async_client().stream(
+                    "POST",
+                    endpoint.url,
+                    headers=_auth_headers(endpoint),
+                    json=_payload(messages, temperature, stream=True, model=endpoint.model),
+                    timeout=timeout,
+                ) as resp:
+                    _record_response(resp, stream=True)
+                    resp.raise_for_status()
+                    async for line in resp.aiter_lines():
+                        delta = _sse_delta(line, meter.capture_usage)
+                        if delta is None:
+                            break
+                        if delta:
+                            if ttft_ms is None:
+                                ttft_ms = _ms_since(started)
+                            meter.first_token()
+                            yield delta
+            except Exception as exc:
+                failed = True
+                upstream.record_failure(exc)
+                if meter.ttft_ms is not None:
+                    raise
+                route.failed(endpoint, exc)
+                continue
+            finally:
+                endpoint.end(ttft_ms, ok=not failed, sample=failed or ttft_ms is not None)
+            upstream.record_success()
+            break
+        meter.ok = True
+    except Exception:
+        _record_error()
+        raise
+    finally:
+        meter.finish()
+
+
+async def aclose_llm_clients() -> None:
+    """关闭共享连接池（应用 shutdown 时调用）。"""
+    global _async_client, _sync_client
+    client, _async_client = _async_client, None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+    with _sync_client_lock:
+        sync_client, _sync_client = _sync_client, None
+    if sync_client is not None:
+        sync_client.close()
 
 
-def llm_stream(messages: list[dict]):
-    yield from call_deepseek_stream(messages)
+def get_llm_client_stats() -> dict[str, Any]:
+    with _STATS_LOCK:
+        stats = dict(_STATS)
+    first_tokens = stats["first_tokens"]
+    stats["first_token_ms_avg"] = round(stats["first_token_ms_total"] / first_tokens, 3) if first_tokens else 0.0
+    stats["first_token_ms_total"] = round(stats["first_token_ms_total"], 3)
+    stats["first_token_ms_max"] = round(stats["first_token_ms_max"], 3)
+    stats["http2"] = LLM_HTTP2
+    stats["max_connections"] = LLM_MAX_CONNECTIONS
+    stats["max_keepalive"] = LLM_MAX_KEEPALIVE
+    return stats
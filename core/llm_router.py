@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import os
+import random
+import threading
+from typing import Any
+
+from config import DEEPSEEK_API_KEY, DEEPSEEK_API_URL, DEEPSEEK_MODEL
+from core.resilience import Upstream, get_upstream
+
+# =========================================================
+# 多服务商路由：DeepSeek 官方与火山方舟（Ark，OpenAI 兼容的 chat/completions）跑的是同一个模型，
+# 每次调用按端点的首 token 耗时（TTFT）与错误率的 EWMA 排序，优先发往当前最快、最稳的端点；
+# 端点有并发上限，满了先用下一个；熔断中的端点跳过。
+# 流式调用在输出首个 token 前失败会立即切到下一个端点（不退避），全部失败后按重试策略再来一轮。
+# 配置：LLM_ENDPOINTS（默认 deepseek,ark；ark 需要 ARK_API_KEY）、ARK_CHAT_URL / ARK_CHAT_MODEL、
+# LLM_MAX_INFLIGHT_<NAME>、LLM_ROUTER_EWMA_ALPHA、LLM_ROUTER_ERROR_PENALTY、LLM_ROUTER_EXPLORE
+# =========================================================
+
+LLM_ENDPOINTS = [n.strip() for n in os.getenv("LLM_ENDPOINTS", "deepseek,ark").split(",") if n.strip()]
+ARK_API_KEY = os.getenv("ARK_API_KEY")
+ARK_CHAT_URL = os.getenv("ARK_CHAT_URL", "https://ark.cn-beijing.volces.com/api/v3/chat/completions")
+ARK_CHAT_MODEL = os.getenv("ARK_CHAT_MODEL", "deepseek-v3-2-251201")
+LLM_ROUTER_EWMA_ALPHA = float(os.getenv("LLM_ROUTER_EWMA_ALPHA", "0.3"))
+LLM_ROUTER_ERROR_PENALTY = float(os.getenv("LLM_ROUTER_ERROR_PENALTY", "4"))
+LLM_ROUTER_EXPLORE = float(os.getenv("LLM_ROUTER_EXPLORE", "0.05"))
+
+_PROVIDERS: dict[str, tuple[str, str | None, str]] = {
+    "deepseek": (DEEPSEEK_API_URL, DEEPSEEK_API_KEY, DEEPSEEK_MODEL),
+    "ark": (ARK_CHAT_URL, ARK_API_KEY, ARK_CHAT_MODEL),
+}
+
+
+class Endpoint:
+    def __init__(self, name: str, url: str, api_key: str | None, model: str, max_inflight: int):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+        self.max_inflight = max(1, max_inflight)
+        self.inflight = 0
+        self.ewma_ttft_ms: float | None = None
+        self.ewma_complete_ms: float | None = None
+        self.ewma_error = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "failovers_from": 0, "overflow": 0}
+
+    @property
+    def upstream(self) -> Upstream:
+        return get_upstream(self.name)
+
+    def score(self) -> float:
+        """越小越好；还没测过的端点记 0，先拿到第一批样本。"""
+        if self.ewma_ttft_ms is None:
+            return 0.0
+        return self.ewma_ttft_ms * (1 + LLM_ROUTER_ERROR_PENALTY * self.ewma_error)
+
+    def full(self) -> bool:
+        return self.inflight >= self.max_inflight
+
+    def begin(self) -> None:
+        with self._lock:
+            self.inflight += 1
+            self.stats["requests"] += 1
+
+    def end(self, ttft_ms: float | None, ok: bool, sample: bool = True, complete_ms: float | None = None) -> None:
+        """ttft_ms：流式调用的首 token 耗时，只有它进入路由得分；非流式调用传 complete_ms（整次耗时），
+        单独记一条 EWMA 供观察，避免几秒的摘要/分析调用拖累聊天的端点选择。失败时只更新错误率。
+        sample=False（如首 token 前客户端就断开）只释放并发名额，不计入测量。"""
+        alpha = LLM_ROUTER_EWMA_ALPHA
+        with self._lock:
+            self.inflight = max(0, self.inflight - 1)
+            if not sample:
+                return
+            self.ewma_error = (1 - alpha) * self.ewma_error + alpha * (0.0 if ok else 1.0)
+            if not ok:
+                self.stats["errors"] += 1
+            if ok and ttft_ms is not None:
+                if self.ewma_ttft_ms is None:
+                    self.ewma_ttft_ms = ttft_ms
+                else:
+                    self.ewma_ttft_ms = (1 - alpha) * self.ewma_ttft_ms + alpha * ttft_ms
+            if ok and complete_ms is not None:
+                if self.ewma_complete_ms is None:
+                    self.ewma_complete_ms = complete_ms
+                else:
+                    self.ewma_complete_ms = (1 - alpha) * self.ewma_complete_ms + alpha * complete_ms
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "name": self.name,
+                "url": self.url,
+                "model": self.model,
+                "inflight": self.inflight,
+                "max_inflight": self.max_inflight,
+                "ewma_ttft_ms": round(self.ewma_ttft_ms, 3) if self.ewma_ttft_ms is not None else None,
+                "ewma_complete_ms": round(self.ewma_complete_ms, 3) if self.ewma_complete_ms is not None else None,
+                "ewma_error": round(self.ewma_error, 4),
+                "score": round(self.score(), 3),
+                "breaker": self.upstream.breaker.state,
+                **self.stats,
+            }
+
+
+_ENDPOINTS: list[Endpoint] | None = None
+_ENDPOINTS_LOCK = threading.Lock()
+
+
+def get_endpoints() -> list[Endpoint]:
+    global _ENDPOINTS
+    with _ENDPOINTS_LOCK:
+        if _ENDPOINTS is None:
+            endpoints = []
+            for name in LLM_ENDPOINTS:
+                provider = _PROVIDERS.get(name)
+                if provider is None:
+                    continue
+                url, api_key, model = provider
+                if name != "deepseek" and not api_key:
+                    continue
+                max_inflight = int(os.getenv(f"LLM_MAX_INFLIGHT_{name.upper()}", "64"))
+                endpoints.append(Endpoint(name, url, api_key, model, max_inflight))
+            if not endpoints:
+                endpoints.append(Endpoint("deepseek", DEEPSEEK_API_URL, DEEPSEEK_API_KEY, DEEPSEEK_MODEL, 64))
+            _ENDPOINTS = endpoints
+        return _ENDPOINTS
+
+
+def rank_endpoints() -> list[Endpoint]:
+    """按 (已满, 熔断中, 得分) 排序；小概率把一个健康的次优端点提到最前，让变慢后又恢复的端点有机会被重新测量。"""
+    endpoints = get_endpoints()
+    ranked = sorted(endpoints, key=lambda e: (e.full(), e.upstream.breaker.rejecting(), e.score()))
+    if len(ranked) > 1 and random.random() < LLM_ROUTER_EXPLORE:
+        healthy = [e for e in ranked[1:] if not e.full() and not e.upstream.breaker.rejecting()]
+        if healthy:
+            pick = random.choice(healthy)
+            ranked.remove(pick)
+            ranked.insert(0, pick)
+    if ranked[0].full():
+        # 全部端点都到了并发上限：不拒绝请求，发往排名第一的端点并计数
+        with ranked[0]._lock:
+            ranked[0].stats["overflow"] += 1
+    return ranked
+
+
+class Route:
+    """一次调用的端点尝试顺序：先按排名各试一次，retry=True 时全部失败后再按首选端点的重试策略退避重来。"""
+
+    def __init__(self, retry: bool = True):
+        self.queue = rank_endpoints()
+        self.retry = retry
+        self.deadline_at = self.queue[0].upstream.start_deadline()
+        self.attempt = 0
+        self.last_exc: BaseException | None = None
+
+    def next(self) -> tuple[Endpoint, float]:
+        """返回 (端点, 发请求前需要等待的秒数)；没有可用端点时抛出最后一次的异常。"""
+        if self.queue:
+            return self.queue.pop(0), 0.0
+        if self.last_exc is None:
+            raise RuntimeError("no_llm_endpoint")
+        if not self.retry:
+            raise self.last_exc
+        best = rank_endpoints()[0]
+        wait_s = best.upstream.retry_delay(self.last_exc, self.attempt, self.deadline_at)
+        if wait_s is None:
+            raise self.last_exc
+        self.attempt += 1
+        return best, wait_s
+
+    def failed(self, endpoint: Endpoint, exc: BaseException) -> None:
+        self.last_exc = exc
+        if self.queue:
+            with endpoint._lock:
+                endpoint.stats["failovers_from"] += 1
+
+    def budget(self, endpoint: Endpoint) -> float:
+        return endpoint.upstream.attempt_budget(self.deadline_at)
+
+
+def get_router_stats() -> dict[str, Any]:
+    return {"endpoints": [endpoint.snapshot() for endpoint in get_endpoints()]}
+
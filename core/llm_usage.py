@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, NamedTuple
+
+# =========================================================
+# 上游 usage 统计：
+# - 前缀缓存：按 角色 / 档位 汇总 DeepSeek 返回的 prompt_cache_hit_tokens / prompt_cache_miss_tokens
+# - 逐次计量：每次上游调用（stage 区分流水线环节）的 token 数与耗时写入定长环形缓冲，
+#   admin 按时间窗口、按 stage / user_id / character / tier 聚合，另保留进程启动以来各 stage 的累计值
+# =========================================================
+
+USAGE_RING_SIZE = int(os.getenv("USAGE_RING_SIZE", "20000"))
+
+_LOCK = threading.Lock()
+_PROMPT_CACHE: dict[tuple[str, str], dict[str, int]] = {}
+
+
+class UsageRecord(NamedTuple):
+    ts: float
+    stage: str
+    user_id: str
+    character: str
+    tier: str
+    prompt_tokens: int
+    completion_tokens: int
+    cache_hit_tokens: int
+    cache_miss_tokens: int
+    latency_ms: float
+    ttft_ms: float | None
+    ok: bool
+
+
+_RING: deque[UsageRecord] = deque(maxlen=max(1, USAGE_RING_SIZE))
+_STAGE_TOTALS: dict[str, dict[str, float]] = {}
+_GROUP_FIELDS = ("stage", "user_id", "character", "tier")
+
+
+def _empty() -> dict[str, int]:
+    return {"turns": 0, "prompt_tokens": 0, "hit_tokens": 0, "miss_tokens": 0}
+
+
+def record_prompt_cache(character: str, tier: str, usage: dict) -> None:
+    hit = int(usage.get("prompt_cache_hit_tokens") or 0)
+    miss = int(usage.get("prompt_cache_miss_tokens") or 0)
+    prompt = int(usage.get("prompt_tokens") or hit + miss)
+    with _LOCK:
+        item = _PROMPT_CACHE.setdefault((character, tier), _empty())
+        item["turns"] += 1
+        item["prompt_tokens"] += prompt
+        item["hit_tokens"] += hit
+        item["miss_tokens"] += miss
+
+
+def _with_rate(item: dict[str, int]) -> dict[str, Any]:
+    total = item["hit_tokens"] + item["miss_tokens"]
+    return {**item, "hit_rate": round(item["hit_tokens"] / total, 4) if total else 0.0}
+
+
+def get_prompt_cache_stats() -> dict[str, Any]:
+    with _LOCK:
+        items = {key: dict(value) for key, value in _PROMPT_CACHE.items()}
+    total = _empty()
+    for item in items.values():
+        for field in total:
+            total[field] += item[field]
+    return {
+        "total": _with_rate(total),
+        "by_character_tier": [
+            {"character": character, "tier": tier, **_with_rate(item)}
+            for (character, tier), item in sorted(items.items())
+        ],
+    }
+
+
+def normalize_usage(usage: dict | None) -> dict[str, int]:
+    """兼容 chat/completions（prompt_tokens / completion_tokens）与 Ark responses（input_tokens / output_tokens）两种格式。"""
+    usage = usage or {}
+    prompt = usage.get("prompt_tokens", usage.get("input_tokens")) or 0
+    completion = usage.get("completion_tokens", usage.get("output_tokens")) or 0
+    hit = usage.get("prompt_cache_hit_tokens")
+    if hit is None:
+        details = usage.get("input_tokens_details") or usage.get("prompt_tokens_details") or {}
+        hit = details.get("cached_tokens") or 0
+    miss = usage.get("prompt_cache_miss_tokens")
+    if miss is None:
+        miss = max(0, int(prompt) - int(hit))
+    return {
+        "prompt_tokens": int(prompt),
+        "completion_tokens": int(completion),
+        "cache_hit_tokens": int(hit),
+        "cache_miss_tokens": int(miss),
+    }
+
+
+def record_usage(
+    stage: str,
+    usage: dict | None,
+    latency_ms: float,
+    *,
+    ttft_ms: float | None = None,
+    ok: bool = True,
+    user_id: str | None = None,
+    character: str | None = None,
+    tier: str | None = None,
+) -> None:
+    tokens = normalize_usage(usage)
+    record = UsageRecord(
+        ts=time.time(),
+        stage=stage,
+        user_id=user_id or "",
+        character=character or "",
+        tier=tier or "",
+        latency_ms=round(latency_ms, 3),
+        ttft_ms=round(ttft_ms, 3) if ttft_ms is not None else None,
+        ok=ok,
+        **tokens,
+    )
+    with _LOCK:
+        _RING.append(record)
+        totals = _STAGE_TOTALS.setdefault(
+            stage,
+            {"calls": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms_total": 0.0},
+        )
+        totals["calls"] += 1
+        totals["errors"] += 0 if ok else 1
+        totals["prompt_tokens"] += record.prompt_tokens
+        totals["completion_tokens"] += record.completion_tokens
+        totals["latency_ms_total"] += record.latency_ms
+
+
+def get_usage_stats() -> dict[str, Any]:
+    """进程启动以来各 stage 的累计用量。"""
+    with _LOCK:
+        stages = {stage: dict(totals) for stage, totals in _STAGE_TOTALS.items()}
+        size = len(_RING)
+    for totals in stages.values():
+        calls = totals["calls"]
+        totals["latency_ms_avg"] = round(totals["latency_ms_total"] / calls, 3) if calls else 0.0
+        totals["latency_ms_total"] = round(totals["latency_ms_total"], 3)
+    return {"stages": stages, "ring_size": size, "ring_capacity": _RING.maxlen}
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct))], 3)
+
+
+def aggregate_usage(window_seconds: float | None = None, group_by: list[str] | None = None) -> list[dict[str, Any]]:
+    """按时间窗口与分组字段聚合环形缓冲中的记录，按 prompt+completion token 数降序。"""
+    fields = [f for f in (group_by or ["stage"]) if f in _GROUP_FIELDS] or ["stage"]
+    since = time.time() - window_seconds if window_seconds else 0.0
+    with _LOCK:
+        records = [r for r in _RING if r.ts >= since]
+    groups: dict[tuple, dict[str, Any]] = {}
+    for r in records:
+        key = tuple(getattr(r, f) for f in fields)
+        item = groups.get(key)
+        if item is None:
+            item = groups[key] = {
+                **dict(zip(fields, key)),
+                "calls": 0,
+                "errors": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cache_hit_tokens": 0,
+                "cache_miss_tokens": 0,
+                "_latency": [],
+                "_ttft": [],
+            }
+        item["calls"] += 1
+        item["errors"] += 0 if r.ok else 1
+        item["prompt_tokens"] += r.prompt_tokens
+        item["completion_tokens"] += r.completion_tokens
+        item["cache_hit_tokens"] += r.cache_hit_tokens
+        item["cache_miss_tokens"] += r.cache_miss_tokens
+        item["_latency"].append(r.latency_ms)
+        if r.ttft_ms is not None:
+            item["_ttft"].append(r.ttft_ms)
+    result = []
+    for item in groups.values():
+        latency = item.pop("_latency")
+        ttft = item.pop("_ttft")
+        item["latency_ms_avg"] = round(sum(latency) / len(latency), 3)
+        item["latency_ms_p50"] = _percentile(latency, 0.5)
+        item["latency_ms_p95"] = _percentile(latency, 0.95)
+        item["ttft_ms_avg"] = round(sum(ttft) / len(ttft), 3) if ttft else None
+        result.append(item)
+    result.sort(key=lambda item: item["prompt_tokens"] + item["completion_tokens"], reverse=True)
+    return result
+
+
+def recent_usage(limit: int = 100) -> list[dict[str, Any]]:
+    with _LOCK:
+        records = list(_RING)[-max(0, limit):] if limit > 0 else []
+    return [r._asdict() for r in reversed(records)]
@@ -1,13 +1,169 @@
 from __future__ import annotations
 
 import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any
 
-_LOCKS: dict[str, asyncio.Lock] = {}
+from core.file_lock import InterProcessLock, lock_path_for
+from data_store import DATA_STORE_LOCK_DIR, DATA_STORE_MULTI_PROCESS
 
+_CONV_LOCK_DIR = os.path.join(DATA_STORE_LOCK_DIR, "conv")
+_POLL_INTERVAL = 0.005
+_POLL_INTERVAL_MAX = 0.05
+# 记录争用统计的 conv_key 数上限（按最近争用时间淘汰）
+_CONTENTION_MAX_KEYS = int(os.getenv("LOCK_CONTENTION_MAX_KEYS", "256"))
 
-def get_lock(conv_key: str) -> asyncio.Lock:
-    lock = _LOCKS.get(conv_key)
-    if lock is None:
-        lock = asyncio.Lock()
-        _LOCKS[conv_key] = lock
-    return lock
+# =========================================================
+# 会话锁注册表：conv_key -> 锁条目，按引用计数（持有者 + 等待者）管理，
+# 最后一个引用释放时立即回收；get_lock 返回的句柄在 acquire 时才取出条目，
+# 因此句柄可以跨越回收长期持有，同一时刻同一 conv_key 只会有一个条目
+# =========================================================
+
+
+class _LockEntry:
+    __slots__ = ("lock", "file_lock", "refs")
+
+    def __init__(self, conv_key: str):
+        self.lock = asyncio.Lock()
+        self.file_lock = (
+            InterProcessLock(lock_path_for(_CONV_LOCK_DIR, conv_key)) if DATA_STORE_MULTI_PROCESS else None
+        )
+        self.refs = 0
+
+
+_LOCKS: dict[str, _LockEntry] = {}
+_CONTENTION: OrderedDict[str, dict[str, Any]] = OrderedDict()
+_STATS = {
+    "acquires": 0,
+    "contended": 0,
+    "wait_ms_total": 0.0,
+    "wait_ms_max": 0.0,
+    "hold_ms_total": 0.0,
+    "hold_ms_max": 0.0,
+    "created": 0,
+    "reclaimed": 0,
+}
+
+
+def _record_acquire(conv_key: str, wait_ms: float, contended: bool) -> None:
+    _STATS["acquires"] += 1
+    _STATS["wait_ms_total"] += wait_ms
+    _STATS["wait_ms_max"] = max(_STATS["wait_ms_max"], wait_ms)
+    if not contended:
+        return
+    _STATS["contended"] += 1
+    item = _CONTENTION.pop(conv_key, None) or {"contended": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+    item["contended"] += 1
+    item["wait_ms_total"] += wait_ms
+    item["wait_ms_max"] = max(item["wait_ms_max"], wait_ms)
+    item["last_at"] = time.time()
+    _CONTENTION[conv_key] = item
+    while len(_CONTENTION) > _CONTENTION_MAX_KEYS:
+        _CONTENTION.popitem(last=False)
+
+
+def _release_ref(conv_key: str, entry: _LockEntry) -> None:
+    entry.refs -= 1
+    if entry.refs <= 0 and _LOCKS.get(conv_key) is entry:
+        del _LOCKS[conv_key]
+        _STATS["reclaimed"] += 1
+
+
+class ConvLock:
+    """同一会话（conv_key）的串行锁句柄：进程内用 asyncio.Lock；
+    多进程模式下再叠加跨进程文件锁，用非阻塞尝试 + 异步退避轮询获取，不阻塞事件循环。"""
+
+    def __init__(self, conv_key: str):
+        self.conv_key = conv_key
+        self._entry: _LockEntry | None = None
+        self._acquired_at = 0.0
+
+    def locked(self) -> bool:
+        entry = _LOCKS.get(self.conv_key)
+        return entry is not None and entry.lock.locked()
+
+    async def acquire(self) -> bool:
+        if self._entry is not None:
+            raise RuntimeError(f"conv lock already held by this handle: {self.conv_key}")
+        entry = _LOCKS.get(self.conv_key)
+        if entry is None:
+            entry = _LockEntry(self.conv_key)
+            _LOCKS[self.conv_key] = entry
+            _STATS["created"] += 1
+        entry.refs += 1
+        contended = entry.lock.locked()
+        start = time.perf_counter()
+        try:
+            await entry.lock.acquire()
+        except BaseException:
+            _release_ref(self.conv_key, entry)
+            raise
+        if entry.file_lock is not None:
+            try:
+                delay = _POLL_INTERVAL
+                while not entry.file_lock.try_acquire():
+                    contended = True
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, _POLL_INTERVAL_MAX)
+            except BaseException:
+                entry.lock.release()
+                _release_ref(self.conv_key, entry)
+                raise
+        self._entry = entry
+        self._acquired_at = time.perf_counter()
+        _record_acquire(self.conv_key, (self._acquired_at - start) * 1000, contended)
+        return True
+
+    def release(self) -> None:
+        entry = self._entry
+        if entry is None:
+            raise RuntimeError(f"conv lock not held by this handle: {self.conv_key}")
+        self._entry = None
+        hold_ms = (time.perf_counter() - self._acquired_at) * 1000
+        _STATS["hold_ms_total"] += hold_ms
+        _STATS["hold_ms_max"] = max(_STATS["hold_ms_max"], hold_ms)
+        if entry.file_lock is not None:
+            entry.file_lock.release()
+        entry.lock.release()
+        _release_ref(self.conv_key, entry)
+
+    async def __aenter__(self) -> "ConvLock":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+def get_lock(conv_key: str) -> ConvLock:
+    return ConvLock(conv_key)
+
+
+def get_lock_stats(top: int = 10) -> dict[str, Any]:
+    """锁注册表的等待/持有耗时与争用最多的 conv_key。注册表只在事件循环上修改，须在事件循环上调用（不要放进线程池）。"""
+    stats = dict(_STATS)
+    live = dict(_LOCKS)
+    contention = list(_CONTENTION.items())
+    acquires = stats["acquires"]
+    stats["wait_ms_avg"] = round(stats["wait_ms_total"] / acquires, 3) if acquires else 0.0
+    stats["hold_ms_avg"] = round(stats["hold_ms_total"] / acquires, 3) if acquires else 0.0
+    for key in ("wait_ms_total", "wait_ms_max", "hold_ms_total", "hold_ms_max"):
+        stats[key] = round(stats[key], 3)
+    stats["active_keys"] = len(live)
+    stats["held"] = sum(1 for entry in live.values() if entry.lock.locked())
+    stats["waiting"] = sum(max(0, entry.refs - 1) for entry in live.values())
+    ranked = sorted(contention, key=lambda item: (item[1]["contended"], item[1]["wait_ms_total"]), reverse=True)
+    stats["top_contended"] = [
+        {
+            "conv_key": conv_key,
+            "contended": item["contended"],
+            "wait_ms_avg": round(item["wait_ms_total"] / item["contended"], 3),
+            "wait_ms_max": round(item["wait_ms_max"], 3),
+            "waiting_now": max(0, live[conv_key].refs - 1) if conv_key in live else 0,
+            "last_at": item["last_at"],
+        }
+        for conv_key, item in ranked[: max(0, top)]
+    ]
+    return stats
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from threading import Lock
+from typing import Any
+
+# 事件循环阻塞监测：定时 sleep，实际醒来时间超出预期的部分即为循环被阻塞的时长
+
+_INTERVAL = 0.05
+_STALL_MS = 50.0
+
+_LOCK = Lock()
+_RECENT: deque[float] = deque(maxlen=1200)
+_STATS = {
+    "samples": 0,
+    "lag_ms_total": 0.0,
+    "lag_ms_max": 0.0,
+    "stalls": 0,
+}
+_TASK: asyncio.Task | None = None
+
+
+async def _monitor(interval: float) -> None:
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (time.perf_counter() - start - interval) * 1000)
+        with _LOCK:
+            _RECENT.append(lag_ms)
+            _STATS["samples"] += 1
+            _STATS["lag_ms_total"] += lag_ms
+            _STATS["lag_ms_max"] = max(_STATS["lag_ms_max"], lag_ms)
+            if lag_ms >= _STALL_MS:
+                _STATS["stalls"] += 1
+
+
+def start_loop_monitor(interval: float = _INTERVAL) -> None:
+    global _TASK
+    if _TASK is not None and not _TASK.done():
+        return
+    _TASK = asyncio.get_running_loop().create_task(_monitor(interval))
+
+
+def stop_loop_monitor() -> None:
+    global _TASK
+    if _TASK is not None:
+        _TASK.cancel()
+        _TASK = None
+
+
+def get_loop_lag_stats() -> dict[str, Any]:
+    with _LOCK:
+        stats = dict(_STATS)
+        recent = sorted(_RECENT)
+    samples = stats["samples"]
+    stats["lag_ms_avg"] = round(stats["lag_ms_total"] / samples, 3) if samples else 0.0
+    stats["lag_ms_p99_recent"] = round(recent[int(len(recent) * 0.99) - 1], 3) if recent else 0.0
+    stats["lag_ms_total"] = round(stats["lag_ms_total"], 3)
+    stats["lag_ms_max"] = round(stats["lag_ms_max"], 3)
+    stats["stall_threshold_ms"] = _STALL_MS
+    return stats
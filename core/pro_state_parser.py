@@ -26,6 +26,18 @@ def split_reply_and_state(text: str) -> tuple[str, dict | None]:
     return reply_text, state_dict
 
 
+def partial_reply_text(text: str) -> str:
+    """中途中断的 Pro 回复：只保留 <REPLY> 内已输出的部分，丢弃不完整的 <STATE>。"""
+    reply_start = text.find("<REPLY>")
+    if reply_start != -1:
+        text = text[reply_start + len("<REPLY>") :]
+    for marker in ("</REPLY>", "<STATE>"):
+        end = text.find(marker)
+        if end != -1:
+            text = text[:end]
+    return text.strip()
+
+
 def apply_treehole_state(user_info: dict, state: dict) -> None:
     profile = user_info.setdefault("treehole_profile", {})
     bond_points = int(profile.get("bond_points", 0))
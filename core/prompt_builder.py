@@ -1,18 +1,26 @@
 from __future__ import annotations
 
+import os
+
+from core.context_budget import CONTEXT_TOKENS_IP, ContextBudget
 from core.schemas import ReplyPlan
 
+USER_TEMPLATE = "历史对话:\n{history_text}\n\n本轮用户输入:\n{user_input}"
 
-def render_history_text(summary: str, history: list[dict], limit_rounds: int = 12) -> str:
-    lines: list[str] = []
-    if summary:
-        lines.append(f"summary: {summary}")
-    recent = history[-(limit_rounds * 2) :]
-    for item in recent:
-        role = item.get("role", "user")
-        content = item.get("content", "")
-        lines.append(f"{role}: {content}")
-    return "\n".join(lines)
+# 提示词布局：
+# legacy（默认）——原布局：system prompt + 控制块 + 整段打包的历史与本轮输入
+# cache（需显式开启）——不随轮次变化的 system prompt / 档位提示在最前，之后是摘要和逐条历史，
+#   每轮都会变的控制块放在最后，前缀保持稳定以命中 DeepSeek 的前缀缓存（计费更低、首 token 更快）；
+#   消息结构与原布局不同，开启前先确认各档位回复质量
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "legacy").strip().lower()
+
+
+def use_cache_layout() -> bool:
+    return PROMPT_LAYOUT == "cache"
+
+
+def summary_message(summary: str) -> dict:
+    return {"role": "system", "content": f"此前对话摘要：{summary}"}
 
 
 def _plan_block(plan: ReplyPlan) -> str:
@@ -29,9 +37,35 @@ def _plan_block(plan: ReplyPlan) -> str:
     )
 
 
-def build_messages(system_prompt: str, plan: ReplyPlan, history_text: str, user_input: str) -> list[dict]:
-    return [
-        {"role": "system", "content": system_prompt},
-        {"role": "system", "content": _plan_block(plan)},
-        {"role": "user", "content": f"历史对话:\n{history_text}\n\n本轮用户输入:\n{user_input}"},
-    ]
+def build_messages(
+    system_prompt: str,
+    plan: ReplyPlan,
+    summary: str,
+    history: list[dict],
+    user_input: str,
+    budget: ContextBudget | None = None,
+    limit_rounds: int | None = None,
+) -> list[dict]:
+    """历史按 token 预算装入：system prompt、控制块和本轮输入先记入，剩余预算从最新一条历史开始装。"""
+    budget = budget or ContextBudget(CONTEXT_TOKENS_IP)
+    control = _plan_block(plan)
+    budget.add("system", system_prompt)
+    budget.add("control", control)
+    if not use_cache_layout():
+        budget.add("input", USER_TEMPLATE.format(history_text="", user_input=user_input))
+        history_text = budget.pack_history(summary, history, limit_rounds)
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": control},
+            {"role": "user", "content": USER_TEMPLATE.format(history_text=history_text, user_input=user_input)},
+        ]
+
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        messages.append(summary_message(summary))
+        budget.add("summary", messages[-1]["content"])
+    budget.add("input", user_input)
+    messages.extend(budget.pack_history_messages(history, limit_rounds))
+    messages.append({"role": "system", "content": control})
+    messages.append({"role": "user", "content": user_input})
+    return messages
@@ -0,0 +1,428 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, TypeVar
+
+import httpx
+import requests
+
+# =========================================================
+# 上游调用韧性层（DeepSeek / Ark / LipVoice 共用）：
+# - 每个上游一个总期限（deadline），单次尝试的超时不超过剩余期限，慢上游不再占住 worker 一分钟
+# - 超时、连接错误、429/5xx 有限次重试，退避为 full jitter（0 ~ min(cap, base*2^n) 随机）
+# - 非流式调用可对冲：本次耗时超过近期 p95 仍未返回时再发一个相同请求，取先成功的
+# - 熔断器：连续失败达到阈值后打开，期间直接抛 CircuitOpenError，由调用方走原有兜底；
+#   冷却结束后放一个探测请求（half_open），成功则关闭
+# 配置：UPSTREAM_<NAME>_DEADLINE / _ATTEMPT_TIMEOUT / _RETRIES / _HEDGE / _BREAKER_FAILURES / _BREAKER_RESET
+# =========================================================
+
+T = TypeVar("T")
+
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.2"))
+UPSTREAM_BACKOFF_CAP = float(os.getenv("UPSTREAM_BACKOFF_CAP", "2.0"))
+UPSTREAM_HEDGE_MIN_MS = float(os.getenv("UPSTREAM_HEDGE_MIN_MS", "300"))
+UPSTREAM_HEDGE_MIN_SAMPLES = int(os.getenv("UPSTREAM_HEDGE_MIN_SAMPLES", "20"))
+UPSTREAM_HEDGE_THREADS = int(os.getenv("UPSTREAM_HEDGE_THREADS", "16"))
+
+_DEFAULTS: dict[str, dict[str, float]] = {
+    # name: deadline / attempt_timeout（秒）、retries、hedge（0/1）、breaker_failures、breaker_reset（秒）
+    "deepseek": {"deadline": 30, "attempt_timeout": 20, "retries": 2, "hedge": 1, "breaker_failures": 5, "breaker_reset": 30},
+    "ark": {"deadline": 15, "attempt_timeout": 10, "retries": 1, "hedge": 1, "breaker_failures": 5, "breaker_reset": 30},
+    "lipvoice": {"deadline": 20, "attempt_timeout": 15, "retries": 1, "hedge": 0, "breaker_failures": 5, "breaker_reset": 30},
+}
+
+_CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, requests.exceptions.ConnectionError)
+_TRANSIENT_ERRORS = (
+    httpx.TransportError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    asyncio.TimeoutError,
+    TimeoutError,
+)
+
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, upstream: str):
+        super().__init__(f"circuit_open: {upstream}")
+        self.upstream = upstream
+
+
+class _RetryableResponse(Exception):
+    """上游返回了 429/5xx：可以重试；重试用尽时把原响应交还给调用方按原逻辑处理。"""
+
+    def __init__(self, response: Any):
+        super().__init__(f"upstream_status_{response.status_code}")
+        self.response = response
+
+
+def _status_of(exc: BaseException) -> int | None:
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _retryable_status(status: int | None) -> bool:
+    return status is not None and (status == 429 or status >= 500)
+
+
+def _is_transient(exc: BaseException, idempotent: bool) -> bool:
+    if isinstance(exc, _RetryableResponse):
+        return idempotent
+    if isinstance(exc, (httpx.HTTPStatusError, requests.exceptions.HTTPError)):
+        return idempotent and _retryable_status(_status_of(exc))
+    if not idempotent:
+        # 非幂等请求（如创建 TTS 任务）只在请求没发出去（连接阶段失败）时重试
+        return isinstance(exc, _CONNECT_ERRORS)
+    return isinstance(exc, _TRANSIENT_ERRORS)
+
+
+def _counts_as_failure(exc: BaseException) -> bool:
+    """4xx 说明请求本身有问题，上游是健康的，不计入熔断。"""
+    status = _status_of(exc)
+    return status is None or _retryable_status(status)
+
+
+def _check_response(result: Any) -> Any:
+    if _retryable_status(getattr(result, "status_code", None)):
+        raise _RetryableResponse(result)
+    return result
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if self.state == "open":
+                if now - self.opened_at < self.reset_seconds:
+                    return False
+                self.state = "half_open"
+                self.probe_at = now
+                return True
+            # half_open：同一时间只放一个探测；探测迟迟没有结果（被取消等）时再放一个
+            if now - self.probe_at >= self.reset_seconds:
+                self.probe_at = now
+                return True
+            return False
+
+    def rejecting(self) -> bool:
+        """当前是否还在熔断冷却期内（不改变状态，供路由排序用）。"""
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.opens += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            retry_in = 0.0
+            if self.state == "open":
+                retry_in = max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "opens": self.opens,
+                "retry_in_s": round(retry_in, 3),
+            }
+
+
+class Upstream:
+    def __init__(self, name: str):
+        conf = dict(_DEFAULTS.get(name, _DEFAULTS["deepseek"]))
+        for field in conf:
+            value = os.getenv(f"UPSTREAM_{name.upper()}_{field.upper()}")
+            if value is not None:
+                conf[field] = float(value)
+        self.name = name
+        self.deadline = float(conf["deadline"])
+        self.attempt_timeout = float(conf["attempt_timeout"])
+        self.retries = int(conf["retries"])
+        self.hedge = bool(int(conf["hedge"]))
+        self.breaker = CircuitBreaker(int(conf["breaker_failures"]), float(conf["breaker_reset"]))
+        self._latencies: deque[float] = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self.stats = {
+            "calls": 0,
+            "attempts": 0,
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "short_circuited": 0,
+            "deadline_exceeded": 0,
+        }
+
+    def _bump(self, field: str) -> None:
+        with self._lock:
+            self.stats[field] += 1
+
+    def p95_ms(self) -> float | None:
+        with self._lock:
+            if len(self._latencies) < UPSTREAM_HEDGE_MIN_SAMPLES:
+                return None
+            values = sorted(self._latencies)
+        return values[min(len(values) - 1, int(len(values) * 0.95))]
+
+    def _hedge_delay(self, hedge: bool | None) -> float | None:
+        if not (self.hedge if hedge is None else hedge):
+            return None
+        p95 = self.p95_ms()
+        if p95 is None:
+            return None
+        return max(p95, UPSTREAM_HEDGE_MIN_MS) / 1000
+
+    def before_attempt(self) -> None:
+        if not self.breaker.allow():
+            self._bump("short_circuited")
+            raise CircuitOpenError(self.name)
+        self._bump("attempts")
+
+    def record_success(self, latency_ms: float | None = None) -> None:
+        self.breaker.record_success()
+        with self._lock:
+            self.stats["successes"] += 1
+            if latency_ms is not None:
+                self._latencies.append(latency_ms)
+
+    def record_failure(self, exc: BaseException) -> None:
+        if _counts_as_failure(exc):
+            self.breaker.record_failure()
+            self._bump("failures")
+
+    def start_deadline(self, deadline: float | None = None) -> float:
+        self._bump("calls")
+        return time.monotonic() + (deadline or self.deadline)
+
+    def attempt_budget(self, deadline_at: float, cap: float | None = None) -> float:
+        """本次尝试可用的超时：不超过单次上限，也不超过剩余总期限。"""
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            self._bump("deadline_exceeded")
+            raise TimeoutError(f"{self.name}_deadline_exceeded")
+        return min(cap or self.attempt_timeout, remaining)
+
+    def retry_delay(self, exc: BaseException, attempt: int, deadline_at: float, idempotent: bool = True) -> float | None:
+        """可重试时返回退避秒数（full jitter），否则返回 None。"""
+        if attempt >= self.retries or isinstance(exc, CircuitOpenError) or not _is_transient(exc, idempotent):
+            return None
+        delay = random.uniform(0, min(UPSTREAM_BACKOFF_CAP, UPSTREAM_BACKOFF_BASE * (2**attempt)))
+        if time.monotonic() + delay >= deadline_at:
+            return None
+        self._bump("retries")
+        return delay
+
+    # ---------- async ----------
+
+    async def _aattempt(self, fn: Callable[[float], Awaitable[T]], timeout: float) -> T:
+        return _check_response(await asyncio.wait_for(fn(timeout), timeout))
+
+    async def _ahedged(self, fn: Callable[[float], Awaitable[T]], timeout: float, delay: float) -> T:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first = loop.create_task(self._aattempt(fn, timeout))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                self._bump("hedges")
+                pending.add(loop.create_task(self._aattempt(fn, max(0.001, timeout - delay))))
+            last_exc: BaseException | None = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._bump("hedge_wins")
+                        return task.result()
+                    last_exc = task.exception()
+                if not pending:
+                    raise last_exc  # type: ignore[misc]
+                remaining = timeout - (loop.time() - start)
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, remaining), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+        finally:
+            # 输的那个请求直接取消、不等待（同 stream_cancel.guard：请求任务被取消时不能把取消再传下去）
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_drain)
+
+    async def acall(
+        self,
+        fn: Callable[[float], Awaitable[T]],
+        *,
+        hedge: bool | None = None,
+        idempotent: bool = True,
+        timeout: float | None = None,
+        deadline: float | None = None,
+    ) -> T:
+        """fn(timeout) 发起一次请求；按本上游的期限 / 重试 / 对冲 / 熔断策略执行。
+        timeout / deadline 覆盖本次调用的单次超时与总期限（如大文件上传）。"""
+        deadline_at = self.start_deadline(deadline)
+        attempt = 0
+        while True:
+            self.before_attempt()
+            budget = self.attempt_budget(deadline_at, timeout)
+            started = time.perf_counter()
+            delay = self._hedge_delay(hedge) if idempotent else None
+            try:
+                if delay is not None and delay < budget:
+                    result = await self._ahedged(fn, budget, delay)
+                else:
+                    result = await self._aattempt(fn, budget)
+            except Exception as exc:
+                self.record_failure(exc)
+                wait_s = self.retry_delay(exc, attempt, deadline_at, idempotent)
+                if wait_s is None:
+                    if isinstance(exc, _RetryableResponse):
+                        return exc.response
+                    if isinstance(exc, asyncio.TimeoutError) and not isinstance(exc, TimeoutError):
+                        # Python 3.10 的 asyncio.TimeoutError 不是内置 TimeoutError 的子类，统一成后者，
+                        # 调用方与同步版本一样只需捕获 TimeoutError
+                        raise TimeoutError(f"{self.name}_attempt_timeout") from exc
+                    raise
+                await asyncio.sleep(wait_s)
+                attempt += 1
+                continue
+            self.record_success((time.perf_counter() - started) * 1000)
+            return result
+
+    # ---------- sync ----------
+
+    def _attempt(self, fn: Callable[[float], T], timeout: float) -> T:
+        return _check_response(fn(timeout))
+
+    def _hedged(self, fn: Callable[[float], T], timeout: float, delay: float) -> T:
+        pool = _hedge_pool()
+        start = time.monotonic()
+        first = pool.submit(self._attempt, fn, timeout)
+        futures: set[Future] = {first}
+        done, futures = wait(futures, timeout=delay)
+        if not done:
+            self._bump("hedges")
+            futures.add(pool.submit(self._attempt, fn, max(0.001, timeout - delay)))
+        last_exc: BaseException | None = None
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self._bump("hedge_wins")
+                    return future.result()
+                last_exc = future.exception()
+            if not futures:
+                raise last_exc  # type: ignore[misc]
+            remaining = timeout - (time.monotonic() - start)
+            done, futures = wait(futures, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+            if not done:
+                # 线程里的请求没法中断，交给它自己的超时结束
+                raise TimeoutError(f"{self.name}_attempt_timeout")
+
+    def call(
+        self,
+        fn: Callable[[float], T],
+        *,
+        hedge: bool | None = None,
+        idempotent: bool = True,
+        timeout: float | None = None,
+        deadline: float | None = None,
+    ) -> T:
+        """acall 的同步版本（requests / httpx.Client）；fn 需自行把 timeout 传给 HTTP 客户端。"""
+        deadline_at = self.start_deadline(deadline)
+        attempt = 0
+        while True:
+            self.before_attempt()
+            budget = self.attempt_budget(deadline_at, timeout)
+            started = time.perf_counter()
+            delay = self._hedge_delay(hedge) if idempotent else None
+            try:
+                if delay is not None and delay < budget:
+                    result = self._hedged(fn, budget, delay)
+                else:
+                    result = self._attempt(fn, budget)
+            except Exception as exc:
+                self.record_failure(exc)
+                wait_s = self.retry_delay(exc, attempt, deadline_at, idempotent)
+                if wait_s is None:
+                    if isinstance(exc, _RetryableResponse):
+                        return exc.response
+                    raise
+                time.sleep(wait_s)
+                attempt += 1
+                continue
+            self.record_success((time.perf_counter() - started) * 1000)
+            return result
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        p95 = self.p95_ms()
+        return {
+            **stats,
+            "breaker": self.breaker.snapshot(),
+            "p95_ms": round(p95, 3) if p95 is not None else None,
+            "deadline_s": self.deadline,
+            "attempt_timeout_s": self.attempt_timeout,
+            "retries_max": self.retries,
+            "hedge": self.hedge,
+        }
+
+
+def _drain(task: asyncio.Task) -> None:
+    if not task.cancelled():
+        task.exception()
+
+
+_UPSTREAMS: dict[str, Upstream] = {}
+_UPSTREAMS_LOCK = threading.Lock()
+_HEDGE_POOL: ThreadPoolExecutor | None = None
+
+
+def _hedge_pool() -> ThreadPoolExecutor:
+    global _HEDGE_POOL
+    with _UPSTREAMS_LOCK:
+        if _HEDGE_POOL is None:
+            _HEDGE_POOL = ThreadPoolExecutor(max_workers=UPSTREAM_HEDGE_THREADS, thread_name_prefix="upstream-hedge")
+        return _HEDGE_POOL
+
+
+def get_upstream(name: str) -> Upstream:
+    with _UPSTREAMS_LOCK:
+        upstream = _UPSTREAMS.get(name)
+        if upstream is None:
+            upstream = _UPSTREAMS[name] = Upstream(name)
+        return upstream
+
+
+def get_upstream_stats() -> dict[str, Any]:
+    for name in _DEFAULTS:
+        get_upstream(name)
+    with _UPSTREAMS_LOCK:
+        upstreams = list(_UPSTREAMS.values())
+    return {upstream.name: upstream.snapshot() for upstream in upstreams}
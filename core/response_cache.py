@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# =========================================================
+# 确定性调用的响应缓存：temperature=0 的分类调用（情绪分析、关系标注）输入相同时结果基本相同，
+# 重试、重复提交、反复的“你好”不必再等 1~2 秒的上游。
+# key = sha256(model + messages + 参数)，值为上游返回的原始文本（解析成功后才写入）；
+# 内存 LRU（条数上限 + TTL），RESPONSE_CACHE_PATH 非空时另写一份 SQLite，进程重启后仍可命中
+# =========================================================
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2048"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "").strip()
+# 磁盘缓存的 SQLite 读写走自己的线程池，不占用户数据存储的线程
+RESPONSE_CACHE_IO_WORKERS = int(os.getenv("RESPONSE_CACHE_IO_WORKERS", "2"))
+
+_io_executor = ThreadPoolExecutor(max_workers=max(1, RESPONSE_CACHE_IO_WORKERS), thread_name_prefix="response-cache-io")
+
+
+async def _run_disk_io(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(fn, *args))
+
+
+def cache_key(model: str, messages: list[dict], **params: Any) -> str:
+    raw = json.dumps({"model": model, "messages": messages, "params": params}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _DiskStore:
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache "
+            "(name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL, "
+            "PRIMARY KEY (name, key))"
+        )
+        self._lock = threading.Lock()
+
+    def get(self, name: str, key: str) -> tuple[str, float] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE name = ? AND key = ?", (name, key)
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put(self, name: str, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (name, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (name, key, value, expires_at),
+            )
+
+    def purge(self) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),)).rowcount
+
+
+_DISK: _DiskStore | None = None
+_DISK_LOCK = threading.Lock()
+
+
+def _disk() -> _DiskStore | None:
+    global _DISK
+    if not RESPONSE_CACHE_PATH:
+        return None
+    with _DISK_LOCK:
+        if _DISK is None:
+            _DISK = _DiskStore(RESPONSE_CACHE_PATH)
+            purged = _DISK.purge()
+            if purged:
+                logger.info("response cache purged %s expired rows", purged)
+        return _DISK
+
+
+class ResponseCache:
+    def __init__(self, name: str, ttl: float = RESPONSE_CACHE_TTL, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._items: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "puts": 0, "evictions": 0, "expired": 0}
+
+    def _memory_get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[1] > now:
+                    self._items.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return item[0]
+                del self._items[key]
+                self.stats["expired"] += 1
+        return None
+
+    def _memory_put(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def _disk_get(self, key: str) -> str | None:
+        disk = _disk()
+        row = disk.get(self.name, key) if disk is not None else None
+        if row is not None and row[1] > time.time():
+            self._memory_put(key, row[0], row[1])
+            with self._lock:
+                self.stats["disk_hits"] += 1
+            return row[0]
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def _disk_put(self, key: str, value: str, expires_at: float) -> None:
+        disk = _disk()
+        if disk is not None:
+            try:
+                disk.put(self.name, key, value, expires_at)
+            except sqlite3.Error:
+                logger.exception("response cache disk write failed")
+
+    def get(self, key: str) -> str | None:
+        if not RESPONSE_CACHE_ENABLED:
+            return None
+        value = self._memory_get(key)
+        return value if value is not None else self._disk_get(key)
+
+    def put(self, key: str, value: str) -> None:
+        if not RESPONSE_CACHE_ENABLED:
+            return
+        expires_at = time.time() + self.ttl
+        self._memory_put(key, value, expires_at)
+        with self._lock:
+            self.stats["puts"] += 1
+        self._disk_put(key, value, expires_at)
+
+    async def aget(self, key: str) -> str | None:
+        """内存命中直接返回；未命中且开启了磁盘缓存时，SQLite 查询放到磁盘缓存线程池里。"""
+        if not RESPONSE_CACHE_ENABLED:
+            return None
+        value = self._memory_get(key)
+        if value is not None:
+            return value
+        if not RESPONSE_CACHE_PATH:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        return await _run_disk_io(self._disk_get, key)
+
+    async def aput(self, key: str, value: str) -> None:
+        if not RESPONSE_CACHE_ENABLED:
+            return
+        expires_at = time.time() + self.ttl
+        self._memory_put(key, value, expires_at)
+        with self._lock:
+            self.stats["puts"] += 1
+        if RESPONSE_CACHE_PATH:
+            await _run_disk_io(self._disk_put, key, value, expires_at)
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self._items)
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        stats["ttl"] = self.ttl
+        stats["max_entries"] = self.max_entries
+        return stats
+
+
+_CACHES: dict[str, ResponseCache] = {}
+
+
+def get_response_cache(name: str) -> ResponseCache:
+    cache = _CACHES.get(name)
+    if cache is None:
+        cache = _CACHES.setdefault(name, ResponseCache(name))
+    return cache
+
+
+def get_response_cache_stats() -> dict[str, Any]:
+    return {
+        "enabled": RESPONSE_CACHE_ENABLED,
+        "persistent": bool(RESPONSE_CACHE_PATH),
+        "caches": {name: cache.snapshot() for name, cache in _CACHES.items()},
+    }
@@ -34,10 +34,12 @@ class TurnRecord(BaseModel):
     analysis: EmotionAnalysis
     plan: ReplyPlan
     error: str | None = None
+    interrupted: bool = False
 
 
 class ConversationState(BaseModel):
     conv_key: str
     round_seq: int = 0
     summary: str = ""
+    summary_round: int = 0
     turns: list[TurnRecord] = Field(default_factory=list)
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, TypeVar
+
+# =========================================================
+# 单飞（single-flight）合并：同一指纹的上游调用还在进行时，后到的相同调用不再另发请求，
+# 而是等待同一个结果（成功或异常都共享）。用于 Pro 页面同一 round_id 重复触发 /api/emotion、
+# 连点发送等场景；完成后立即移除，之后的重复请求交给响应缓存（core.response_cache）。
+# 同步调用（线程）与 async 调用各自合并，互不等待
+# =========================================================
+
+T = TypeVar("T")
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[str, _Call] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as exc:
+                call.error = exc
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+        else:
+            call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """上游调用放在独立任务里，各调用方 shield 等待：某个调用方被取消不影响其他等待者。"""
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t, key=key: self._done(key, t))
+            with self._lock:
+                self.stats["leaders"] += 1
+        else:
+            with self._lock:
+                self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["inflight"] = len(self._calls) + len(self._tasks)
+        return stats
+
+
+_FLIGHTS: dict[str, SingleFlight] = {}
+
+
+def get_single_flight(name: str) -> SingleFlight:
+    flight = _FLIGHTS.get(name)
+    if flight is None:
+        flight = _FLIGHTS.setdefault(name, SingleFlight(name))
+    return flight
+
+
+def get_single_flight_stats() -> dict[str, Any]:
+    return {name: flight.snapshot() for name, flight in _FLIGHTS.items()}
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, AsyncIterable, AsyncIterator
+
+from fastapi import Request
+
+# =========================================================
+# 客户端断开检测：与上游并行监听 ASGI receive 的 http.disconnect，
+# 客户端关闭页面/中止 fetch 时立即取消正在等待的上游读取并关闭上游生成器（即关闭到 DeepSeek 的流式连接），
+# 不再为没人读的回复继续拉取 token
+# =========================================================
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+_DETACHED: set[asyncio.Task] = set()
+_STATS = {
+    "completed_streams": 0,
+    "completed_chars": 0,
+    "cancelled_streams": 0,
+    "cancelled_before_first_token": 0,
+    "partial_chars": 0,
+    "tokens_saved_est": 0,
+}
+
+
+def spawn_detached(coro) -> asyncio.Task:
+    """在独立任务中完成收尾（如保存中断的轮次），不受当前请求被取消的影响。"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _DETACHED.add(task)
+    task.add_done_callback(_DETACHED.discard)
+    return task
+
+
+class DisconnectWatcher:
+    def __init__(self, request: Request):
+        self._request = request
+        self._task: asyncio.Task | None = None
+
+    async def _watch(self) -> None:
+        while True:
+            message = await self._request.receive()
+            if message.get("type") == "http.disconnect":
+                return
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def guard(self, deltas: AsyncIterable[str]) -> AsyncIterator[str]:
+        """转发上游增量；客户端断开时取消上游并抛出 ClientDisconnected。"""
+        self.start()
+        iterator = deltas.__aiter__()
+        pending: asyncio.Future | None = None
+        exhausted = False
+        try:
+            while True:
+                pending = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({pending, self._task}, return_when=asyncio.FIRST_COMPLETED)
+                if pending not in done:
+                    raise ClientDisconnected()
+                step, pending = pending, None
+                try:
+                    delta = step.result()
+                except StopAsyncIteration:
+                    exhausted = True
+                    return
+                yield delta
+        finally:
+            # 提前结束时上游的关闭放到独立任务里完成：请求任务可能正被 Starlette 反复取消，
+            # 在这里 await 会把取消传给上游，打断 httpx 关闭连接，连接会一直挂到进程退出
+            if pending is not None and not pending.done():
+                pending.cancel()
+                _DETACHED.add(pending)
+                pending.add_done_callback(_DETACHED.discard)
+            elif not exhausted:
+                aclose = getattr(iterator, "aclose", None)
+                if aclose is not None:
+                    spawn_detached(aclose())
+
+
+def record_completed(reply_chars: int) -> None:
+    _STATS["completed_streams"] += 1
+    _STATS["completed_chars"] += reply_chars
+
+
+def record_cancelled(delivered_chars: int) -> None:
+    """记录一次中断的流；省下的 token 按已完成回复的平均长度减去已输出长度估算（中文约 1 字 1 token）。"""
+    _STATS["cancelled_streams"] += 1
+    _STATS["partial_chars"] += delivered_chars
+    if delivered_chars == 0:
+        _STATS["cancelled_before_first_token"] += 1
+    completed = _STATS["completed_streams"]
+    if completed:
+        avg_chars = _STATS["completed_chars"] / completed
+        _STATS["tokens_saved_est"] += max(0, round(avg_chars - delivered_chars))
+
+
+def get_stream_cancel_stats() -> dict[str, Any]:
+    stats = dict(_STATS)
+    total = stats["completed_streams"] + stats["cancelled_streams"]
+    stats["cancel_rate"] = round(stats["cancelled_streams"] / total, 4) if total else 0.0
+    return stats
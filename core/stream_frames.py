@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from typing import Any, AsyncIterable, AsyncIterator
+
+from core.stream_cancel import _DETACHED, spawn_detached
+
+# =========================================================
+# 输出帧合并：上游每个 delta 往往只有一两个汉字，逐个写出会变成几百次小 chunk 写入和前端重绘。
+# 首个 delta 立即发出（不影响首字时间），之后的 delta 攒到 STREAM_FRAME_MS 毫秒
+# 或 STREAM_FRAME_BYTES 字节（先到为准）合成一帧再写出；上游停顿时到点就发，不会卡住半句话。
+# STREAM_FRAME_MS=0 关闭合并，逐个转发
+# =========================================================
+
+STREAM_FRAME_MS = max(0.0, float(os.getenv("STREAM_FRAME_MS", "40")))
+STREAM_FRAME_BYTES = max(1, int(os.getenv("STREAM_FRAME_BYTES", "256")))
+
+_STATS = {
+    "streams": 0,
+    "deltas": 0,
+    "frames": 0,
+    "bytes": 0,
+    "size_flushes": 0,
+    "max_frame_bytes": 0,
+}
+
+
+def _record_frame(frame: str, deltas: int) -> None:
+    size = len(frame.encode("utf-8"))
+    _STATS["frames"] += 1
+    _STATS["deltas"] += deltas
+    _STATS["bytes"] += size
+    _STATS["max_frame_bytes"] = max(_STATS["max_frame_bytes"], size)
+
+
+async def coalesced(
+    deltas: AsyncIterable[str],
+    window: float = STREAM_FRAME_MS / 1000,
+    max_bytes: int = STREAM_FRAME_BYTES,
+) -> AsyncIterator[str]:
+    """把上游增量合并成帧；等待上游时用独立任务，窗口到点可以先把已攒的发出去而不打断上游读取。"""
+    _STATS["streams"] += 1
+    iterator = deltas.__aiter__()
+    loop = asyncio.get_running_loop()
+    pending: asyncio.Future | None = None
+    exhausted = False
+    first = True
+    buffer: list[str] = []
+    size = 0
+    flush_at = 0.0
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                done, _ = await asyncio.wait({pending}, timeout=max(0.0, flush_at - loop.time()))
+                if not done:
+                    frame = "".join(buffer)
+                    _record_frame(frame, len(buffer))
+                    buffer, size = [], 0
+                    yield frame
+                    continue
+            else:
+                await asyncio.wait({pending})
+            step, pending = pending, None
+            try:
+                delta = step.result()
+            except StopAsyncIteration:
+                exhausted = True
+                break
+            if not delta:
+                continue
+            if first or window <= 0:
+                # 首个 delta 不等窗口，保证首字时间
+                first = False
+                _record_frame(delta, 1)
+                yield delta
+                continue
+            if not buffer:
+                flush_at = loop.time() + window
+            buffer.append(delta)
+            size += len(delta.encode("utf-8"))
+            if size >= max_bytes:
+                _STATS["size_flushes"] += 1
+                frame = "".join(buffer)
+                _record_frame(frame, len(buffer))
+                buffer, size = [], 0
+                yield frame
+        if buffer:
+            frame = "".join(buffer)
+            _record_frame(frame, len(buffer))
+            yield frame
+    finally:
+        # 同 stream_cancel.guard：提前结束时不在这里 await 上游，取消/关闭放到后台完成
+        if pending is not None and not pending.done():
+            pending.cancel()
+            _DETACHED.add(pending)
+            pending.add_done_callback(_DETACHED.discard)
+        elif not exhausted:
+            aclose = getattr(iterator, "aclose", None)
+            if aclose is not None:
+                spawn_detached(aclose())
+
+
+def get_stream_frame_stats() -> dict[str, Any]:
+    stats = dict(_STATS)
+    frames = stats["frames"]
+    stats["deltas_per_frame"] = round(stats["deltas"] / frames, 3) if frames else 0.0
+    stats["bytes_per_frame"] = round(stats["bytes"] / frames, 3) if frames else 0.0
+    stats["frames_per_stream"] = round(frames / stats["streams"], 3) if stats["streams"] else 0.0
+    stats["frame_ms"] = STREAM_FRAME_MS
+    stats["frame_bytes"] = STREAM_FRAME_BYTES
+    return stats
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Iterator
+
+# =========================================================
+# 流式输出节奏（打字效果）：在 async 生成器里用 asyncio.sleep 控制两段输出的最小间隔，
+# 不占线程、不阻塞事件循环；上游本身够慢时不额外等待
+# 间隔按 角色 > IP/树洞档位 的优先级取值，单位毫秒：
+#   STREAM_PACE_MS_IP（虚拟 IP，默认 10）/ STREAM_PACE_MS_PLUS / STREAM_PACE_MS_PRO（默认 0，不限速）
+#   STREAM_PACE_MS_NOTICE：提示语、测试回复等固定文本逐字输出的间隔（默认 10）
+#   STREAM_PACE_MS_CHARACTERS：按角色覆盖，如 "linyu:20,qiming:15"
+# =========================================================
+
+
+def _env_ms(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, default)))
+    except (TypeError, ValueError):
+        return default
+
+
+def _parse_character_ms(raw: str) -> dict[str, float]:
+    result: dict[str, float] = {}
+    for item in raw.split(","):
+        name, sep, value = item.partition(":")
+        if not sep or not name.strip():
+            continue
+        try:
+            result[name.strip()] = max(0.0, float(value))
+        except ValueError:
+            continue
+    return result
+
+
+STREAM_PACE_MS_IP = _env_ms("STREAM_PACE_MS_IP", 10)
+STREAM_PACE_MS_TIERS = {
+    "plus": _env_ms("STREAM_PACE_MS_PLUS", 0),
+    "pro": _env_ms("STREAM_PACE_MS_PRO", 0),
+}
+STREAM_PACE_MS_NOTICE = _env_ms("STREAM_PACE_MS_NOTICE", 10)
+STREAM_PACE_MS_CHARACTERS = _parse_character_ms(os.getenv("STREAM_PACE_MS_CHARACTERS", ""))
+
+_STATS = {
+    "streams": 0,
+    "active": 0,
+    "max_active": 0,
+    "pauses": 0,
+    "pause_ms_total": 0.0,
+}
+
+
+def pace_for(tier: str | None, character_id: str | None = None) -> float:
+    """返回该档位/角色两段输出之间的最小间隔（秒）。"""
+    if character_id:
+        ms = STREAM_PACE_MS_CHARACTERS.get(character_id, STREAM_PACE_MS_IP)
+    else:
+        ms = STREAM_PACE_MS_TIERS.get((tier or "plus").lower(), STREAM_PACE_MS_TIERS["plus"])
+    return ms / 1000
+
+
+def notice_pace() -> float:
+    return STREAM_PACE_MS_NOTICE / 1000
+
+
+async def paced(deltas: AsyncIterable[str], interval: float) -> AsyncIterator[str]:
+    """按最小间隔转发上游增量；关闭时一并关闭上游生成器。"""
+    _STATS["streams"] += 1
+    _STATS["active"] += 1
+    _STATS["max_active"] = max(_STATS["max_active"], _STATS["active"])
+    loop = asyncio.get_running_loop()
+    next_at = 0.0
+    try:
+        async for delta in deltas:
+            if interval > 0:
+                wait = next_at - loop.time()
+                if wait > 0:
+                    _STATS["pauses"] += 1
+                    _STATS["pause_ms_total"] += wait * 1000
+                    await asyncio.sleep(wait)
+            yield delta
+            next_at = loop.time() + interval
+    finally:
+        _STATS["active"] -= 1
+        aclose = getattr(deltas, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def paced_sync(deltas: Iterable[str], interval: float) -> Iterator[str]:
+    """paced 的同步版本，给在线程池里迭代的同步生成器（chat_core.stream_chat_with_deepseek）用：
+    同样按截止时间只补足差额，上游够慢时不等待；停顿占用的是工作线程，不阻塞事件循环。"""
+    next_at = 0.0
+    for delta in deltas:
+        if interval > 0:
+            wait = next_at - time.monotonic()
+            if wait > 0:
+                _STATS["pauses"] += 1
+                _STATS["pause_ms_total"] += wait * 1000
+                time.sleep(wait)
+        yield delta
+        next_at = time.monotonic() + interval
+
+
+async def _chars(text: str) -> AsyncIterator[str]:
+    for ch in text:
+        yield ch
+
+
+def paced_text(text: str, interval: float) -> AsyncIterator[str]:
+    """固定文本逐字输出。"""
+    return paced(_chars(text), interval)
+
+
+def get_pacing_stats() -> dict[str, Any]:
+    stats = dict(_STATS)
+    stats["pause_ms_total"] = round(stats["pause_ms_total"], 3)
+    stats["ip_ms"] = STREAM_PACE_MS_IP
+    stats["tier_ms"] = dict(STREAM_PACE_MS_TIERS)
+    stats["notice_ms"] = STREAM_PACE_MS_NOTICE
+    stats["character_ms"] = dict(STREAM_PACE_MS_CHARACTERS)
+    return stats
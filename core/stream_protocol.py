@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import json
+from typing import Any, AsyncIterable, AsyncIterator
+
+from fastapi.responses import StreamingResponse
+
+# =========================================================
+# /chat_stream 分帧协议（按 Accept 协商，默认仍是纯文本）：
+#   Accept: text/event-stream      -> SSE，每个事件 "event: <type>\ndata: <json>\n\n"
+#   Accept: application/x-ndjson   -> NDJSON，每行 {"type": <type>, ...}
+# 事件类型：analysis（情绪分析）、plan（ReplyPlan）、delta（{"text"}，内容与纯文本模式一致）、
+# state（Pro 的 <STATE> 解析结果）、error（{"msg","text"}）、done（round_id、最终回复、耗时与用量）
+# =========================================================
+
+PROTOCOL_TEXT = "text"
+PROTOCOL_SSE = "sse"
+PROTOCOL_NDJSON = "ndjson"
+
+_MEDIA_TYPES = {
+    PROTOCOL_TEXT: "text/plain",
+    PROTOCOL_SSE: "text/event-stream",
+    PROTOCOL_NDJSON: "application/x-ndjson",
+}
+_ACCEPT = {
+    "text/event-stream": PROTOCOL_SSE,
+    "application/x-ndjson": PROTOCOL_NDJSON,
+    "application/ndjson": PROTOCOL_NDJSON,
+    "application/jsonl": PROTOCOL_NDJSON,
+}
+
+_STATS = {PROTOCOL_TEXT: 0, PROTOCOL_SSE: 0, PROTOCOL_NDJSON: 0, "events": 0}
+
+
+def negotiate(accept: str | None) -> str:
+    """按 Accept 中出现的顺序取第一个支持的分帧类型（忽略 q 值）；都没有时为纯文本。"""
+    for item in (accept or "").split(","):
+        protocol = _ACCEPT.get(item.split(";", 1)[0].strip().lower())
+        if protocol is not None:
+            return protocol
+    return PROTOCOL_TEXT
+
+
+def encode_event(protocol: str, event: str, data: dict[str, Any]) -> str:
+    _STATS["events"] += 1
+    if protocol == PROTOCOL_SSE:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return json.dumps({"type": event, **data}, ensure_ascii=False) + "\n"
+
+
+async def framed_text(deltas: AsyncIterable[str], protocol: str, **done: Any) -> AsyncIterator[str]:
+    """提示语等固定文本：纯文本模式原样输出，分帧模式包成 delta 事件并以 done 结尾。"""
+    if protocol == PROTOCOL_TEXT:
+        async for delta in deltas:
+            yield delta
+        return
+    async for delta in deltas:
+        yield encode_event(protocol, "delta", {"text": delta})
+    yield encode_event(protocol, "done", done)
+
+
+def stream_response(body: AsyncIterable[str], protocol: str) -> StreamingResponse:
+    _STATS[protocol] += 1
+    headers = None
+    if protocol == PROTOCOL_SSE:
+        # 关掉反向代理缓冲，事件到了就转发
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(body, media_type=_MEDIA_TYPES[protocol], headers=headers)
+
+
+def get_stream_protocol_stats() -> dict[str, Any]:
+    return dict(_STATS)
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from threading import Lock
+from typing import Any
+
+from core.conv_state import aget_state, aload_turn_history, aput_state
+from core.llm_client import allm_complete
+from core.lock_manager import get_lock
+from core.schemas import ConversationState, TurnRecord
+
+# =========================================================
+# 滚动摘要：最近 SUMMARY_KEEP_ROUNDS 轮原文保留在上下文里，
+# 更早且尚未摘要的轮次攒够 SUMMARY_EVERY_TURNS 轮后，在后台用 allm_complete 并入 state.summary，
+# state.summary_round 记录摘要已覆盖到的轮次；不占用请求路径
+# =========================================================
+
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"
+SUMMARY_EVERY_TURNS = int(os.getenv("SUMMARY_EVERY_TURNS", "4"))
+SUMMARY_KEEP_ROUNDS = int(os.getenv("SUMMARY_KEEP_ROUNDS", "4"))
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "400"))
+
+_SUMMARY_SYSTEM = (
+    "你是对话摘要助手。把新增对话合并进已有摘要，保留用户的关键经历、情绪变化、提到的重要人物和尚未解决的问题。"
+    "用第三人称中文书写，不超过 {max_chars} 字，只输出摘要正文，不要标题和多余说明。"
+)
+
+_LOCK = Lock()
+_STATS = {
+    "scheduled": 0,
+    "completed": 0,
+    "failed": 0,
+    "stale": 0,
+    "folded_turns": 0,
+    "llm_ms_total": 0.0,
+    "llm_ms_max": 0.0,
+}
+_INFLIGHT: set[str] = set()
+_TASKS: set[asyncio.Task] = set()
+
+
+def history_rounds(state: ConversationState, limit_rounds: int) -> int:
+    """有摘要时，上下文只需带上摘要之后的轮次。"""
+    if not state.summary:
+        return limit_rounds
+    return max(1, min(limit_rounds, state.round_seq - state.summary_round))
+
+
+def _pending_turns(turns: list[TurnRecord], summary_round: int, fold_upto: int) -> list[TurnRecord]:
+    return [turn for turn in turns if summary_round < turn.round_id <= fold_upto and turn.assistant_text]
+
+
+def _needs_summary(state: ConversationState) -> bool:
+    return state.round_seq - SUMMARY_KEEP_ROUNDS - state.summary_round >= max(1, SUMMARY_EVERY_TURNS)
+
+
+def _build_messages(summary: str, turns: list[TurnRecord]) -> list[dict]:
+    lines = []
+    for turn in turns:
+        lines.append(f"user: {turn.user_text}")
+        lines.append(f"assistant: {turn.assistant_text}")
+    prompt = f"已有摘要:\n{summary or '（无）'}\n\n新增对话:\n" + "\n".join(lines)
+    return [
+        {"role": "system", "content": _SUMMARY_SYSTEM.format(max_chars=SUMMARY_MAX_CHARS)},
+        {"role": "user", "content": prompt},
+    ]
+
+
+async def _summarize(user_id: str, conv_key: str) -> None:
+    async with get_lock(conv_key):
+        state = await aget_state(user_id, conv_key)
+        if not _needs_summary(state):
+            return
+        fold_upto = state.round_seq - SUMMARY_KEEP_ROUNDS
+        base_round = state.summary_round
+        base_summary = state.summary
+        turns = _pending_turns(state.turns, base_round, fold_upto)
+        # 状态里最早的一轮之前还有未摘要的轮次时，它们已被移出状态（待归档或已归档）
+        archived = not state.turns or state.turns[0].round_id > base_round + 1
+    if archived:
+        # 在锁外读完整记录（含尚未写入归档的轮次），已归档的轮次不会再变
+        turns = _pending_turns(await aload_turn_history(user_id, conv_key), base_round, fold_upto)
+    with _LOCK:
+        _STATS["scheduled"] += 1
+
+    start = time.perf_counter()
+    try:
+        text = await allm_complete(
+            _build_messages(base_summary, turns), temperature=0.3, stage="summary", meta={"user_id": user_id}
+        )
+    except Exception:
+        with _LOCK:
+            _STATS["failed"] += 1
+        return
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    summary = (text or "").strip()[:SUMMARY_MAX_CHARS]
+    if not summary:
+        with _LOCK:
+            _STATS["failed"] += 1
+        return
+
+    async with get_lock(conv_key):
+        latest = await aget_state(user_id, conv_key)
+        if latest.summary_round != base_round:
+            with _LOCK:
+                _STATS["stale"] += 1
+            return
+        latest.summary = summary
+        latest.summary_round = fold_upto
+        await aput_state(user_id, latest)
+
+    with _LOCK:
+        _STATS["completed"] += 1
+        _STATS["folded_turns"] += len(turns)
+        _STATS["llm_ms_total"] += elapsed_ms
+        _STATS["llm_ms_max"] = max(_STATS["llm_ms_max"], elapsed_ms)
+
+
+async def _run(user_id: str, conv_key: str) -> None:
+    try:
+        await _summarize(user_id, conv_key)
+    finally:
+        _INFLIGHT.discard(conv_key)
+
+
+def schedule_summary(user_id: str, state: ConversationState) -> None:
+    """本轮结束后调用：需要摘要时在后台启动一次，同一会话同时只跑一个。"""
+    if not SUMMARY_ENABLED or not _needs_summary(state) or state.conv_key in _INFLIGHT:
+        return
+    _INFLIGHT.add(state.conv_key)
+    task = asyncio.get_running_loop().create_task(_run(user_id, state.conv_key))
+    _TASKS.add(task)
+    task.add_done_callback(_TASKS.discard)
+
+
+def get_summarizer_stats() -> dict[str, Any]:
+    with _LOCK:
+        stats = dict(_STATS)
+    completed = stats["completed"]
+    stats["llm_ms_avg"] = round(stats["llm_ms_total"] / completed, 3) if completed else 0.0
+    stats["llm_ms_total"] = round(stats["llm_ms_total"], 3)
+    stats["llm_ms_max"] = round(stats["llm_ms_max"], 3)
+    stats["inflight"] = len(_INFLIGHT)
+    stats["enabled"] = SUMMARY_ENABLED
+    return stats
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from core.context_budget import ContextBudget, budget_for
+from core.prompt_builder import USER_TEMPLATE, summary_message, use_cache_layout
 from core.schemas import ReplyPlan
 
 PLUS_DISABLE_PHRASES = [
@@ -47,26 +49,83 @@ def _plan_block(plan: ReplyPlan, tier: str) -> str:
 def build_treehole_messages(
     system_prompt: str,
     plan: ReplyPlan,
-    history_text: str,
+    summary: str,
+    history: list[dict],
     user_input: str,
     tier: str,
     memory_nuggets: list[str],
     bond_level: int,
+    budget: ContextBudget | None = None,
+    limit_rounds: int | None = None,
 ) -> list[dict]:
+    """固定部分先记入预算；长期记忆最多 8 条且不超过剩余预算的四分之一，其余预算装历史。"""
+    budget = budget or ContextBudget(budget_for(tier))
     hint = TREEHOLE_PRO_HINT if tier == "pro" else TREEHOLE_PLUS_HINT
+    control = _plan_block(plan, tier)
+    budget.add("system", system_prompt)
+    budget.add("control", control)
+    if not use_cache_layout():
+        return _legacy_messages(
+            system_prompt, control, hint, summary, history, user_input, tier, memory_nuggets, bond_level, budget, limit_rounds
+        )
+
+    # 稳定前缀：角色设定 + 档位提示（含 Pro 输出格式），每轮都一样
+    stable_hints = [hint, PRO_OUTPUT_FORMAT_RULE] if tier == "pro" else [hint]
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": "\n".join(stable_hints)},
+    ]
+    budget.add("hints", messages[-1]["content"])
+    if summary:
+        messages.append(summary_message(summary))
+        budget.add("summary", messages[-1]["content"])
+
+    # 易变尾部：控制块 + 亲密度 / 长期记忆 + 本轮输入
+    tail = [control]
+    if tier == "pro":
+        tail.append(f"关系亲密度 bond_level={bond_level}，亲近但不过界。")
+        budget.add("hints", tail[-1])
+        nuggets = budget.take_nuggets(memory_nuggets, max_items=8)
+        if nuggets:
+            tail.append("可自然吸收这些长期记忆，不要列表复述：" + "；".join(nuggets))
+    budget.add("input", user_input)
+
+    messages.extend(budget.pack_history_messages(history, limit_rounds))
+    messages.append({"role": "system", "content": "\n".join(tail)})
+    messages.append({"role": "user", "content": user_input})
+    return messages
+
+
+def _legacy_messages(
+    system_prompt: str,
+    control: str,
+    hint: str,
+    summary: str,
+    history: list[dict],
+    user_input: str,
+    tier: str,
+    memory_nuggets: list[str],
+    bond_level: int,
+    budget: ContextBudget,
+    limit_rounds: int | None,
+) -> list[dict]:
     messages = [
         {"role": "system", "content": system_prompt},
-        {"role": "system", "content": _plan_block(plan, tier)},
+        {"role": "system", "content": control},
     ]
+    budget.add("input", USER_TEMPLATE.format(history_text="", user_input=user_input))
 
     if tier == "pro":
-        hints = [hint, PRO_OUTPUT_FORMAT_RULE]
-        if memory_nuggets:
-            hints.append("可自然吸收这些长期记忆，不要列表复述：" + "；".join(memory_nuggets[-8:]))
-        hints.append(f"关系亲密度 bond_level={bond_level}，亲近但不过界。")
+        hints = [hint, PRO_OUTPUT_FORMAT_RULE, f"关系亲密度 bond_level={bond_level}，亲近但不过界。"]
+        budget.add("hints", "\n".join(hints))
+        nuggets = budget.take_nuggets(memory_nuggets, max_items=8)
+        if nuggets:
+            hints.insert(2, "可自然吸收这些长期记忆，不要列表复述：" + "；".join(nuggets))
         messages.append({"role": "system", "content": "\n".join(hints)})
     else:
+        budget.add("hints", hint)
         messages.append({"role": "system", "content": hint})
 
-    messages.append({"role": "user", "content": f"历史对话:\n{history_text}\n\n本轮用户输入:\n{user_input}"})
+    history_text = budget.pack_history(summary, history, limit_rounds)
+    messages.append({"role": "user", "content": USER_TEMPLATE.format(history_text=history_text, user_input=user_input)})
     return messages
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+from typing import Any
+
+# =========================================================
+# 会话轮次归档：ConversationState 只保留最近若干轮，
+# 更早的 TurnRecord 追加到按用户划分的 gzip 文件，每次归档写入一个完整的 gzip member，
+# 只有需要查看完整记录时才读取
+# conv_archive/<sha1前两位>/<user_id>.jsonl.gz
+# =========================================================
+
+CONV_ARCHIVE_DIR = os.getenv("CONV_ARCHIVE_DIR", "conv_archive")
+_SAFE_USER_ID = re.compile(r"^[A-Za-z0-9_-]{1,80}$")
+
+_STATS_LOCK = threading.Lock()
+_STATS = {
+    "archived_turns": 0,
+    "archive_writes": 0,
+    "archive_bytes": 0,
+    "write_errors": 0,
+    "reads": 0,
+    "torn_members": 0,
+}
+
+
+def _archive_path(user_id: str) -> str:
+    digest = hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+    name = user_id if _SAFE_USER_ID.match(user_id) else f"~{digest}"
+    return os.path.join(CONV_ARCHIVE_DIR, digest[:2], f"{name}.jsonl.gz")
+
+
+def archive_turns(user_id: str, conv_key: str, turns: list[dict[str, Any]]) -> None:
+    """把若干轮追加到用户的归档文件。调用方需持有该用户的事务，保证同一文件不会并发追加。"""
+    if not turns:
+        return
+    lines = "".join(
+        json.dumps({"conv_key": conv_key, **turn}, ensure_ascii=False, separators=(",", ":")) + "\n"
+        for turn in turns
+    )
+    member = gzip.compress(lines.encode("utf-8"))
+    path = _archive_path(user_id)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as f:
+            f.write(member)
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError:
+        with _STATS_LOCK:
+            _STATS["write_errors"] += 1
+        raise
+    with _STATS_LOCK:
+        _STATS["archived_turns"] += len(turns)
+        _STATS["archive_writes"] += 1
+        _STATS["archive_bytes"] += len(member)
+
+
+_GZIP_MAGIC = b"\x1f\x8b\x08"
+
+
+def _read_members(data: bytes) -> tuple[bytes, int]:
+    """逐个解压 gzip member；写了一半的 member（进程崩溃）跳过，从下一个 member 头继续。
+    返回解压后的内容与跳过的残缺 member 数。"""
+    out = []
+    torn = 0
+    while data:
+        decomp = zlib.decompressobj(wbits=31)
+        try:
+            chunk = decomp.decompress(data)
+            complete = decomp.eof
+        except zlib.error:
+            complete = False
+        if not complete:
+            torn += 1
+            next_member = data.find(_GZIP_MAGIC, 1)
+            if next_member < 0:
+                break
+            data = data[next_member:]
+            continue
+        out.append(chunk)
+        data = decomp.unused_data
+    return b"".join(out), torn
+
+
+def load_archived_turns(user_id: str, conv_key: str, limit: int | None = None) -> list[dict[str, Any]]:
+    """读取某个会话已归档的轮次（按 round_id 升序），limit 为只取最后若干轮。"""
+    try:
+        with open(_archive_path(user_id), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    text, torn = _read_members(data)
+    with _STATS_LOCK:
+        _STATS["reads"] += 1
+        _STATS["torn_members"] += torn
+    by_round: dict[int, dict[str, Any]] = {}
+    for line in text.decode("utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(record, dict) or record.pop("conv_key", None) != conv_key:
+            continue
+        if isinstance(record.get("round_id"), int):
+            by_round[record["round_id"]] = record
+    turns = [by_round[round_id] for round_id in sorted(by_round)]
+    if limit is not None:
+        turns = turns[-limit:] if limit > 0 else []
+    return turns
+
+
+def get_turn_archive_stats() -> dict[str, Any]:
+    with _STATS_LOCK:
+        return dict(_STATS)
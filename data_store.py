@@ -1,18 +1,56 @@
+import asyncio
+import atexit
+import functools
+import hashlib
 import json
+import logging
 import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
 from datetime import datetime
+from typing import Callable, Iterator
 
-USER_DATA_FILE = "user_data.json"
+from core.file_lock import InterProcessLock, lock_path_for
+from turn_journal import JournalCommit, TurnJournal
 
-if not os.path.exists(USER_DATA_FILE):
-    with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump({}, f)
+logger = logging.getLogger(__name__)
 
+USER_DATA_FILE = "user_data.json"
+USER_DATA_DIR = os.getenv("USER_DATA_DIR", "user_data")
+USER_DB_PATH = os.getenv("USER_DB_PATH", "user_data.db")
+DATA_STORE_BACKEND = os.getenv("DATA_STORE_BACKEND", "json").strip().lower()
+_MIGRATION_MARKER = ".migrated"
+_SAFE_USER_ID = re.compile(r"^[A-Za-z0-9_-]{1,80}$")
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "512"))
+USER_CACHE_FLUSH_INTERVAL = float(os.getenv("USER_CACHE_FLUSH_INTERVAL", "2"))
+TURN_JOURNAL_ENABLED = os.getenv("TURN_JOURNAL_ENABLED", "1") == "1"
+TURN_JOURNAL_DIR = os.getenv("TURN_JOURNAL_DIR", "turn_journal")
+TURN_JOURNAL_COMMIT_MS = float(os.getenv("TURN_JOURNAL_COMMIT_MS", "20"))
+TURN_JOURNAL_COMMIT_RECORDS = int(os.getenv("TURN_JOURNAL_COMMIT_RECORDS", "64"))
+TURN_JOURNAL_COMPACT_INTERVAL = float(os.getenv("TURN_JOURNAL_COMPACT_INTERVAL", "300"))
+# durable 追加等待 fsync 的上限（秒），超时抛 TimeoutError
+TURN_JOURNAL_DURABLE_TIMEOUT = float(os.getenv("TURN_JOURNAL_DURABLE_TIMEOUT", "5"))
+JOURNAL_SEQ_KEY = "_journal_seq"
+DATA_STORE_IO_WORKERS = int(os.getenv("DATA_STORE_IO_WORKERS", "4"))
+_WEB_CONCURRENCY = os.getenv("WEB_CONCURRENCY", "1").strip()
+# 多个 worker 进程共享同一份存储时开启：跨进程文件锁 + 写穿缓存 + 读前校验版本
+DATA_STORE_MULTI_PROCESS = os.getenv(
+    "DATA_STORE_MULTI_PROCESS", "1" if _WEB_CONCURRENCY.isdigit() and int(_WEB_CONCURRENCY) > 1 else "0"
+) == "1"
+DATA_STORE_LOCK_DIR = os.getenv("DATA_STORE_LOCK_DIR", "user_locks")
 
-def load_user_data(user_id: str) -> dict:
-    with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return data.get(user_id, {
+
+def _default_user_data() -> dict:
+    return {
         "plan": "plus",
         "system_prompt": "你是一个温柔的倾听者，善于共情，不批判、不说教，回复简洁温暖",
         "memories": [],
@@ -25,23 +63,922 @@ def load_user_data(user_id: str) -> dict:
             "avatar_url": "",
             "password_hash": ""
         }
-    })
+    }
+
+
+def _dump_doc(user_info: dict) -> str:
+    return json.dumps(user_info, ensure_ascii=False, separators=(",", ":"))
+
+
+def _read_legacy_file(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        legacy = json.load(f)
+    return legacy if isinstance(legacy, dict) else {}
+
+
+# =========================================================
+# 存储后端接口：文档以紧凑 JSON 文本在缓存与后端之间传递
+# =========================================================
+
+class UserStore:
+    name = "base"
+
+    def load(self, user_id: str) -> dict | None:
+        raise NotImplementedError
+
+    def save(self, user_id: str, doc_text: str) -> None:
+        raise NotImplementedError
+
+    def exists(self, user_id: str) -> bool:
+        return self.load(user_id) is not None
+
+    def version(self, user_id: str):
+        """文档版本标识，每次写入都会变化；用于多进程下判断缓存是否过期。"""
+        return None
+
+    def iter_users(self) -> Iterator[tuple[str, dict]]:
+        raise NotImplementedError
+
+    def is_migrated(self) -> bool:
+        raise NotImplementedError
+
+    def mark_migrated(self) -> None:
+        raise NotImplementedError
+
+
+# =========================================================
+# 分片存储：每个 user_id 一个文件
+# user_data/<sha1前两位>/<user_id>.json
+# 非安全字符的 user_id 用 "~<sha1>" 命名，原始 id 存在文件内
+# 文件开头的 rev 每次写入随机生成，读版本时只需读文件头
+# =========================================================
+
+_REV_PATTERN = re.compile(r'^\{"rev":"([0-9a-f]+)"')
+
+class ShardedJsonStore(UserStore):
+    name = "json"
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, user_id: str) -> str:
+        digest = hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+        name = user_id if _SAFE_USER_ID.match(user_id) else f"~{digest}"
+        return os.path.join(self.root, digest[:2], f"{name}.json")
+
+    @staticmethod
+    def _read(path: str) -> dict | None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        if not isinstance(record, dict) or not isinstance(record.get("data"), dict):
+            return None
+        return record
+
+    def load(self, user_id: str) -> dict | None:
+        record = self._read(self._path(user_id))
+        return record["data"] if record else None
+
+    def exists(self, user_id: str) -> bool:
+        return os.path.exists(self._path(user_id))
+
+    def version(self, user_id: str):
+        path = self._path(user_id)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                head = f.read(64)
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        match = _REV_PATTERN.match(head)
+        if match:
+            return match.group(1)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def save(self, user_id: str, doc_text: str) -> None:
+        path = self._path(user_id)
+        shard_dir = os.path.dirname(path)
+        os.makedirs(shard_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=shard_dir, prefix=".tmp-", suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(f'{{"rev":"{os.urandom(8).hex()}","user_id":')
+                f.write(json.dumps(user_id, ensure_ascii=False))
+                f.write(',"data":')
+                f.write(doc_text)
+                f.write("}")
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def iter_users(self) -> Iterator[tuple[str, dict]]:
+        for bucket in sorted(os.listdir(self.root)):
+            bucket_dir = os.path.join(self.root, bucket)
+            if not os.path.isdir(bucket_dir):
+                continue
+            for filename in sorted(os.listdir(bucket_dir)):
+                if filename.startswith(".") or not filename.endswith(".json"):
+                    continue
+                record = self._read(os.path.join(bucket_dir, filename))
+                if record is None:
+                    continue
+                yield str(record.get("user_id", filename[:-5])), record["data"]
+
+    def is_migrated(self) -> bool:
+        return os.path.exists(os.path.join(self.root, _MIGRATION_MARKER))
+
+    def mark_migrated(self) -> None:
+        with open(os.path.join(self.root, _MIGRATION_MARKER), "w", encoding="utf-8") as f:
+            f.write(datetime.now().isoformat(timespec="seconds"))
+
+
+# =========================================================
+# SQLite 存储（WAL）：大字段拆成独立的行，
+# 保存时只写入内容发生变化的行（例如只 +1 某个角色的消息计数）
+# =========================================================
+
+# 单行保存的字段
+_ROW_SECTIONS = ("profile", "history", "voice_clone")
+# 按子键一行保存的字段
+_KEYED_SECTIONS = ("character_histories", "conv_states", "relationships")
+_CORE_SECTION = "core"
+
+
+def _split_doc(user_info: dict) -> dict[tuple[str, str], str]:
+    rows: dict[tuple[str, str], str] = {}
+    core: dict = {}
+    for key, value in user_info.items():
+        if key in _ROW_SECTIONS:
+            rows[(key, "")] = _dump_doc(value)
+        elif key in _KEYED_SECTIONS and isinstance(value, dict):
+            rows[(key, "")] = "{}"
+            for item_key, item in value.items():
+                rows[(key, str(item_key))] = _dump_doc(item)
+        else:
+            core[key] = value
+    rows[(_CORE_SECTION, "")] = _dump_doc(core)
+    return rows
+
+
+def _join_rows(rows: list[tuple[str, str, str]]) -> dict:
+    user_info: dict = {}
+    keyed: dict[str, dict] = {}
+    for section, item_key, data in rows:
+        value = json.loads(data)
+        if section == _CORE_SECTION:
+            user_info.update(value)
+        elif section in _KEYED_SECTIONS:
+            if item_key:
+                keyed.setdefault(section, {})[item_key] = value
+            else:
+                keyed.setdefault(section, {})
+        else:
+            user_info[section] = value
+    user_info.update(keyed)
+    return user_info
+
+
+class SqliteStore(UserStore):
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_rows ("
+            "user_id TEXT NOT NULL, section TEXT NOT NULL, item_key TEXT NOT NULL DEFAULT '', "
+            "data TEXT NOT NULL, PRIMARY KEY (user_id, section, item_key)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_versions (user_id TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, user_id: str) -> dict | None:
+        rows = self._conn().execute(
+            "SELECT section, item_key, data FROM user_rows WHERE user_id = ?", (user_id,)
+        ).fetchall()
+        if not rows:
+            return None
+        return _join_rows(rows)
+
+    def exists(self, user_id: str) -> bool:
+        row = self._conn().execute(
+            "SELECT 1 FROM user_rows WHERE user_id = ? AND section = ?", (user_id, _CORE_SECTION)
+        ).fetchone()
+        return row is not None
+
+    def version(self, user_id: str):
+        row = self._conn().execute("SELECT version FROM user_versions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def save(self, user_id: str, doc_text: str) -> None:
+        rows = _split_doc(json.loads(doc_text))
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = {
+                (section, item_key): data
+                for section, item_key, data in conn.execute(
+                    "SELECT section, item_key, data FROM user_rows WHERE user_id = ?", (user_id,)
+                )
+            }
+            changed = [
+                (user_id, section, item_key, data)
+                for (section, item_key), data in rows.items()
+                if current.get((section, item_key)) != data
+            ]
+            removed = [(user_id, section, item_key) for section, item_key in current if (section, item_key) not in rows]
+            if changed:
+                conn.executemany(
+                    "INSERT INTO user_rows (user_id, section, item_key, data) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (user_id, section, item_key) DO UPDATE SET data = excluded.data",
+                    changed,
+                )
+            if removed:
+                conn.executemany(
+                    "DELETE FROM user_rows WHERE user_id = ? AND section = ? AND item_key = ?", removed
+                )
+            if changed or removed:
+                conn.execute(
+                    "INSERT INTO user_versions (user_id, version) VALUES (?, 1) "
+                    "ON CONFLICT (user_id) DO UPDATE SET version = version + 1",
+                    (user_id,),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def iter_users(self) -> Iterator[tuple[str, dict]]:
+        user_ids = [
+            row[0]
+            for row in self._conn().execute(
+                "SELECT user_id FROM user_rows WHERE section = ? ORDER BY user_id", (_CORE_SECTION,)
+            )
+        ]
+        for user_id in user_ids:
+            user_info = self.load(user_id)
+            if user_info is not None:
+                yield user_id, user_info
+
+    def is_migrated(self) -> bool:
+        row = self._conn().execute("SELECT 1 FROM store_meta WHERE key = 'migrated_at'").fetchone()
+        return row is not None
+
+    def mark_migrated(self) -> None:
+        self._conn().execute(
+            "INSERT OR REPLACE INTO store_meta (key, value) VALUES ('migrated_at', ?)",
+            (datetime.now().isoformat(timespec="seconds"),),
+        )
+
+
+def _create_store() -> UserStore:
+    if DATA_STORE_BACKEND == "sqlite":
+        return SqliteStore(USER_DB_PATH)
+    if DATA_STORE_BACKEND != "json":
+        raise ValueError(f"unknown DATA_STORE_BACKEND: {DATA_STORE_BACKEND}")
+    return ShardedJsonStore(USER_DATA_DIR)
+
+
+def import_user_data_file(path: str, store: UserStore, overwrite: bool = False) -> int:
+    """把旧版单文件 user_data.json 导入到存储后端，返回导入的用户数。"""
+    imported = 0
+    for user_id, user_info in _read_legacy_file(path).items():
+        if not isinstance(user_info, dict):
+            continue
+        if not overwrite and store.exists(user_id):
+            continue
+        store.save(user_id, _dump_doc(user_info))
+        imported += 1
+    return imported
+
+
+_store = _create_store()
+
+
+# =========================================================
+# 对话轮次日志：每轮先追加到 journal（组提交 fsync），再应用到缓存文档；
+# 文档记录已应用的最大序号 _journal_seq，加载时补上未落盘的日志尾部，
+# 定期压缩：切段 -> 刷盘 -> 删除旧段
+# =========================================================
+
+_turn_journal = (
+    TurnJournal(TURN_JOURNAL_DIR, TURN_JOURNAL_COMMIT_MS / 1000, TURN_JOURNAL_COMMIT_RECORDS)
+    if TURN_JOURNAL_ENABLED
+    else None
+)
+_journal_lock = threading.RLock()
+# 已退出进程遗留、尚未压缩进存储的轮次，按 user_id 分组
+_recovered_turns: dict[str, list[dict]] = {}
+_recovered_lock = threading.Lock()
+# 启动时接手的遗留段，以及上一轮压缩时已关闭的本进程日志段
+_orphan_segments: list[str] = []
+_closed_segments: set[str] = set()
+if _turn_journal is not None:
+    _orphan_segments = _turn_journal.orphan_segment_paths()
+    for _record in _turn_journal.scan(_orphan_segments):
+        _recovered_turns.setdefault(str(_record.get("user_id")), []).append(_record)
+
+
+def _apply_turn(user_info: dict, record: dict) -> bool:
+    seq = int(record["seq"])
+    if int(user_info.get(JOURNAL_SEQ_KEY, 0) or 0) >= seq:
+        return False
+    max_messages = int(record.get("max_messages") or 16)
+    new_messages = [
+        {"role": "user", "content": record.get("user", "")},
+        {"role": "assistant", "content": record.get("assistant", "")},
+    ]
+    history_key = record.get("history_key")
+    if history_key:
+        history_map = user_info.setdefault("character_histories", {})
+        history = history_map.get(history_key, history_map.get(record.get("fallback_key") or "", []))
+        history_map[history_key] = (list(history) + new_messages)[-max_messages:]
+    else:
+        user_info["history"] = (list(user_info.get("history", [])) + new_messages)[-max_messages:]
+    user_info[JOURNAL_SEQ_KEY] = seq
+    return True
+
+
+def _read_user_doc(user_id: str) -> tuple[dict, bool]:
+    """从存储读取文档并补上日志尾部；第二个返回值表示是否补过（需要回写）。"""
+    user_info = _store.load(user_id)
+    if user_info is None:
+        user_info = _default_user_data()
+    with _recovered_lock:
+        records = _recovered_turns.pop(user_id, [])
+    replayed = False
+    for record in records:
+        replayed = _apply_turn(user_info, record) or replayed
+    return user_info, replayed
+
+
+# =========================================================
+# 写回缓存：按 user_id 缓存序列化快照，save 时与快照比对，
+# 只有内容真正变化的文档才标脏，由后台线程定期批量落盘
+# 多进程模式（shared）下改为写穿，命中时先比对存储中的版本，
+# 其他 worker 写过的文档会重新读取
+# =========================================================
+
+class _CacheEntry:
+    __slots__ = ("text", "dirty", "version")
+
+    def __init__(self, text: str, dirty: bool = False, version=None):
+        self.text = text
+        self.dirty = dirty
+        self.version = version
+
+
+class _UserDocCache:
+    def __init__(self, max_entries: int, flush_interval: float, shared: bool = False):
+        self.max_entries = max(1, max_entries)
+        self.shared = shared
+        self.flush_interval = 0 if shared else flush_interval
+        self._entries: OrderedDict[str, _CacheEntry] = OrderedDict()
+        # 被 LRU 淘汰但尚未落盘的脏文档，写盘成功前仍可被读取
+        self._evicted: dict[str, str] = {}
+        self._lock = threading.RLock()
+        # 串行化所有写盘，保证同一用户的新快照不会被旧快照覆盖
+        self._write_lock = threading.Lock()
+        self._flusher: threading.Thread | None = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "saves": 0,
+            "clean_saves": 0,
+            "evictions": 0,
+            "flushes": 0,
+            "flushed_docs": 0,
+            "flush_errors": 0,
+            "stale_reloads": 0,
+        }
+
+    def _cached_locked(self, user_id: str, version) -> dict | None:
+        entry = self._entries.get(user_id)
+        if entry is not None and self.shared and not entry.dirty and entry.version != version:
+            del self._entries[user_id]
+            self._stats["stale_reloads"] += 1
+            entry = None
+        if entry is None and user_id in self._evicted:
+            entry = _CacheEntry(self._evicted.pop(user_id), dirty=True)
+            self._entries[user_id] = entry
+        if entry is None:
+            return None
+        self._entries.move_to_end(user_id)
+        self._stats["hits"] += 1
+        self._evict_locked()
+        return json.loads(entry.text)
+
+    def load(self, user_id: str) -> dict:
+        version = _store.version(user_id) if self.shared else None
+        with self._lock:
+            cached = self._cached_locked(user_id, version)
+        if cached is not None:
+            return cached
+        # 未命中时读盘不占全局锁（否则所有用户的未命中都被串行化），只占该用户的锁：
+        # 写入该用户的路径（transaction / save_user_data）都持有同一把锁，读到的文档不会被并发的保存覆盖
+        with _user_lock(user_id):
+            with self._lock:
+                cached = self._cached_locked(user_id, version)
+                if cached is not None:
+                    return cached
+                self._stats["misses"] += 1
+            user_info, replayed = _read_user_doc(user_id)
+            with self._lock:
+                self._entries[user_id] = _CacheEntry(_dump_doc(user_info), dirty=replayed, version=version)
+                self._evict_locked()
+        if replayed and not self.shared:
+            self._ensure_flusher()
+        return user_info
+
+    def save(self, user_id: str, user_info: dict) -> None:
+        text = _dump_doc(user_info)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.text == text and not (self.shared and entry.dirty):
+                self._entries.move_to_end(user_id)
+                self._stats["clean_saves"] += 1
+                return
+            self._stats["saves"] += 1
+            self._entries[user_id] = _CacheEntry(text, dirty=True)
+            self._entries.move_to_end(user_id)
+            self._evict_locked()
+        if self.shared:
+            self._write_through(user_id, text)
+        elif self.flush_interval <= 0:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def _write_through(self, user_id: str, text: str) -> None:
+        # 调用方已持有该用户的跨进程锁，只写这一个文档
+        try:
+            _store.save(user_id, text)
+            version = _store.version(user_id)
+        except Exception:
+            with self._lock:
+                self._stats["flush_errors"] += 1
+                self._entries.pop(user_id, None)
+            raise
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.text == text:
+                entry.dirty = False
+                entry.version = version
+            self._stats["flushed_docs"] += 1
+
+    def _evict_locked(self) -> None:
+        while len(self._entries) > self.max_entries:
+            user_id, entry = self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+            if entry.dirty:
+                self._evicted[user_id] = entry.text
+
+    def flush(self) -> int:
+        with self._write_lock:
+            with self._lock:
+                pending = dict(self._evicted)
+                for user_id, entry in self._entries.items():
+                    if entry.dirty:
+                        pending[user_id] = entry.text
+                        entry.dirty = False
+            written = 0
+            for user_id, text in pending.items():
+                try:
+                    _store.save(user_id, text)
+                    written += 1
+                except Exception:
+                    with self._lock:
+                        self._stats["flush_errors"] += 1
+                        entry = self._entries.get(user_id)
+                        if entry is not None and entry.text == text:
+                            entry.dirty = True
+                    continue
+                with self._lock:
+                    if self._evicted.get(user_id) == text:
+                        del self._evicted[user_id]
+            with self._lock:
+                self._stats["flushes"] += 1
+                self._stats["flushed_docs"] += written
+            return written
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="user-cache-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                continue
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["dirty"] = sum(1 for entry in self._entries.values() if entry.dirty) + len(self._evicted)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["max_entries"] = self.max_entries
+        stats["flush_interval"] = self.flush_interval
+        stats["shared"] = self.shared
+        return stats
+
+
+_user_cache = _UserDocCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_FLUSH_INTERVAL, shared=DATA_STORE_MULTI_PROCESS)
+
+
+# =========================================================
+# 事务（unit of work）：同一用户的多次修改合并为一次读取 + 一次原子写入
+#   with transaction(user_id) as user_info:
+#       ...
+# 事务内对同一用户的 load/save 与嵌套事务都作用在同一份文档上，
+# 正常退出时统一保存，抛异常则丢弃修改
+# 多进程模式下同时持有该用户的跨进程文件锁，读-改-写期间其他 worker 不会插入写入
+# =========================================================
+
+_active_docs: ContextVar[dict[str, dict] | None] = ContextVar("data_store_active_docs", default=None)
+# 事务内追加、需要等待 fsync 的日志提交；由最外层事务在释放用户锁之后统一等待
+_pending_commits: ContextVar[list[JournalCommit] | None] = ContextVar("data_store_pending_commits", default=None)
+_user_locks: "weakref.WeakValueDictionary[str, threading.RLock]" = weakref.WeakValueDictionary()
+_user_locks_guard = threading.Lock()
+
+
+def _user_lock(user_id: str):
+    with _user_locks_guard:
+        lock = _user_locks.get(user_id)
+        if lock is None:
+            lock = threading.RLock()
+            _user_locks[user_id] = lock
+        return lock
+
+
+_USER_LOCK_DIR = os.path.join(DATA_STORE_LOCK_DIR, "users")
+_process_locks_held = threading.local()
+_process_lock_stats_lock = threading.Lock()
+_process_lock_stats = {"acquires": 0, "contended": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+
+@contextmanager
+def _process_lock(user_id: str) -> Iterator[None]:
+    """多进程模式下的跨进程用户锁，同一线程内可重入；单进程模式下不加锁。"""
+    if not DATA_STORE_MULTI_PROCESS:
+        yield
+        return
+    held = getattr(_process_locks_held, "users", None)
+    if held is None:
+        held = _process_locks_held.users = set()
+    if user_id in held:
+        yield
+        return
+    lock = InterProcessLock(lock_path_for(_USER_LOCK_DIR, user_id))
+    started = time.perf_counter()
+    contended = not lock.try_acquire()
+    if contended:
+        lock.acquire()
+    wait_ms = (time.perf_counter() - started) * 1000
+    with _process_lock_stats_lock:
+        _process_lock_stats["acquires"] += 1
+        _process_lock_stats["contended"] += int(contended)
+        _process_lock_stats["wait_ms_total"] += wait_ms
+        _process_lock_stats["wait_ms_max"] = max(_process_lock_stats["wait_ms_max"], wait_ms)
+    held.add(user_id)
+    try:
+        yield
+    finally:
+        held.discard(user_id)
+        lock.release()
+
+
+# 不是合法的 user_id，不会与用户锁冲突
+_MIGRATION_LOCK_KEY = "__legacy_migration__"
+
+
+def _migrate_legacy_data(store: UserStore) -> None:
+    """首次启动时一次性导入旧数据：切换到 sqlite 时先导入已有的分片目录（比旧文件新），
+    再导入旧版 user_data.json。已存在的用户不覆盖。
+    每个 worker 导入模块时都会调用，持跨进程锁后再检查一次，只由一个进程导入。"""
+    if store.is_migrated():
+        return
+    with _process_lock(_MIGRATION_LOCK_KEY):
+        if store.is_migrated():
+            return
+        if store.name != "json" and os.path.isdir(USER_DATA_DIR):
+            for user_id, user_info in ShardedJsonStore(USER_DATA_DIR).iter_users():
+                if store.exists(user_id):
+                    continue
+                store.save(user_id, _dump_doc(user_info))
+        if os.path.exists(USER_DATA_FILE):
+            import_user_data_file(USER_DATA_FILE, store)
+        store.mark_migrated()
+
+
+_migrate_legacy_data(_store)
+
+
+@contextmanager
+def transaction(user_id: str) -> Iterator[dict]:
+    active = _active_docs.get()
+    if active is not None and user_id in active:
+        yield active[user_id]
+        return
+    commits: list[JournalCommit] | None = None
+    if _pending_commits.get() is None:
+        commits = []
+        commits_token = _pending_commits.set(commits)
+    lock = _user_lock(user_id)
+    try:
+        with lock, _process_lock(user_id):
+            user_info = _user_cache.load(user_id)
+            token = _active_docs.set({**(active or {}), user_id: user_info})
+            try:
+                yield user_info
+            finally:
+                _active_docs.reset(token)
+            _user_cache.save(user_id, user_info)
+    finally:
+        if commits is not None:
+            _pending_commits.reset(commits_token)
+    # 组提交窗口不占用户锁与跨进程锁
+    for commit in commits or ():
+        _wait_durable(commit)
+
+
+def load_user_data(user_id: str) -> dict:
+    active = _active_docs.get()
+    if active is not None and user_id in active:
+        return active[user_id]
+    return _user_cache.load(user_id)
 
 
 def save_user_data(user_id: str, user_info: dict):
-    with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    data[user_id] = user_info
-    with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    active = _active_docs.get()
+    if active is not None and user_id in active:
+        doc = active[user_id]
+        if doc is not user_info:
+            doc.clear()
+            doc.update(user_info)
+        return
+    with _user_lock(user_id), _process_lock(user_id):
+        _user_cache.save(user_id, user_info)
 
 
-def add_user_memory(user_id: str, memory_text: str):
-    user_info = load_user_data(user_id)
+def flush_user_data() -> int:
+    return _user_cache.flush()
+
+
+def get_user_cache_stats() -> dict:
+    return _user_cache.stats()
+
+
+def get_process_lock_stats() -> dict:
+    with _process_lock_stats_lock:
+        stats = dict(_process_lock_stats)
+    acquires = stats["acquires"]
+    stats["wait_ms_avg"] = round(stats["wait_ms_total"] / acquires, 3) if acquires else 0.0
+    stats["wait_ms_total"] = round(stats["wait_ms_total"], 3)
+    stats["wait_ms_max"] = round(stats["wait_ms_max"], 3)
+    stats["enabled"] = DATA_STORE_MULTI_PROCESS
+    stats["pid"] = os.getpid()
+    return stats
+
+
+def append_chat_turn(
+    user_id: str,
+    user_text: str,
+    assistant_text: str,
+    history_key: str | None = None,
+    fallback_key: str | None = None,
+    conv_key: str | None = None,
+    round_id: int | None = None,
+    max_messages: int = 16,
+    durable: bool = True,
+    on_applied: Callable[[dict], None] | None = None,
+) -> dict:
+    """追加一轮对话：写入 journal 并应用到用户文档的 history / character_histories。
+    history_key 为空时写入主 history；fallback_key 为旧版按角色存储的历史键。
+    on_applied 在同一事务内对文档做附带修改（不进 journal）。
+    durable=True 时等待本轮所在批次 fsync 完成（在最外层事务释放锁之后等待），
+    超过 TURN_JOURNAL_DURABLE_TIMEOUT 秒抛 TimeoutError。返回更新后的用户文档。"""
+    with transaction(user_id) as user_info, _journal_lock:
+        # 序号必须大于文档已应用的序号，否则多进程下时钟略慢的 worker 写入的轮次会被当成已应用
+        seq = _turn_journal.next_seq() if _turn_journal is not None else time.time_ns()
+        seq = max(seq, int(user_info.get(JOURNAL_SEQ_KEY, 0) or 0) + 1)
+        record = {
+            "seq": seq,
+            "at": _now_iso(),
+            "user_id": user_id,
+            "conv_key": conv_key,
+            "round_id": round_id,
+            "history_key": history_key,
+            "fallback_key": fallback_key,
+            "max_messages": max_messages,
+            "user": user_text,
+            "assistant": assistant_text,
+        }
+        commit = _turn_journal.append(record) if _turn_journal is not None else None
+        _apply_turn(user_info, record)
+        if on_applied is not None:
+            on_applied(user_info)
+        if commit is not None and durable:
+            _pending_commits.get().append(commit)
+    _ensure_compactor()
+    return user_info
+
+
+_durable_timeouts = 0
+_durable_lock = threading.Lock()
+
+
+def _wait_durable(commit: JournalCommit) -> None:
+    global _durable_timeouts
+    if commit.wait(timeout=TURN_JOURNAL_DURABLE_TIMEOUT):
+        return
+    with _durable_lock:
+        _durable_timeouts += 1
+    logger.error("turn journal fsync not confirmed within %.1fs", TURN_JOURNAL_DURABLE_TIMEOUT)
+    raise TimeoutError("turn_journal_commit_timeout")
+
+
+def compact_turn_journal(final: bool = False) -> int:
+    """把日志段合并进存储后删除，返回删除的段数。
+    本进程的段要等到下一轮压缩才删除：刚关闭的段里可能有事务尚未提交的轮次；
+    final=True（进程退出）时一并删除。遗留段在补写完对应用户后即可删除。"""
+    global _orphan_segments, _closed_segments
+    if _turn_journal is None:
+        flush_user_data()
+        return 0
+    with _journal_lock:
+        closed = _turn_journal.rotate()
+    with _recovered_lock:
+        pending_users = list(_recovered_turns)
+    for user_id in pending_users:
+        with transaction(user_id):
+            pass
+    errors_before = _user_cache.stats()["flush_errors"]
+    flush_user_data()
+    if _user_cache.stats()["flush_errors"] > errors_before:
+        return 0
+    with _journal_lock:
+        removable = closed if final else [path for path in closed if path in _closed_segments]
+        removable += _orphan_segments
+        _turn_journal.remove(removable)
+        _orphan_segments = []
+        _closed_segments = set(closed) - set(removable)
+    return len(removable)
+
+
+_compactor: threading.Thread | None = None
+
+
+def _compact_loop() -> None:
+    while True:
+        time.sleep(TURN_JOURNAL_COMPACT_INTERVAL)
+        try:
+            compact_turn_journal()
+        except Exception:
+            continue
 
-    new_memory = f"[{datetime.now().strftime('%m-%d')}] {memory_text[:100]}"
-    user_info["memories"] = (user_info["memories"] + [new_memory])[-5:]
-    save_user_data(user_id, user_info)
+
+def _ensure_compactor() -> None:
+    global _compactor
+    if _turn_journal is None or TURN_JOURNAL_COMPACT_INTERVAL <= 0:
+        return
+    if _compactor is not None and _compactor.is_alive():
+        return
+    with _journal_lock:
+        if _compactor is None or not _compactor.is_alive():
+            _compactor = threading.Thread(target=_compact_loop, name="turn-journal-compact", daemon=True)
+            _compactor.start()
+
+
+def get_turn_journal_stats() -> dict:
+    if _turn_journal is None:
+        return {"enabled": False}
+    stats = _turn_journal.stats()
+    stats["enabled"] = True
+    with _recovered_lock:
+        stats["recovered_users"] = len(_recovered_turns)
+    stats["durable_timeouts"] = _durable_timeouts
+    return stats
+
+
+_shutdown_done = False
+
+
+def shutdown_data_store() -> None:
+    global _shutdown_done
+    if _shutdown_done:
+        return
+    _shutdown_done = True
+    compact_turn_journal(final=True)
+    if _turn_journal is not None:
+        _turn_journal.close()
+
+
+atexit.register(shutdown_data_store)
+if _orphan_segments and DATA_STORE_MULTI_PROCESS:
+    # 多进程下在启动时就把崩溃 worker 留下的轮次写回存储
+    compact_turn_journal()
+elif _recovered_turns:
+    _ensure_compactor()
+
+
+def iter_user_data() -> Iterator[tuple[str, dict]]:
+    flush_user_data()
+    yield from _store.iter_users()
+
+
+def load_all_user_data() -> dict:
+    return dict(iter_user_data())
+
+
+# =========================================================
+# 异步接口：供 async 路由使用，存储 I/O 放到专用的有界线程池执行，
+# 不占用事件循环
+# =========================================================
+
+_io_executor = ThreadPoolExecutor(max_workers=max(1, DATA_STORE_IO_WORKERS), thread_name_prefix="data-store-io")
+_io_stats_lock = threading.Lock()
+_io_stats = {"calls": 0, "errors": 0, "queue_ms_total": 0.0, "run_ms_total": 0.0, "run_ms_max": 0.0}
+
+
+def _timed_io(submitted_at: float, fn, *args, **kwargs):
+    started_at = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        with _io_stats_lock:
+            _io_stats["errors"] += 1
+        raise
+    finally:
+        finished_at = time.perf_counter()
+        run_ms = (finished_at - started_at) * 1000
+        with _io_stats_lock:
+            _io_stats["calls"] += 1
+            _io_stats["queue_ms_total"] += (started_at - submitted_at) * 1000
+            _io_stats["run_ms_total"] += run_ms
+            _io_stats["run_ms_max"] = max(_io_stats["run_ms_max"], run_ms)
+
+
+async def run_storage_io(fn, *args, **kwargs):
+    """在存储线程池中执行同步存储调用（保留当前 contextvars，事务状态随之传递）。"""
+    loop = asyncio.get_running_loop()
+    context = copy_context()
+    call = functools.partial(context.run, _timed_io, time.perf_counter(), fn, *args, **kwargs)
+    return await loop.run_in_executor(_io_executor, call)
+
+
+async def aload_user_data(user_id: str) -> dict:
+    return await run_storage_io(load_user_data, user_id)
+
+
+async def aappend_chat_turn(user_id: str, user_text: str, assistant_text: str, **kwargs) -> dict:
+    return await run_storage_io(append_chat_turn, user_id, user_text, assistant_text, **kwargs)
+
+
+def get_storage_io_stats() -> dict:
+    with _io_stats_lock:
+        stats = dict(_io_stats)
+    calls = stats["calls"]
+    stats["queue_ms_avg"] = round(stats["queue_ms_total"] / calls, 3) if calls else 0.0
+    stats["run_ms_avg"] = round(stats["run_ms_total"] / calls, 3) if calls else 0.0
+    stats["queue_ms_total"] = round(stats["queue_ms_total"], 3)
+    stats["run_ms_total"] = round(stats["run_ms_total"], 3)
+    stats["run_ms_max"] = round(stats["run_ms_max"], 3)
+    stats["workers"] = max(1, DATA_STORE_IO_WORKERS)
+    return stats
+
+
+def add_user_memory(user_id: str, memory_text: str):
+    with transaction(user_id) as user_info:
+        new_memory = f"[{datetime.now().strftime('%m-%d')}] {memory_text[:100]}"
+        user_info["memories"] = (user_info["memories"] + [new_memory])[-5:]
 
 
 def get_user_memory_text(user_id: str) -> str:
@@ -72,55 +1009,55 @@ def _now_iso():
     return datetime.now().isoformat(timespec="seconds")
 
 
-def get_relationship_state(user_id: str, character_id: str) -> dict:
-    user_info = load_user_data(user_id)
+def _relationship_state(user_info: dict, character_id: str) -> dict:
     relationships = user_info.setdefault("relationships", {})
     state = relationships.get(character_id)
     if not isinstance(state, dict):
         state = _default_relationship_state()
         relationships[character_id] = state
-        save_user_data(user_id, user_info)
     return state
 
 
+def get_relationship_state(user_id: str, character_id: str) -> dict:
+    with transaction(user_id) as user_info:
+        return _relationship_state(user_info, character_id)
+
+
 def save_relationship_state(user_id: str, character_id: str, state: dict) -> None:
-    user_info = load_user_data(user_id)
-    relationships = user_info.setdefault("relationships", {})
-    relationships[character_id] = state
-    save_user_data(user_id, user_info)
+    with transaction(user_id) as user_info:
+        user_info.setdefault("relationships", {})[character_id] = state
 
 
 def increment_user_msg_count(user_id: str, character_id: str, inc: int = 1) -> int:
-    state = get_relationship_state(user_id, character_id)
-    state["user_msg_count_since_last_eval"] = int(state.get("user_msg_count_since_last_eval", 0)) + inc
-    save_relationship_state(user_id, character_id, state)
-    return state["user_msg_count_since_last_eval"]
+    with transaction(user_id) as user_info:
+        state = _relationship_state(user_info, character_id)
+        state["user_msg_count_since_last_eval"] = int(state.get("user_msg_count_since_last_eval", 0)) + inc
+        return state["user_msg_count_since_last_eval"]
 
 
 def reset_user_msg_count(user_id: str, character_id: str) -> None:
-    state = get_relationship_state(user_id, character_id)
-    state["user_msg_count_since_last_eval"] = 0
-    save_relationship_state(user_id, character_id, state)
+    with transaction(user_id) as user_info:
+        _relationship_state(user_info, character_id)["user_msg_count_since_last_eval"] = 0
 
 
 def update_risk_buffer(user_id: str, character_id: str, signal: str, inc: int = 1) -> None:
-    state = get_relationship_state(user_id, character_id)
-    risk_buffer = state.setdefault("risk_buffer", _default_relationship_state()["risk_buffer"])
-    risk_buffer[signal] = int(risk_buffer.get(signal, 0)) + inc
-    risk_buffer["updated_at"] = _now_iso()
-    save_relationship_state(user_id, character_id, state)
+    with transaction(user_id) as user_info:
+        state = _relationship_state(user_info, character_id)
+        risk_buffer = state.setdefault("risk_buffer", _default_relationship_state()["risk_buffer"])
+        risk_buffer[signal] = int(risk_buffer.get(signal, 0)) + inc
+        risk_buffer["updated_at"] = _now_iso()
 
 
 def clear_risk_buffer(user_id: str, character_id: str, signal: str | None = None) -> None:
-    state = get_relationship_state(user_id, character_id)
-    risk_buffer = state.setdefault("risk_buffer", _default_relationship_state()["risk_buffer"])
-    if signal:
-        risk_buffer[signal] = 0
-    else:
-        for key in ["boundary_pressure", "dependency_attempt", "conflict_pattern"]:
-            risk_buffer[key] = 0
-    risk_buffer["updated_at"] = _now_iso()
-    save_relationship_state(user_id, character_id, state)
+    with transaction(user_id) as user_info:
+        state = _relationship_state(user_info, character_id)
+        risk_buffer = state.setdefault("risk_buffer", _default_relationship_state()["risk_buffer"])
+        if signal:
+            risk_buffer[signal] = 0
+        else:
+            for key in ["boundary_pressure", "dependency_attempt", "conflict_pattern"]:
+                risk_buffer[key] = 0
+        risk_buffer["updated_at"] = _now_iso()
 
 
 def append_affinity_eval_log(
@@ -131,16 +1068,24 @@ def append_affinity_eval_log(
     delta: float,
     note: str = ""
 ) -> None:
-    state = get_relationship_state(user_id, character_id)
-    log_item = {
-        "at": _now_iso(),
-        "signals": signals,
-        "confidence": confidence,
-        "delta": delta,
-        "note": note,
-    }
-    logs = state.setdefault("affinity_eval_log", [])
-    logs.append(log_item)
-    state["affinity_eval_log"] = logs[-20:]
-    state["last_affinity_eval_at"] = log_item["at"]
-    save_relationship_state(user_id, character_id, state)
+    with transaction(user_id) as user_info:
+        state = _relationship_state(user_info, character_id)
+        log_item = {
+            "at": _now_iso(),
+            "signals": signals,
+            "confidence": confidence,
+            "delta": delta,
+            "note": note,
+        }
+        logs = state.setdefault("affinity_eval_log", [])
+        logs.append(log_item)
+        state["affinity_eval_log"] = logs[-20:]
+        state["last_affinity_eval_at"] = log_item["at"]
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "import":
+        source = sys.argv[2] if len(sys.argv) >= 3 else USER_DATA_FILE
+        count = import_user_data_file(source, _store, overwrite=True)
+        print(f"imported {count} users from {source} into {_store.name} store")
+    else:
+        print("usage: python data_store.py import [user_data.json]")
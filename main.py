@@ -8,10 +8,14 @@ from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 
 from api import admin, client_log, debug_relationship
-from config import HOST, PORT
+from config import HOST, PORT, WORKERS
 from core.log_buffer import add_log
 from core.log_handler import BufferLogHandler
-from routers import auth, chat, emotion, page, profile, voice_clone
+from core.conv_state import close_state_cache
+from core.llm_client import aclose_llm_clients
+from core.loop_monitor import start_loop_monitor, stop_loop_monitor
+from data_store import shutdown_data_store
+from routers import auth, chat, emotion, page, profile, session, voice_clone
 
 app = FastAPI(title="DeepSeek虚拟树洞（精致版）")
 
@@ -89,12 +93,26 @@ async def access_log_middleware(request: Request, call_next):
     return response
 
 
+@app.on_event("startup")
+async def start_monitors() -> None:
+    start_loop_monitor()
+
+
+@app.on_event("shutdown")
+async def close_data_store() -> None:
+    stop_loop_monitor()
+    await close_state_cache()
+    await aclose_llm_clients()
+    shutdown_data_store()
+
+
 app.include_router(emotion.router)
 app.include_router(auth.router)
 app.include_router(profile.router)
 app.include_router(page.router)
 app.include_router(chat.router)
 app.include_router(voice_clone.router)
+app.include_router(session.router)
 app.include_router(debug_relationship.router)
 app.include_router(client_log.router)
 app.include_router(admin.router)
@@ -103,7 +121,11 @@ app.include_router(admin.router)
 def run_api():
     import uvicorn
 
-    uvicorn.run(app, host=HOST, port=PORT)
+    if WORKERS > 1:
+        # 多 worker：每个子进程各自导入 main:app；存储层按同一个 WEB_CONCURRENCY 自动切换到跨进程模式
+        uvicorn.run("main:app", host=HOST, port=PORT, workers=WORKERS)
+    else:
+        uvicorn.run(app, host=HOST, port=PORT)
 
 
 if __name__ == "__main__":
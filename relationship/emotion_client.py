@@ -1,9 +1,20 @@
 import json
+import logging
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from typing import Any
 
 import requests
 
+from core.llm_usage import record_usage
+from core.resilience import get_upstream
+from core.response_cache import cache_key, get_response_cache
+from core.single_flight import get_single_flight
+
+logger = logging.getLogger(__name__)
+
 
 def _debug_enabled() -> bool:
     return os.getenv("DEBUG_RELATIONSHIP", "0") == "1"
@@ -25,6 +36,8 @@ ALLOWED_SIGNALS = {
     "neutral_interaction",
 }
 ALLOWED_CONFIDENCE = {"low", "medium", "high"}
+_CACHE = get_response_cache("relationship")
+_FLIGHT = get_single_flight("relationship")
 
 SYSTEM_PROMPT = """你是关系信号标注器，只负责从多轮对话中识别关系信号。
 只输出 JSON，不要解释，不要安慰。
@@ -56,24 +69,25 @@ def _fallback() -> dict:
     }
 
 
-def _normalize_result(raw: Any) -> dict:
+def _parse_result(raw: Any) -> dict | None:
+    """校验一条标注结果，不合法返回 None。"""
     if not isinstance(raw, dict):
-        return _fallback()
+        return None
 
     signals = raw.get("signals")
     confidence = raw.get("confidence")
 
     if not isinstance(signals, list) or not signals:
-        return _fallback()
+        return None
 
     normalized_signals = []
     for s in signals:
         if not isinstance(s, str) or s not in ALLOWED_SIGNALS:
-            return _fallback()
+            return None
         normalized_signals.append(s)
 
     if not isinstance(confidence, str) or confidence not in ALLOWED_CONFIDENCE:
-        return _fallback()
+        return None
 
     return {
         "signals": normalized_signals,
@@ -81,7 +95,56 @@ def _normalize_result(raw: Any) -> dict:
     }
 
 
-def analyze_relationship(character_id: str, character_name: str, messages: list[dict]) -> dict:
+def _normalize_result(raw: Any) -> dict:
+    return _parse_result(raw) or _fallback()
+
+
+def _headers(api_key: str) -> dict:
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+
+
+def _request(payload: dict, api_key: str, stage: str, user_id: str | None = None, character: str | None = None) -> dict:
+    """发一次请求并计量；熔断打开时抛 CircuitOpenError，由调用方兜底。"""
+
+    def send(attempt_timeout: float) -> dict:
+        resp = requests.post(
+            DEEPSEEK_EMOTION_URL,
+            headers=_headers(api_key),
+            json=payload,
+            timeout=attempt_timeout,
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    start = time.perf_counter()
+    data: dict = {}
+    try:
+        data = get_upstream("deepseek").call(send, timeout=20)
+        return data
+    finally:
+        record_usage(
+            stage,
+            data.get("usage"),
+            (time.perf_counter() - start) * 1000,
+            ok=bool(data),
+            user_id=user_id,
+            character=character,
+        )
+
+
+def _content(data: dict) -> str:
+    return (((data.get("choices") or [{}])[0]).get("message") or {}).get("content", "")
+
+
+def analyze_relationship(
+    character_id: str,
+    character_name: str,
+    messages: list[dict],
+    user_id: str | None = None,
+) -> dict:
     api_key = os.getenv("DEEPSEEK_EMOTION_API_KEY", "").strip()
     if not api_key:
         return _fallback()
@@ -104,11 +167,7 @@ def analyze_relationship(character_id: str, character_name: str, messages: list[
         "response_format": {"type": "json_object"},
     }
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-
+    key = None
     try:
         fault_mode = _fault_mode()
         if fault_mode == "empty":
@@ -118,19 +177,238 @@ def analyze_relationship(character_id: str, character_name: str, messages: list[
         elif fault_mode == "bad_signals":
             content = json.dumps({"signals": ["made_up_signal"], "confidence": "high"}, ensure_ascii=False)
         else:
-            resp = requests.post(
-                DEEPSEEK_EMOTION_URL,
-                headers=headers,
-                json=payload,
-                timeout=20,
+            key = cache_key(
+                payload["model"],
+                payload["messages"],
+                **{k: v for k, v in payload.items() if k not in ("model", "messages")},
             )
-            resp.raise_for_status()
-            data = resp.json()
-            content = (((data.get("choices") or [{}])[0]).get("message") or {}).get("content", "")
+            cached = _CACHE.get(key)
+            if cached is not None:
+                return _normalize_result(json.loads(cached))
+            if RELATIONSHIP_BATCH_ENABLED:
+                batched = _BATCHER.submit(api_key, user_prompt, user_id)
+                if batched is _ABANDONED:
+                    return _fallback()
+                if batched is not None:
+                    _CACHE.put(key, json.dumps(batched, ensure_ascii=False))
+                    return batched
+            # 同一输入的并发调用只发一次请求
+            data = _FLIGHT.do(key, lambda: _request(payload, api_key, "relationship", user_id, character_id))
+            content = _content(data)
 
         if not content:
             return _fallback()
         parsed = json.loads(content)
+        if key is not None:
+            _CACHE.put(key, content)
         return _normalize_result(parsed)
     except Exception:
         return _fallback()
+
+
+# =========================================================
+# 批量标注（RELATIONSHIP_BATCH_ENABLED=1）：单次标注的输出只有几十个 token，成本主要是每次请求的固定开销。
+# 收集器把 RELATIONSHIP_BATCH_MS 毫秒内（最多 RELATIONSHIP_BATCH_MAX 条）的待标注对话合成一个多条目提示，
+# 返回的 results 数组按 id 拆回各调用方，逐条经 _parse_result 校验；
+# 整批解析失败或某条缺失/不合法时，对应调用方退回单条请求。
+# 调用方（chat_core）是同步代码（在用户事务之外调用），收集与发送放在后台线程，调用方阻塞等待自己的 Future；
+# 等待超时的条目标记为放弃：还没发出就从批次里去掉、由调用方单独请求，已经发出则不再重复请求
+# =========================================================
+
+RELATIONSHIP_BATCH_ENABLED = os.getenv("RELATIONSHIP_BATCH_ENABLED", "0") == "1"
+RELATIONSHIP_BATCH_MS = float(os.getenv("RELATIONSHIP_BATCH_MS", "50"))
+RELATIONSHIP_BATCH_MAX = int(os.getenv("RELATIONSHIP_BATCH_MAX", "8"))
+RELATIONSHIP_BATCH_WORKERS = int(os.getenv("RELATIONSHIP_BATCH_WORKERS", "4"))
+
+BATCH_SYSTEM_PROMPT = """你是关系信号标注器。输入是 items 数组，每一项是一段互相独立的多轮对话（id、character_id、character_name、messages）。
+逐项独立标注关系信号，不要让不同项互相影响。只输出 JSON，不要解释，不要安慰。
+
+
+允许的 signals：
+- boundary_pressure
+- dependency_attempt
+- emotional_support
+- conflict_pattern
+- stable_interaction
+- neutral_interaction
+
+
+confidence 只能是 low / medium / high
+results 必须与 items 一一对应，id 原样返回。
+
+
+输出示例：
+{
+  \"results\": [
+    {\"id\": 0, \"signals\": [\"stable_interaction\"], \"confidence\": \"medium\"},
+    {\"id\": 1, \"signals\": [\"neutral_interaction\"], \"confidence\": \"low\"}
+  ]
+}"""
+
+
+# submit 等待超时、而这条已随批量请求发出时的返回值：调用方直接用兜底结果，避免同一条标注计费两次
+_ABANDONED = object()
+
+
+class _Pending:
+    __slots__ = ("prompt", "user_id", "future", "sent", "abandoned")
+
+    def __init__(self, prompt: dict, user_id: str | None):
+        self.prompt = prompt
+        self.user_id = user_id
+        self.future: Future = Future()
+        self.sent = False
+        self.abandoned = False
+
+
+class _RelationshipBatcher:
+    def __init__(self, window_ms: float, max_items: int, workers: int):
+        self.window = window_ms / 1000
+        self.max_items = max(1, max_items)
+        self.workers = max(1, workers)
+        self._queue: list[_Pending] = []
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._pool: ThreadPoolExecutor | None = None
+        self._api_key = ""
+        self.stats = {
+            "evaluations": 0,
+            "batches": 0,
+            "batched_items": 0,
+            "max_batch": 0,
+            "single_fallbacks": 0,
+            "batch_failures": 0,
+            "wait_timeouts": 0,
+        }
+
+    def submit(self, api_key: str, prompt: dict, user_id: str | None) -> Any:
+        """加入下一批并等待结果；返回 None 表示这条需要调用方自己单独请求，
+        返回 _ABANDONED 表示等待超时且请求已发出（不要再单独请求）。"""
+        pending = _Pending(prompt, user_id)
+        with self._cond:
+            self._api_key = api_key
+            self._queue.append(pending)
+            self.stats["evaluations"] += 1
+            if self._thread is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="relationship-batch")
+                self._thread = threading.Thread(target=self._collect, name="relationship-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        # 最多等一个批次窗口加上游总期限；收集线程或线程池出问题时不能让调用方一直挂着
+        try:
+            return pending.future.result(timeout=self.window + get_upstream("deepseek").deadline + 1)
+        except FutureTimeoutError:
+            pass
+        with self._cond:
+            if pending.future.done():
+                return pending.future.result()
+            self.stats["wait_timeouts"] += 1
+            pending.abandoned = True
+            if pending in self._queue:
+                self._queue.remove(pending)
+            sent = pending.sent
+        if sent:
+            logger.warning("relationship batch wait timed out after the batch was sent, using the fallback result")
+            return _ABANDONED
+        logger.warning("relationship batch wait timed out, falling back to a single call")
+        return None
+
+    def _collect(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._queue) < self.max_items:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._queue = self._queue[: self.max_items], self._queue[self.max_items :]
+                api_key = self._api_key
+            # 发送放到线程池，收集下一批不必等这一批返回
+            try:
+                self._pool.submit(self._flush, batch, api_key)
+            except Exception:
+                logger.exception("relationship batch submit failed")
+                self._release(batch)
+
+    @staticmethod
+    def _release(batch: list[_Pending]) -> None:
+        """还没有结果的条目一律交回调用方单独请求。"""
+        for pending in batch:
+            if not pending.future.done():
+                pending.future.set_result(None)
+
+    def _flush(self, batch: list[_Pending], api_key: str) -> None:
+        try:
+            self._send(batch, api_key)
+        except Exception:
+            logger.exception("relationship batch flush failed")
+        finally:
+            self._release(batch)
+
+    def _send(self, batch: list[_Pending], api_key: str) -> None:
+        with self._cond:
+            batch = [pending for pending in batch if not pending.abandoned]
+            for pending in batch:
+                pending.sent = True
+        if not batch:
+            return
+        if len(batch) == 1:
+            # 窗口内只有一条：走原来的单条请求，提示词更短
+            with self._cond:
+                self.stats["single_fallbacks"] += 1
+            batch[0].future.set_result(None)
+            return
+
+        items = [{"id": i, **pending.prompt} for i, pending in enumerate(batch)]
+        payload = {
+            "model": "deepseek-chat",
+            "messages": [
+                {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                {"role": "user", "content": json.dumps({"items": items}, ensure_ascii=False)},
+            ],
+            "stream": False,
+            "temperature": 0,
+            "max_tokens": min(2048, 120 * len(batch)),
+            "response_format": {"type": "json_object"},
+        }
+        by_id: dict[Any, Any] = {}
+        try:
+            results = json.loads(_content(_request(payload, api_key, "relationship_batch"))).get("results")
+            by_id = {r.get("id"): r for r in results if isinstance(r, dict)}
+        except Exception as exc:
+            logger.warning("relationship batch of %s failed, falling back to single calls: %s", len(batch), exc)
+            with self._cond:
+                self.stats["batch_failures"] += 1
+
+        fallbacks = 0
+        for i, pending in enumerate(batch):
+            result = _parse_result(by_id.get(i))
+            if result is None:
+                fallbacks += 1
+            pending.future.set_result(result)
+        with self._cond:
+            self.stats["batches"] += 1
+            self.stats["batched_items"] += len(batch) - fallbacks
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+            self.stats["single_fallbacks"] += fallbacks
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._cond:
+            stats = dict(self.stats)
+            stats["queued"] = len(self._queue)
+        requests_made = stats["batches"] + stats["single_fallbacks"]
+        stats["requests_per_evaluation"] = round(requests_made / stats["evaluations"], 4) if stats["evaluations"] else 0.0
+        stats["enabled"] = RELATIONSHIP_BATCH_ENABLED
+        stats["window_ms"] = RELATIONSHIP_BATCH_MS
+        stats["max_items"] = self.max_items
+        return stats
+
+
+_BATCHER = _RelationshipBatcher(RELATIONSHIP_BATCH_MS, RELATIONSHIP_BATCH_MAX, RELATIONSHIP_BATCH_WORKERS)
+
+
+def get_relationship_batch_stats() -> dict[str, Any]:
+    return _BATCHER.snapshot()
@@ -14,7 +14,7 @@ from core.auth_utils import (
     validate_password,
     verify_password,
 )
-from data_store import load_user_data, save_user_data
+from data_store import load_user_data, transaction
 
 router = APIRouter()
 
@@ -59,19 +59,18 @@ def auth_init(req: AuthRequest):
         return JSONResponse(status_code=200, content={"ok": False, "msg": password_msg})
 
     user_id = make_user_id(norm)
-    user_info = load_user_data(user_id)
-    profile = user_info.setdefault("profile", {})
+    with transaction(user_id) as user_info:
+        profile = user_info.setdefault("profile", {})
 
-    if profile.get("password_hash"):
-        return JSONResponse(status_code=200, content={"ok": False, "msg": "pin_already_set"})
+        if profile.get("password_hash"):
+            return JSONResponse(status_code=200, content={"ok": False, "msg": "pin_already_set"})
 
-    profile["password_hash"] = hash_password(req.pin)
-    profile.pop("pin_hash", None)
-    profile["username"] = req.username.strip()
-    profile.setdefault("avatar_url", "")
-    profile.setdefault("display_name", "")
+        profile["password_hash"] = hash_password(req.pin)
+        profile.pop("pin_hash", None)
+        profile["username"] = req.username.strip()
+        profile.setdefault("avatar_url", "")
+        profile.setdefault("display_name", "")
 
-    save_user_data(user_id, user_info)
     return {"ok": True}
 
 
@@ -1,26 +1,35 @@
+import asyncio
 import os
 import time
+from typing import AsyncIterator
 
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
 from chat_core import IP_PROMPT_MAP, build_character_history_key, check_sensitive
 from config import MAX_HISTORY
 from core.auth_utils import is_valid_user_id
 from core.characters import get_character_bias, get_character_system_prompt
-from core.conv_state import ensure_state, make_conv_key, next_round_id, save_state
-from core.emotion_analyzer import EmotionAnalyzerError, analyze_emotion
+from core.context_budget import CONTEXT_TOKENS_ANALYSIS, ContextBudget, budget_for, log_context_budget
+from core.conv_state import aget_state, aput_state, make_conv_key, next_round_id
+from core.emotion_analyzer import EmotionAnalyzerError, aanalyze_emotion
 from core.guards import enforce_reply
-from core.llm_client import llm_stream
+from core.llm_client import allm_stream
+from core.llm_usage import normalize_usage, record_prompt_cache
 from core.lock_manager import get_lock
-from core.prompt_builder import build_messages as build_pipeline_messages, render_history_text
-from core.pro_state_parser import apply_treehole_state, split_reply_and_state
+from core.prompt_builder import build_messages as build_pipeline_messages
+from core.pro_state_parser import apply_treehole_state, partial_reply_text, split_reply_and_state
 from core.response_planner import compute_plan
-from core.schemas import EmotionAnalysis, TurnRecord
+from core.schemas import TurnRecord
+from core.stream_cancel import ClientDisconnected, DisconnectWatcher, record_cancelled, record_completed, spawn_detached
+from core.stream_frames import coalesced
+from core.stream_pacing import notice_pace, pace_for, paced, paced_text
+from core.stream_protocol import PROTOCOL_TEXT, encode_event, framed_text, negotiate, stream_response
+from core.summarizer import history_rounds, schedule_summary
 from core.treehole_policy import build_treehole_messages
 from core.treehole_quick_emotion import quick_analyze
-from data_store import load_user_data, save_user_data
+from data_store import aappend_chat_turn, aload_user_data, load_user_data, transaction
 
 router = APIRouter()
 
@@ -32,17 +41,14 @@ def greeting(user_id: str, request: Request):
     if not is_valid_user_id(user_id):
         return JSONResponse(status_code=400, content={"ok": False, "msg": "invalid_user_id"})
 
-    user_info = load_user_data(user_id)
-    save_user_data(user_id, user_info)
-
-    if user_info.get("has_greeted"):
-        return {"text": ""}
+    with transaction(user_id) as user_info:
+        if user_info.get("has_greeted"):
+            return {"text": ""}
 
-    text = "我在这里，你可以慢慢说。"
+        text = "我在这里，你可以慢慢说。"
 
-    user_info["has_greeted"] = True
-    user_info.setdefault("history", []).append({"role": "assistant", "content": text})
-    save_user_data(user_id, user_info)
+        user_info["has_greeted"] = True
+        user_info.setdefault("history", []).append({"role": "assistant", "content": text})
 
     return {"text": text}
 
@@ -57,6 +63,20 @@ class ChatStreamRequest(BaseModel):
 
 @router.post("/chat_stream")
 async def chat_stream(req: ChatStreamRequest, request: Request):
+    protocol = negotiate(request.headers.get("accept"))
+    turn = await open_chat_turn(req, protocol, DisconnectWatcher(request))
+    if isinstance(turn, JSONResponse):
+        return turn
+    return stream_response(turn, protocol)
+
+
+async def open_chat_turn(
+    req: ChatStreamRequest, protocol: str, watcher: DisconnectWatcher | None = None
+) -> JSONResponse | AsyncIterator[str]:
+    """一轮聊天：校验、分析与计划在这里完成，返回待输出的流（或错误响应）。
+    watcher 为 None 时不监听 HTTP 断开，由调用方取消任务来中断（如 WebSocket 会话）。"""
+    started = time.perf_counter()
+    framed = protocol != PROTOCOL_TEXT
     user_id = req.user_id.strip()
     if not user_id:
         return JSONResponse(status_code=400, content={"ok": False, "msg": "missing_user_id"})
@@ -70,35 +90,23 @@ async def chat_stream(req: ChatStreamRequest, request: Request):
     if character_id and character_id not in IP_PROMPT_MAP:
         return JSONResponse(status_code=400, content={"ok": False, "msg": "invalid_character_id"})
 
-    user_info = load_user_data(user_id)
-    save_user_data(user_id, user_info)
+    user_info = await aload_user_data(user_id)
     if os.getenv("E2E_TEST_MODE") == "1":
-        def e2e_stream():
-            message = "你好。测试回复。"
-            for ch in message:
-                yield ch
-                time.sleep(0.01)
-
-        return StreamingResponse(e2e_stream(), media_type="text/plain")
+        return framed_text(paced_text("你好。测试回复。", notice_pace()), protocol)
 
     if not user_info.get("system_prompt"):
         return JSONResponse(status_code=400, content={"ok": False, "msg": "missing_system_prompt"})
 
     unsafe, warning = check_sensitive(user_input)
     if unsafe:
-        def warning_stream():
-            for c in warning:
-                yield c
-                time.sleep(0.01)
-
-        return StreamingResponse(warning_stream(), media_type="text/plain")
+        return framed_text(paced_text(warning, notice_pace()), protocol, blocked=True)
 
     device_id = (req.device_id or "").strip() or "default"
     conv_key = make_conv_key(user_id, device_id, character_id)
     lock = get_lock(conv_key)
 
     async with lock:
-        state = ensure_state(user_id, conv_key)
+        state = await aget_state(user_id, conv_key)
         history_map = user_info.get("character_histories", {})
         if is_ip:
             history_key = build_character_history_key(user_id, character_id)
@@ -106,15 +114,22 @@ async def chat_stream(req: ChatStreamRequest, request: Request):
         else:
             history = user_info.get("history", [])
 
-        history_text = render_history_text(state.summary, history, limit_rounds=12 if is_ip else (10 if tier == "pro" else 8))
+        # 轮数只是上限（且不与摘要重叠），实际装入多少由 token 预算决定
+        limit_rounds = history_rounds(state, 12 if is_ip else (10 if tier == "pro" else 8))
+        summary = state.summary
+        history_text = ContextBudget(CONTEXT_TOKENS_ANALYSIS, "analysis").pack_history(summary, history, limit_rounds)
 
         if is_ip:
             analysis_error = None
             try:
-                analysis = analyze_emotion(history_text, user_input)
+                analysis = await aanalyze_emotion(
+                    history_text, user_input, meta={"user_id": user_id, "character": character_id, "tier": tier}
+                )
             except EmotionAnalyzerError as exc:
+                # 上游失败或熔断：退回本地关键词分析，不阻塞本轮回复
                 analysis_error = str(exc)
-                analysis = EmotionAnalysis(intent="venting", summary="fallback-neutral", error=analysis_error)
+                analysis = quick_analyze(history_text, user_input)
+                analysis.error = analysis_error
         else:
             analysis_error = None
             analysis = quick_analyze(history_text, user_input)
@@ -136,13 +151,19 @@ async def chat_stream(req: ChatStreamRequest, request: Request):
                 analysis=analysis,
                 plan=plan,
                 error=analysis_error,
+                # 先记为中断，完整保存时再改为 False：响应体还没开始输出客户端就断开时，这一轮不会留下未标记的空记录
+                interrupted=True,
             )
         )
-        save_state(user_id, state)
+        await aput_state(user_id, state)
+    analysis_ms = (time.perf_counter() - started) * 1000
 
     system_prompt = get_character_system_prompt(user_info, character_id)
+    budget = ContextBudget(budget_for(tier, character_id), "ip" if is_ip else tier)
     if is_ip:
-        messages = build_pipeline_messages(system_prompt, plan, history_text, user_input)
+        messages = build_pipeline_messages(
+            system_prompt, plan, summary, history, user_input, budget=budget, limit_rounds=limit_rounds
+        )
     else:
         profile = user_info.get("treehole_profile", {})
         memory_nuggets = profile.get("memory_nuggets", [])
@@ -150,62 +171,137 @@ async def chat_stream(req: ChatStreamRequest, request: Request):
         messages = build_treehole_messages(
             system_prompt,
             plan,
-            history_text,
+            summary,
+            history,
             user_input,
             tier,
             memory_nuggets,
             bond_level,
+            budget=budget,
+            limit_rounds=limit_rounds,
         )
+    log_context_budget(budget, user_id=user_id, conv_key=conv_key, round_id=round_id)
 
-    async def pipeline_stream():
-        full_reply = ""
-        try:
-            for delta in llm_stream(messages):
-                if delta:
-                    full_reply += delta
-                    yield delta
-                    if is_ip:
-                        time.sleep(0.01)
-        except Exception:
-            full_reply = "（对话异常，请稍后再试）"
-            for c in full_reply:
-                yield c
-                if is_ip:
-                    time.sleep(0.01)
+    pace = pace_for(tier, character_id)
+    usage_character = character_id or "treehole"
+    usage_meta = {"user_id": user_id, "character": usage_character, "tier": tier}
+    reply_usage: dict = {}
 
+    def on_usage(usage: dict) -> None:
+        record_prompt_cache(usage_character, tier, usage)
+        reply_usage.update(normalize_usage(usage))
+
+    async def finish_turn(full_reply: str, interrupted: bool = False) -> tuple[str, dict | None]:
         state_dict = None
-        if not is_ip and tier == "pro":
+        if interrupted:
+            # 客户端中途断开：原样保存已输出的部分，不做收尾改写
+            final_text = partial_reply_text(full_reply) if not is_ip and tier == "pro" else full_reply.strip()
+        elif not is_ip and tier == "pro":
             reply_text, state_dict = split_reply_and_state(full_reply)
             final_text = enforce_reply(reply_text, safety_mode=plan.safety_mode)
         else:
             final_text = enforce_reply(full_reply, safety_mode=plan.safety_mode)
 
         async with lock:
-            user_info_latest = load_user_data(user_id)
-            history_map_latest = user_info_latest.get("character_histories", {})
-            if is_ip:
-                history_key_latest = build_character_history_key(user_id, character_id)
-                history_latest = history_map_latest.get(history_key_latest, history_map_latest.get(character_id, []))
-                history_latest.append({"role": "user", "content": user_input})
-                history_latest.append({"role": "assistant", "content": final_text})
-                user_info_latest.setdefault("character_histories", {})[history_key_latest] = history_latest[-MAX_HISTORY * 2 :]
-            else:
-                history_latest = user_info_latest.get("history", [])
-                history_latest.append({"role": "user", "content": user_input})
-                history_latest.append({"role": "assistant", "content": final_text})
-                user_info_latest["history"] = history_latest[-MAX_HISTORY * 2 :]
-                if tier == "pro" and state_dict:
-                    apply_treehole_state(user_info_latest, state_dict)
-            save_user_data(user_id, user_info_latest)
-
-            state_latest = ensure_state(user_id, conv_key)
+            if final_text or not interrupted:
+                if is_ip:
+                    await aappend_chat_turn(
+                        user_id,
+                        user_input,
+                        final_text,
+                        history_key=build_character_history_key(user_id, character_id),
+                        fallback_key=character_id,
+                        conv_key=conv_key,
+                        round_id=round_id,
+                        max_messages=MAX_HISTORY * 2,
+                    )
+                else:
+                    # 树洞状态与本轮历史在同一事务内写入，避免其他 worker 的写入被整份文档覆盖
+                    on_applied = None
+                    if tier == "pro" and state_dict:
+                        on_applied = lambda doc: apply_treehole_state(doc, state_dict)
+                    await aappend_chat_turn(
+                        user_id,
+                        user_input,
+                        final_text,
+                        conv_key=conv_key,
+                        round_id=round_id,
+                        max_messages=MAX_HISTORY * 2,
+                        on_applied=on_applied,
+                    )
+
+            state_latest = await aget_state(user_id, conv_key)
             for idx, record in enumerate(state_latest.turns):
                 if record.round_id == round_id:
                     state_latest.turns[idx].assistant_text = final_text
+                    state_latest.turns[idx].interrupted = interrupted
                     break
-            save_state(user_id, state_latest)
+            await aput_state(user_id, state_latest)
+        schedule_summary(user_id, state_latest)
+        return final_text, state_dict
+
+    async def pipeline_stream():
+        parts: list[str] = []
+        ttft_ms = None
+        error = None
+        try:
+            if framed:
+                # 分帧模式把本轮分析与回复计划随流下发，客户端不必再单独请求
+                yield encode_event(protocol, "analysis", analysis.model_dump(mode="json"))
+                yield encode_event(protocol, "plan", plan.model_dump(mode="json"))
+            upstream = allm_stream(messages, on_usage=on_usage, stage="chat", meta=usage_meta)
+            deltas = coalesced(paced(upstream, pace))
+            async for delta in watcher.guard(deltas) if watcher is not None else deltas:
+                if delta:
+                    if ttft_ms is None:
+                        ttft_ms = (time.perf_counter() - started) * 1000
+                    parts.append(delta)
+                    yield encode_event(protocol, "delta", {"text": delta}) if framed else delta
+        except ClientDisconnected:
+            # 上游已在 guard 中关闭；保存放到独立任务，避免被本请求的取消打断
+            record_cancelled(len("".join(parts)))
+            spawn_detached(finish_turn("".join(parts), interrupted=True))
+            return
+        except (asyncio.CancelledError, GeneratorExit):
+            record_cancelled(len("".join(parts)))
+            spawn_detached(finish_turn("".join(parts), interrupted=True))
+            raise
+        except Exception as exc:
+            parts = ["（对话异常，请稍后再试）"]
+            error = type(exc).__name__
+            if framed:
+                yield encode_event(protocol, "error", {"msg": "chat_failed", "text": parts[0]})
+            else:
+                async for c in paced_text(parts[0], pace):
+                    yield c
+        finally:
+            if watcher is not None:
+                watcher.stop()
+
+        full_reply = "".join(parts)
+        record_completed(len(full_reply))
+        # 保存放在独立任务里并 shield 等待：这里被取消时，写完历史的保存不会停在 aput_state 之前
+        final_text, state_dict = await asyncio.shield(spawn_detached(finish_turn(full_reply)))
+        if framed:
+            if state_dict is not None:
+                yield encode_event(protocol, "state", state_dict)
+            yield encode_event(
+                protocol,
+                "done",
+                {
+                    "round_id": round_id,
+                    "reply": final_text,
+                    "error": error,
+                    "timings": {
+                        "analysis_ms": round(analysis_ms, 1),
+                        "ttft_ms": round(ttft_ms, 1) if ttft_ms is not None else None,
+                        "total_ms": round((time.perf_counter() - started) * 1000, 1),
+                    },
+                    "usage": reply_usage,
+                },
+            )
 
-    return StreamingResponse(pipeline_stream(), media_type="text/plain")
+    return pipeline_stream()
 
 
 @router.get("/load_history")
@@ -216,7 +312,6 @@ def load_history(request: Request, user_id: str, character_id: str = ""):
         return JSONResponse(status_code=400, content={"ok": False, "msg": "invalid_user_id"})
 
     user_info = load_user_data(user_id)
-    save_user_data(user_id, user_info)
     character_id = (character_id or "").strip()
     if character_id:
         if character_id not in IP_PROMPT_MAP:
@@ -10,6 +10,10 @@ from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 
 from core.auth_utils import is_valid_user_id
+from core.llm_usage import record_usage
+from core.resilience import CircuitOpenError, get_upstream
+from core.response_cache import cache_key
+from core.single_flight import get_single_flight
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -24,6 +28,8 @@ MAX_HISTORY_MESSAGES = 24
 # ===============================
 _emotion_store = {}
 _store_lock = Lock()
+# 同一轮重复触发时，第一次请求还没返回前 _emotion_store 去重不生效，用 single-flight 合并
+_flight = get_single_flight("api_emotion")
 
 
 def get_user_emotion_state(user_id: str):
@@ -57,25 +63,28 @@ def analyze_emotion(req: EmotionRequest, request: Request):
         return JSONResponse(status_code=400, content={"ok": False, "msg": "missing_user_id"})
     if not is_valid_user_id(user_id):
         return JSONResponse(status_code=400, content={"ok": False, "msg": "invalid_user_id"})
-    history = req.history if req.history is not None else []
-    current_input = req.current_input or ""
-    round_id = req.round_id if req.round_id is not None else int(time.time())
 
     header_device_id = request.headers.get("x-device-id")
     client_host = request.client.host if request.client else "unknown"
     user_key = user_id or header_device_id or f"{client_host}:{request.headers.get('user-agent', 'unknown')}"
+    return JSONResponse(status_code=200, content=emotion_report(req, user_key))
+
+
+def emotion_report(req: EmotionRequest, user_key: str) -> dict:
+    """情绪分析主流程（同步，会阻塞在 Ark 请求上）；返回 /api/emotion 的响应体。"""
+    user_id = req.user_id
+    history = req.history if req.history is not None else []
+    current_input = req.current_input or ""
+    round_id = req.round_id if req.round_id is not None else int(time.time())
 
     if not isinstance(history, list):
         logger.warning("Emotion request history is not list: %s", type(history))
-        return JSONResponse(
-            status_code=200,
-            content={
-                "ok": False,
-                "data": None,
-                "msg": "emotion_failed",
-                "detail": "history_must_be_list",
-            },
-        )
+        return {
+            "ok": False,
+            "data": None,
+            "msg": "emotion_failed",
+            "detail": "history_must_be_list",
+        }
 
     if len(history) > MAX_HISTORY_MESSAGES:
         history = history[-MAX_HISTORY_MESSAGES:]
@@ -94,7 +103,7 @@ def analyze_emotion(req: EmotionRequest, request: Request):
 
         # 命中去重
         if state["last_round"] == round_id and state["result"]:
-            return JSONResponse(status_code=200, content=state["result"])
+            return state["result"]
 
         # 拼上下文（只吃 user）
         context_text = "\n".join(
@@ -179,18 +188,35 @@ def analyze_emotion(req: EmotionRequest, request: Request):
             ]
         }
 
-        r = requests.post(
-            ARK_URL,
-            headers={
-                "Authorization": f"Bearer {ARK_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json=payload,
-            timeout=30
-        )
-
-        r.raise_for_status()
-        seed_json = r.json()
+        def send(attempt_timeout: float) -> dict:
+            r = requests.post(
+                ARK_URL,
+                headers={
+                    "Authorization": f"Bearer {ARK_API_KEY}",
+                    "Content-Type": "application/json"
+                },
+                json=payload,
+                timeout=attempt_timeout
+            )
+            r.raise_for_status()
+            return r.json()
+
+        def request() -> dict:
+            start = time.perf_counter()
+            seed_json = {}
+            try:
+                seed_json = get_upstream("ark").call(send)
+                return seed_json
+            finally:
+                record_usage(
+                    "api_emotion",
+                    seed_json.get("usage"),
+                    (time.perf_counter() - start) * 1000,
+                    ok=bool(seed_json),
+                    user_id=user_id,
+                )
+
+        seed_json = _flight.do(cache_key(MODEL_ID, payload["input"]), request)
         logger.info("Emotion raw response: %s", seed_json)
 
         for item in seed_json.get("output", []):
@@ -203,17 +229,22 @@ def analyze_emotion(req: EmotionRequest, request: Request):
                     state["last_round"] = round_id
                     state["result"] = response_payload
 
-                return JSONResponse(status_code=200, content=response_payload)
+                return response_payload
 
         raise RuntimeError("Emotion JSON parse failed")
+    except CircuitOpenError as exc:
+        logger.warning("Emotion analysis skipped: %s", exc)
+        return {
+            "ok": False,
+            "data": None,
+            "msg": "emotion_failed",
+            "detail": str(exc),
+        }
     except Exception as exc:
         logger.exception("Emotion analysis failed")
-        return JSONResponse(
-            status_code=200,
-            content={
-                "ok": False,
-                "data": None,
-                "msg": "emotion_failed",
-                "detail": str(exc),
-            },
-        )
+        return {
+            "ok": False,
+            "data": None,
+            "msg": "emotion_failed",
+            "detail": str(exc),
+        }
@@ -13,7 +13,7 @@ from core.auth_utils import (
     hash_password,
     validate_password,
 )
-from data_store import load_user_data, save_user_data
+from data_store import aload_user_data, run_storage_io, transaction
 router = APIRouter()
 
 LOGIN_COOKIE_NAME = "auth_token"
@@ -36,7 +36,7 @@ class RegisterRequest(BaseModel):
     password: str = Field(alias="pass")
 
 
-def _get_current_user_id(request: Request) -> str | None:
+async def _get_current_user_id(request: Request) -> str | None:
     user_id = request.cookies.get(LOGIN_COOKIE_NAME, "").strip()
     if not user_id:
         return None
@@ -44,22 +44,40 @@ def _get_current_user_id(request: Request) -> str | None:
     if not is_valid_user_id(user_id):
         return None
 
-    user_info = load_user_data(user_id)
+    user_info = await aload_user_data(user_id)
     if not user_info.get("profile", {}).get("password_hash"):
         return None
     return user_id
 
 
-def _is_logged_in(request: Request) -> bool:
-    return _get_current_user_id(request) is not None
+async def _is_logged_in(request: Request) -> bool:
+    return await _get_current_user_id(request) is not None
 
 
-def _require_login_redirect(request: Request):
-    if not _is_logged_in(request):
+async def _require_login_redirect(request: Request):
+    if not await _is_logged_in(request):
         return RedirectResponse(url="/login", status_code=302)
     return None
 
 
+def _create_account(user_id: str, username: str, password_hash: str) -> bool:
+    with transaction(user_id) as user_info:
+        profile = user_info.setdefault("profile", {})
+        if profile.get("password_hash"):
+            return False
+        profile["username"] = username
+        profile.setdefault("display_name", "")
+        profile.setdefault("avatar_url", "")
+        profile["password_hash"] = password_hash
+        profile.pop("pin_hash", None)
+        return True
+
+
+def _set_ip_name(user_id: str, ip_name: str) -> None:
+    with transaction(user_id) as user_info:
+        user_info["ip_name"] = ip_name
+
+
 def _render_html_file(filename: str) -> str:
     base_dir = os.path.dirname(__file__)
     html_path = os.path.join(base_dir, filename)
@@ -84,14 +102,14 @@ def _with_admin_link(html: str) -> str:
 
 @router.get("/", response_class=HTMLResponse)
 async def intro_page(request: Request):
-    if _is_logged_in(request):
+    if await _is_logged_in(request):
         return RedirectResponse(url="/ai树洞计划.html", status_code=302)
     return RedirectResponse(url="/login", status_code=302)
 
 
 @router.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
-    if _is_logged_in(request):
+    if await _is_logged_in(request):
         return RedirectResponse(url="/ai树洞计划.html", status_code=302)
     return HTMLResponse(_render_html_file("login.html"))
 
@@ -100,7 +118,7 @@ async def login_page(request: Request):
 
 @router.get("/register")
 async def register_page(request: Request):
-    if _is_logged_in(request):
+    if await _is_logged_in(request):
         return RedirectResponse(url="/ai树洞计划.html", status_code=302)
     base_dir = os.path.dirname(os.path.dirname(__file__))
     return FileResponse(os.path.join(base_dir, "static", "register.html"))
@@ -118,19 +136,9 @@ async def register_action(payload: RegisterRequest):
         return JSONResponse(status_code=400, content={"ok": False, "msg": password_msg})
 
     user_id = make_user_id(norm)
-    user_info = load_user_data(user_id)
-    profile = user_info.setdefault("profile", {})
-
-    if profile.get("password_hash"):
+    created = await run_storage_io(_create_account, user_id, username, hash_password(password))
+    if not created:
         return JSONResponse(status_code=409, content={"ok": False, "msg": "user_already_exists"})
-
-    profile["username"] = username
-    profile.setdefault("display_name", "")
-    profile.setdefault("avatar_url", "")
-    profile["password_hash"] = hash_password(password)
-    profile.pop("pin_hash", None)
-
-    save_user_data(user_id, user_info)
     return JSONResponse(status_code=200, content={"ok": True, "user_id": user_id})
 
 
@@ -144,7 +152,7 @@ async def login_action(payload: LoginRequest):
         return JSONResponse(status_code=400, content={"ok": False, "msg": "username_required"})
 
     user_id = make_user_id(norm)
-    user_info = load_user_data(user_id)
+    user_info = await aload_user_data(user_id)
     profile = user_info.get("profile", {})
     password_hash = profile.get("password_hash", "")
 
@@ -186,14 +194,14 @@ async def logout_action():
 
 @router.get("/ai树洞计划.html", response_class=HTMLResponse)
 async def ai_treehole_page(request: Request):
-    if not _is_logged_in(request):
+    if not await _is_logged_in(request):
         return RedirectResponse(url="/login", status_code=302)
     html = _render_html_file("ai树洞计划.html")
     return HTMLResponse(_with_admin_logger(_with_admin_link(html)))
 
 @router.get("/ip", response_class=HTMLResponse)
 async def ip_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     base_dir = os.path.dirname(__file__)
@@ -204,14 +212,14 @@ async def ip_page(request: Request):
 
 @router.get("/二级页面2第六版.html", response_class=HTMLResponse)
 async def evolution_plus_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     return render_html("二级页面2第六版.html")
 
 @router.get("/page", response_class=HTMLResponse)
 async def chat_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     plan = request.query_params.get("plan", "plus")
@@ -228,14 +236,14 @@ async def chat_page(request: Request):
 
 @router.get("/treehole_plus", response_class=HTMLResponse)
 async def treehole_plus_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     return render_html("treehole_plus.html")
 
 @router.get("/treehole_pro", response_class=HTMLResponse)
 async def treehole_pro_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     return render_html("treehole_pro.html")
@@ -252,15 +260,11 @@ def resolve_ip_user_id(request: Request) -> str:
 
 @router.get("/ip/linyu", response_class=HTMLResponse)
 async def linyu_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     user_id = resolve_ip_user_id(request)
-    user_info = load_user_data(user_id)
-
-    user_info["ip_name"] = "linyu"   # ★ 必须
-
-    save_user_data(user_id, user_info)
+    await run_storage_io(_set_ip_name, user_id, "linyu")   # ★ 必须
 
     return HTMLResponse(_with_admin_logger(open("routers/林屿哥哥.html", encoding="utf-8").read()))
 
@@ -268,57 +272,41 @@ async def linyu_page(request: Request):
 
 @router.get("/ip/suwan", response_class=HTMLResponse)
 async def suwan_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     user_id = resolve_ip_user_id(request)
-    user_info = load_user_data(user_id)
-
-    user_info["ip_name"] = "suwan"
-
-    save_user_data(user_id, user_info)
+    await run_storage_io(_set_ip_name, user_id, "suwan")
 
     return HTMLResponse(_with_admin_logger(open("routers/苏晚姐姐.html", encoding="utf-8").read()))
 
 
 @router.get("/ip/xiaxingmian", response_class=HTMLResponse)
 async def xiaxingmian_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     user_id = resolve_ip_user_id(request)
-    user_info = load_user_data(user_id)
-
-    user_info["ip_name"] = "xiaxingmian"
-
-    save_user_data(user_id, user_info)
+    await run_storage_io(_set_ip_name, user_id, "xiaxingmian")
 
     return HTMLResponse(_with_admin_logger(open("routers/病娇校花.html", encoding="utf-8").read()))
 
 @router.get("/ip/jiangche", response_class=HTMLResponse)
 async def jiangche_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     user_id = resolve_ip_user_id(request)
-    user_info = load_user_data(user_id)
-
-    user_info["ip_name"] = "jiangche"
-
-    save_user_data(user_id, user_info)
+    await run_storage_io(_set_ip_name, user_id, "jiangche")
 
     return HTMLResponse(_with_admin_logger(open("routers/白月光江澈.html", encoding="utf-8").read()))
 
 @router.get("/ip/jiangan", response_class=HTMLResponse)
 async def jiangan_page(request: Request):
-    unauthorized = _require_login_redirect(request)
+    unauthorized = await _require_login_redirect(request)
     if unauthorized:
         return unauthorized
     user_id = resolve_ip_user_id(request)
-    user_info = load_user_data(user_id)
-
-    user_info["ip_name"] = "jiangan"
-
-    save_user_data(user_id, user_info)
+    await run_storage_io(_set_ip_name, user_id, "jiangan")
 
     return HTMLResponse(_with_admin_logger(open("routers/学长.html", encoding="utf-8").read()))
@@ -6,7 +6,7 @@ from fastapi.responses import JSONResponse
 from PIL import Image
 
 from core.auth_utils import is_valid_user_id
-from data_store import load_user_data, save_user_data
+from data_store import transaction
 from routers.page import LOGIN_COOKIE_NAME
 
 router = APIRouter()
@@ -30,9 +30,8 @@ def get_profile(request: Request):
     if not is_valid_user_id(user_id):
         return JSONResponse(status_code=400, content={"ok": False, "msg": "invalid_user_id"})
 
-    user_info = load_user_data(user_id)
-    profile = normalize_profile(user_info)
-    save_user_data(user_id, user_info)
+    with transaction(user_id) as user_info:
+        profile = normalize_profile(user_info)
     return {
         "ok": True,
         "profile": {
@@ -62,14 +61,13 @@ def update_profile(payload: dict, request: Request):
     if display_name is None and avatar_url is None:
         return JSONResponse(status_code=400, content={"ok": False, "msg": "profile_empty"})
 
-    user_info = load_user_data(user_id)
-    profile = normalize_profile(user_info)
-    if display_name is not None:
-        profile["display_name"] = display_name
-    if avatar_url is not None:
-        profile["avatar_url"] = avatar_url
+    with transaction(user_id) as user_info:
+        profile = normalize_profile(user_info)
+        if display_name is not None:
+            profile["display_name"] = display_name
+        if avatar_url is not None:
+            profile["avatar_url"] = avatar_url
 
-    save_user_data(user_id, user_info)
     return JSONResponse(
         status_code=200,
         content={
@@ -112,10 +110,9 @@ def avatar_upload(
     image.save(path, format="PNG")
 
     avatar_url = f"/static/avatars/{filename}"
-    user_info = load_user_data(user_id)
-    profile = normalize_profile(user_info)
-    profile["avatar_url"] = avatar_url
-    save_user_data(user_id, user_info)
+    with transaction(user_id) as user_info:
+        profile = normalize_profile(user_info)
+        profile["avatar_url"] = avatar_url
     cache_bust = int(time.time())
     return JSONResponse(
         status_code=200,
@@ -0,0 +1,338 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import urlencode
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+
+from core.auth_utils import decode_token, get_auth_secret, is_valid_user_id
+from core.stream_protocol import PROTOCOL_NDJSON
+from data_store import aload_user_data
+from routers.chat import ChatStreamRequest, open_chat_turn
+from routers.emotion import EmotionRequest, emotion_report
+from routers.page import LOGIN_COOKIE_NAME
+from routers.voice_clone import LipVoiceTtsError, lipvoice_get_result, voice_clone_tts_create
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# =========================================================
+# WebSocket 会话：/ws/session，需登录——带登录 cookie（同页面），或 ?token=...（浏览器的 WebSocket 不能带 Authorization 头）；
+# 可另带 ?user_id=...，须与登录身份一致
+# 一条连接上复用聊天、情绪分析与 TTS，取代每轮的 /chat_stream、/api/emotion 与 TTS 轮询请求。
+# 客户端消息：{"id": "...", "type": "chat" | "emotion" | "tts", ...参数同对应 HTTP 接口}，
+#            {"id": "...", "type": "cancel"} 取消进行中的操作，{"type": "ping"} / {"type": "pong"}
+# 服务端消息都带请求的 id：chat 为 /chat_stream NDJSON 模式的各事件，emotion 为 /api/emotion 的响应体，
+# tts 为 tts_created 与完成后的 tts_ready（音频仍走 /api/voice_clone/tts/audio）；出错为 error。
+# 服务端每 WS_PING_INTERVAL 秒发 ping；WS_IDLE_TIMEOUT 秒收不到任何消息则断开。
+# 发送队列最多 WS_SEND_QUEUE 条，客户端读得慢时生产方（上游流）随之暂停；
+# 每条连接同时最多 WS_MAX_INFLIGHT 个操作，每个用户最多 WS_MAX_CONNECTIONS_PER_USER 条连接
+# =========================================================
+
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))
+WS_SEND_QUEUE = max(1, int(os.getenv("WS_SEND_QUEUE", "64")))
+WS_MAX_INFLIGHT = max(1, int(os.getenv("WS_MAX_INFLIGHT", "4")))
+WS_MAX_CONNECTIONS_PER_USER = max(1, int(os.getenv("WS_MAX_CONNECTIONS_PER_USER", "4")))
+WS_TTS_TIMEOUT = float(os.getenv("WS_TTS_TIMEOUT", "60"))
+
+_CONNECTIONS: dict[str, int] = {}
+_STATS = {
+    "connections": 0,
+    "rejected_connections": 0,
+    "idle_closed": 0,
+    "messages_in": 0,
+    "messages_out": 0,
+    "send_waits": 0,
+    "dropped_replies": 0,
+    "ops": {},
+    "cancelled": 0,
+    "rejected_ops": 0,
+}
+
+
+def _body(response: JSONResponse) -> dict:
+    return json.loads(response.body)
+
+
+class _Session:
+    def __init__(self, websocket: WebSocket, user_id: str, device_id: str):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.device_id = device_id
+        self.outbox: asyncio.Queue[dict] = asyncio.Queue(maxsize=WS_SEND_QUEUE)
+        self.ops: dict[str, asyncio.Task] = {}
+        self._replies: set[asyncio.Task] = set()
+
+    async def send(self, message: dict) -> None:
+        """放入发送队列；队列满时在这里等待，调用方（聊天流等）随之放慢。"""
+        if self.outbox.full():
+            _STATS["send_waits"] += 1
+        await self.outbox.put(message)
+
+    def reply(self, message: dict) -> None:
+        """接收循环里的应答（pong、cancelled、错误）：队列满时放到后台排队，接收循环不停，
+        客户端不读消息时仍能发 cancel。"""
+        try:
+            self.outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            if len(self._replies) >= WS_SEND_QUEUE:
+                # 客户端长期不读还一直发消息：应答丢弃（cancel 本身已经生效）
+                _STATS["dropped_replies"] += 1
+                return
+            _STATS["send_waits"] += 1
+            task = asyncio.get_running_loop().create_task(self.outbox.put(message))
+            self._replies.add(task)
+            task.add_done_callback(self._replies.discard)
+
+    async def _writer(self) -> None:
+        while True:
+            message = await self.outbox.get()
+            try:
+                await self.websocket.send_text(json.dumps(message, ensure_ascii=False))
+            except Exception:
+                return
+            _STATS["messages_out"] += 1
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(WS_PING_INTERVAL)
+            await self.send({"type": "ping", "ts": time.time()})
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        writer = loop.create_task(self._writer())
+        heartbeat = loop.create_task(self._heartbeat())
+        await self.send(
+            {
+                "type": "hello",
+                "user_id": self.user_id,
+                "ping_interval": WS_PING_INTERVAL,
+                "idle_timeout": WS_IDLE_TIMEOUT,
+                "max_inflight": WS_MAX_INFLIGHT,
+            }
+        )
+        try:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(self.websocket.receive(), timeout=WS_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    _STATS["idle_closed"] += 1
+                    await self.websocket.close(code=1001, reason="idle_timeout")
+                    return
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", 1000))
+                _STATS["messages_in"] += 1
+                raw = frame.get("text")
+                if raw is None:
+                    # 只接受文本帧
+                    self.reply({"type": "error", "msg": "invalid_message"})
+                    continue
+                self._dispatch(raw)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            # 连接断开：取消进行中的操作；聊天按中断处理，已输出的部分照常保存
+            for task in self.ops.values():
+                task.cancel()
+            for task in self._replies:
+                task.cancel()
+            heartbeat.cancel()
+            writer.cancel()
+
+    def _dispatch(self, raw: str) -> None:
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            self.reply({"type": "error", "msg": "invalid_message"})
+            return
+
+        kind = message.get("type")
+        op_id = message.get("id")
+        if kind == "ping":
+            self.reply({"type": "pong", "ts": time.time()})
+            return
+        if kind == "pong":
+            return
+        if kind == "cancel":
+            task = self.ops.get(str(op_id))
+            if task is not None:
+                task.cancel()
+                _STATS["cancelled"] += 1
+            self.reply({"id": op_id, "type": "cancelled", "found": task is not None})
+            return
+
+        handler = _HANDLERS.get(kind)
+        if handler is None:
+            self.reply({"id": op_id, "type": "error", "msg": "unknown_type"})
+            return
+        if not isinstance(op_id, (str, int)) or str(op_id) in self.ops:
+            self.reply({"id": op_id, "type": "error", "msg": "invalid_id"})
+            return
+        if len(self.ops) >= WS_MAX_INFLIGHT:
+            _STATS["rejected_ops"] += 1
+            self.reply({"id": op_id, "type": "error", "msg": "too_many_inflight"})
+            return
+
+        _STATS["ops"][kind] = _STATS["ops"].get(kind, 0) + 1
+        key = str(op_id)
+        task = asyncio.get_running_loop().create_task(self._run_op(op_id, handler, message))
+        self.ops[key] = task
+        task.add_done_callback(lambda t, key=key: self.ops.pop(key, None))
+
+    async def _run_op(self, op_id, handler, message: dict) -> None:
+        try:
+            await handler(self, op_id, message)
+        except ValidationError:
+            await self.send({"id": op_id, "type": "error", "msg": "invalid_payload"})
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("ws session op failed type=%s", message.get("type"))
+            await self.send({"id": op_id, "type": "error", "msg": "internal_error"})
+
+
+async def _chat(session: _Session, op_id, message: dict) -> None:
+    req = ChatStreamRequest.model_validate(
+        {
+            "user_id": session.user_id,
+            "user_input": message.get("user_input") or "",
+            "character_id": message.get("character_id"),
+            "device_id": message.get("device_id") or session.device_id,
+            "tier": message.get("tier"),
+        }
+    )
+    # 不传 watcher：客户端取消或断开时由会话取消本任务，走与 HTTP 断开相同的中断保存流程
+    turn = await open_chat_turn(req, PROTOCOL_NDJSON)
+    if isinstance(turn, JSONResponse):
+        await session.send({"id": op_id, "type": "error", **_body(turn)})
+        return
+    try:
+        async for line in turn:
+            await session.send({"id": op_id, **json.loads(line)})
+    finally:
+        # 在 send 处被取消时生成器停在 yield 上，显式关闭让它立即走中断保存
+        await turn.aclose()
+
+
+async def _emotion(session: _Session, op_id, message: dict) -> None:
+    req = EmotionRequest.model_validate(
+        {
+            "user_id": session.user_id,
+            "history": message.get("history") or [],
+            "current_input": message.get("current_input") or "",
+            "round_id": message.get("round_id"),
+        }
+    )
+    result = await run_in_threadpool(emotion_report, req, session.user_id)
+    await session.send({"id": op_id, "type": "emotion", **result})
+
+
+async def _tts(session: _Session, op_id, message: dict) -> None:
+    """创建 TTS 任务后在服务端轮询（与前端相同的 0.4s 起、每次 +0.2s、最多 1s 的间隔），完成时推送一次。"""
+    payload = {key: message[key] for key in ("text", "style", "ext", "genre", "speed") if key in message}
+    created = await voice_clone_tts_create({**payload, "user_id": session.user_id})
+    if isinstance(created, JSONResponse):
+        await session.send({"id": op_id, "type": "error", **_body(created)})
+        return
+    task_id = created["taskId"]
+    await session.send({"id": op_id, "type": "tts_created", "taskId": task_id})
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + WS_TTS_TIMEOUT
+    wait_s = 0.4
+    while loop.time() < deadline:
+        try:
+            status, voice_url = await lipvoice_get_result(task_id=task_id)
+        except LipVoiceTtsError as exc:
+            logger.warning("ws session tts result failed detail=%s", exc.detail)
+            await session.send(
+                {"id": op_id, "type": "error", "ok": False, "msg": "lipvoice_tts_result_failed", "detail": exc.detail}
+            )
+            return
+        if status == 2 and voice_url:
+            await session.send(
+                {
+                    "id": op_id,
+                    "type": "tts_ready",
+                    "taskId": task_id,
+                    "voiceUrl": voice_url,
+                    "audioUrl": "/api/voice_clone/tts/audio?" + urlencode({"voiceUrl": voice_url}),
+                }
+            )
+            return
+        if status == 3:
+            await session.send({"id": op_id, "type": "error", "ok": False, "msg": "lipvoice_tts_failed", "taskId": task_id})
+            return
+        await asyncio.sleep(wait_s)
+        wait_s = min(wait_s + 0.2, 1.0)
+    await session.send({"id": op_id, "type": "error", "ok": False, "msg": "lipvoice_tts_timeout", "taskId": task_id})
+
+
+_HANDLERS = {"chat": _chat, "emotion": _emotion, "tts": _tts}
+
+
+async def _resolve_user(websocket: WebSocket, user_id: str, token: str) -> tuple[str | None, str]:
+    """登录身份：token 优先，否则用登录 cookie（与页面一致，须是设置过密码的已注册用户）。"""
+    if token:
+        secret = get_auth_secret()
+        if not secret:
+            return None, "auth_secret_missing"
+        payload, err = decode_token(token, secret)
+        if not payload or err:
+            return None, "unauthorized"
+        login_user = payload.get("user_id") or ""
+    else:
+        login_user = (websocket.cookies.get(LOGIN_COOKIE_NAME) or "").strip()
+        if not login_user:
+            return None, "unauthorized"
+        if not is_valid_user_id(login_user):
+            return None, "invalid_user_id"
+        user_info = await aload_user_data(login_user)
+        if not user_info.get("profile", {}).get("password_hash"):
+            return None, "unauthorized"
+    if user_id and user_id != login_user:
+        return None, "unauthorized"
+    if not is_valid_user_id(login_user):
+        return None, "invalid_user_id"
+    return login_user, ""
+
+
+@router.websocket("/ws/session")
+async def session_socket(websocket: WebSocket, user_id: str = "", token: str = "", device_id: str = ""):
+    resolved, err = await _resolve_user(websocket, user_id.strip(), token.strip())
+    if resolved is None:
+        _STATS["rejected_connections"] += 1
+        await websocket.close(code=1008, reason=err)
+        return
+    if _CONNECTIONS.get(resolved, 0) >= WS_MAX_CONNECTIONS_PER_USER:
+        _STATS["rejected_connections"] += 1
+        await websocket.close(code=1013, reason="too_many_connections")
+        return
+
+    await websocket.accept()
+    _CONNECTIONS[resolved] = _CONNECTIONS.get(resolved, 0) + 1
+    _STATS["connections"] += 1
+    try:
+        await _Session(websocket, resolved, device_id.strip() or "default").run()
+    finally:
+        remaining = _CONNECTIONS.get(resolved, 1) - 1
+        if remaining > 0:
+            _CONNECTIONS[resolved] = remaining
+        else:
+            _CONNECTIONS.pop(resolved, None)
+
+
+def get_session_stats() -> dict:
+    stats = dict(_STATS)
+    stats["ops"] = dict(_STATS["ops"])
+    stats["active_connections"] = sum(_CONNECTIONS.values())
+    stats["active_users"] = len(_CONNECTIONS)
+    return stats
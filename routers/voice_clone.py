@@ -12,7 +12,8 @@ import httpx
 from fastapi import APIRouter, Body, File, Form, Request, UploadFile
 from fastapi.responses import JSONResponse, Response
 
-from data_store import load_user_data, save_user_data
+from core.resilience import CircuitOpenError, get_upstream
+from data_store import aload_user_data, run_storage_io, transaction
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -106,6 +107,10 @@ class LipVoiceTtsError(Exception):
         super().__init__(detail.get("reason") or "lipvoice_tts_failed")
 
 
+def _unavailable_reason(exc: Exception) -> str:
+    return "circuit_open" if isinstance(exc, CircuitOpenError) else "deadline_exceeded"
+
+
 def _truncate_body(content: str, limit: int = 500) -> str:
     """截断第三方响应体，避免日志过长。"""
     if not content:
@@ -289,6 +294,22 @@ _VOICE_CLONE_EMOTION_KEYS = (
 )
 
 
+def _save_voice_clone(user_id: str, audio_id: str, emotion_params: dict) -> None:
+    with transaction(user_id) as user_info:
+        user_info["voice_clone"] = {
+            "audioId": audio_id,
+            "emotion_params": emotion_params
+        }
+
+
+def _record_tts_task(user_id: str, task_id: str, text_len: int) -> None:
+    with transaction(user_id) as user_info:
+        user_info.setdefault("tts_tasks", {})[task_id] = {
+            "created_at": time.time(),
+            "text_len": text_len
+        }
+
+
 def parse_voice_clone_emotion_params(raw: str | None) -> dict:
     if not raw:
         return {}
@@ -543,11 +564,17 @@ async def lipvoice_create_task(
         json.dumps(payload.get("ext"), ensure_ascii=False)[:300],
         payload.get("speed")
     )
+    async def send(attempt_timeout: float) -> httpx.Response:
+        async with httpx.AsyncClient(timeout=attempt_timeout) as client:
+            return await client.post(url, headers={"sign": sign}, json=payload)
+
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(url, headers={"sign": sign}, json=payload)
+        # 创建任务非幂等：只在连接阶段失败时重试，不对冲
+        response = await get_upstream("lipvoice").acall(send, idempotent=False)
     except httpx.RequestError as exc:
         raise LipVoiceTtsError({"stage": "create", "reason": "request_error", "error": str(exc)}) from exc
+    except (CircuitOpenError, TimeoutError) as exc:
+        raise LipVoiceTtsError({"stage": "create", "reason": _unavailable_reason(exc), "error": str(exc)}) from exc
 
     logger.debug(
         "LipVoice TTS create upstream response status=%s body=%s",
@@ -588,11 +615,16 @@ async def lipvoice_get_result(task_id: str) -> tuple[int | None, str | None]:
     else:
         base_url = os.getenv("LIPVOICE_BASE_URL", "https://openapi.lipvoice.cn")
     url = f"{base_url}/api/third/tts/result"
+    async def send(attempt_timeout: float) -> httpx.Response:
+        async with httpx.AsyncClient(timeout=attempt_timeout) as client:
+            return await client.get(url, headers={"sign": sign}, params={"taskId": task_id})
+
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.get(url, headers={"sign": sign}, params={"taskId": task_id})
+        response = await get_upstream("lipvoice").acall(send)
     except httpx.RequestError as exc:
         raise LipVoiceTtsError({"stage": "result", "reason": "request_error", "error": str(exc)}) from exc
+    except (CircuitOpenError, TimeoutError) as exc:
+        raise LipVoiceTtsError({"stage": "result", "reason": _unavailable_reason(exc), "error": str(exc)}) from exc
 
     if response.status_code != 200:
         detail = {"stage": "result", **_build_upstream_detail(response)}
@@ -627,11 +659,16 @@ async def lipvoice_fetch_audio(voice_url: str) -> tuple[bytes, str]:
         signed_url,
         bool(sign)
     )
+    async def send(attempt_timeout: float) -> httpx.Response:
+        async with httpx.AsyncClient(timeout=attempt_timeout) as client:
+            return await client.get(signed_url, headers={"sign": sign})
+
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.get(signed_url, headers={"sign": sign})
+        response = await get_upstream("lipvoice").acall(send)
     except httpx.RequestError as exc:
         raise LipVoiceTtsError({"stage": "fetch", "reason": "request_error", "error": str(exc)}) from exc
+    except (CircuitOpenError, TimeoutError) as exc:
+        raise LipVoiceTtsError({"stage": "fetch", "reason": _unavailable_reason(exc), "error": str(exc)}) from exc
 
     if response.status_code != 200:
         detail = {"stage": "fetch", **_build_upstream_detail(response)}
@@ -741,20 +778,24 @@ async def upload_reference_audio(
             return JSONResponse(status_code=400, content={"ok": False, "msg": "empty_file"})
 
         # 使用 httpx.AsyncClient，避免在 async 路由里阻塞事件循环。
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(
-                url,
-                headers={"sign": sign},
-                files={
-                    "file": (
-                        file.filename or "reference_audio",
-                        file_bytes,
-                        file.content_type or "application/octet-stream"
-                    )
-                },
-                data={"name": name, "describe": describe or ""}
-            )
-    except httpx.RequestError as exc:
+        async def send(attempt_timeout: float) -> httpx.Response:
+            async with httpx.AsyncClient(timeout=attempt_timeout) as client:
+                return await client.post(
+                    url,
+                    headers={"sign": sign},
+                    files={
+                        "file": (
+                            file.filename or "reference_audio",
+                            file_bytes,
+                            file.content_type or "application/octet-stream"
+                        )
+                    },
+                    data={"name": name, "describe": describe or ""}
+                )
+
+        # 参考音频可能较大：单次仍给 30 秒（与原先一致），总期限放宽到 60 秒，不受 lipvoice 默认 20 秒期限截断
+        response = await get_upstream("lipvoice").acall(send, idempotent=False, timeout=30, deadline=60)
+    except (httpx.RequestError, CircuitOpenError, TimeoutError) as exc:
         return JSONResponse(
             status_code=502,
             content={"ok": False, "msg": "lipvoice_upload_failed", "detail": str(exc)}
@@ -788,13 +829,8 @@ async def upload_reference_audio(
         )
 
     parsed_emotion_params = parse_voice_clone_emotion_params(emotion_params)
-    user_info = load_user_data(user_id)
-    user_info["voice_clone"] = {
-        "audioId": audio_id,
-        "emotion_params": parsed_emotion_params
-    }
-    save_user_data(user_id, user_info)
-    confirm_info = load_user_data(user_id)
+    await run_storage_io(_save_voice_clone, user_id, audio_id, parsed_emotion_params)
+    confirm_info = await aload_user_data(user_id)
     confirm_audio_id = (confirm_info.get("voice_clone") or {}).get("audioId")
     logger.info(
         "LipVoice upload saved user_id=%s audioId=%s confirmed_audioId=%s emotion_params=%s",
@@ -828,7 +864,7 @@ async def voice_clone_tts(payload: dict = Body(...)):
     if not user_id or not text:
         return JSONResponse(status_code=400, content={"ok": False, "msg": "invalid_payload"})
 
-    user_info = load_user_data(user_id)
+    user_info = await aload_user_data(user_id)
     voice_clone_info = user_info.get("voice_clone") or {}
     audio_id = voice_clone_info.get("audioId")
     emotion_params = voice_clone_info.get("emotion_params") or {}
@@ -916,7 +952,7 @@ async def voice_clone_tts_create(payload: dict = Body(...)):
     if not user_id or not text:
         return JSONResponse(status_code=400, content={"ok": False, "msg": "invalid_payload"})
 
-    user_info = load_user_data(user_id)
+    user_info = await aload_user_data(user_id)
     voice_clone_info = user_info.get("voice_clone") or {}
     audio_id = voice_clone_info.get("audioId")
     emotion_params = voice_clone_info.get("emotion_params") or {}
@@ -991,11 +1027,7 @@ async def voice_clone_tts_create(payload: dict = Body(...)):
             content={"ok": False, "msg": "lipvoice_tts_create_failed", "detail": detail}
         )
 
-    user_info.setdefault("tts_tasks", {})[task_id] = {
-        "created_at": time.time(),
-        "text_len": len(text)
-    }
-    save_user_data(user_id, user_info)
+    await run_storage_io(_record_tts_task, user_id, task_id, len(text))
 
     return {"ok": True, "taskId": task_id, "status": status, "upstream_status": upstream_status}
 
@@ -1040,7 +1072,7 @@ async def voice_clone_tts_audio(voiceUrl: str):
 async def debug_get_audio_id(user_id: str):
     if os.getenv("DEBUG") != "1":
         return JSONResponse(status_code=404, content={"ok": False, "msg": "debug_disabled"})
-    user_info = load_user_data(user_id)
+    user_info = await aload_user_data(user_id)
     voice_clone_info = user_info.get("voice_clone") or {}
     audio_id = voice_clone_info.get("audioId")
     return {
@@ -1068,7 +1100,7 @@ async def debug_voice_clone_tts_selftest(payload: dict = Body(...)):
     if not user_id or not text:
         return JSONResponse(status_code=400, content={"ok": False, "msg": "invalid_payload"})
 
-    user_info = load_user_data(user_id)
+    user_info = await aload_user_data(user_id)
     voice_clone_info = user_info.get("voice_clone") or {}
     audio_id = voice_clone_info.get("audioId")
     emotion_params = voice_clone_info.get("emotion_params") or {}
@@ -0,0 +1,153 @@
+"""LLM 多端点路由检查：本地起两个 OpenAI 兼容的替身服务（代替 DeepSeek 与 Ark），验证路由与切换。
+
+    python scripts/check_llm_router.py --requests 40 --fast-ms 20 --slow-ms 200 --complete-ms 1500
+
+检查项：
+- 同步 llm_complete / llm_stream 混合调用时，非流式调用的整次耗时不计入首 token 得分，流式请求仍发往首 token 更快的端点
+- 两个端点都健康时，大部分请求发往首 token 更快的端点
+- 较快的端点开始返回 503 时，流式请求在首个 token 之前切到另一个端点，客户端拿到完整回复
+- 非流式请求同样会切换端点
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPLY = "我在这里，慢慢说。"
+
+
+class _StandIn:
+    """一个 chat/completions 替身：流式 delay_ms 后开始输出，非流式 complete_ms 后返回，fail=True 时直接返回 503。"""
+
+    def __init__(self, name: str, delay_ms: int, complete_ms: int | None = None):
+        self.name = name
+        self.delay_ms = delay_ms
+        self.complete_ms = delay_ms if complete_ms is None else complete_ms
+        self.fail = False
+        self.hits = 0
+        self.stream_hits = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                stand_in.hits += 1
+                if stand_in.fail:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if not body.get("stream"):
+                    time.sleep(stand_in.complete_ms / 1000)
+                    data = json.dumps(
+                        {"model": body.get("model"), "choices": [{"message": {"content": REPLY}}], "usage": {}}
+                    ).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                stand_in.stream_hits += 1
+                time.sleep(stand_in.delay_ms / 1000)
+                chunks = [json.dumps({"choices": [{"delta": {"content": ch}}]}) for ch in REPLY] + ["[DONE]"]
+                data = "".join(f"data: {chunk}\n\n" for chunk in chunks).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/chat/completions"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--fast-ms", type=int, default=20)
+    parser.add_argument("--slow-ms", type=int, default=200)
+    parser.add_argument("--complete-ms", type=int, default=1500, help="快端点非流式调用的整次耗时（比慢端点的首 token 还慢）")
+    parser.add_argument("--mixed", type=int, default=8)
+    args = parser.parse_args()
+
+    fast = _StandIn("deepseek", args.fast_ms, args.complete_ms)
+    slow = _StandIn("ark", args.slow_ms)
+    os.environ.update(
+        {
+            "LLM_ENDPOINTS": "ark,deepseek",
+            "DEEPSEEK_API_URL": fast.url,
+            "DEEPSEEK_API_KEY": "stand-in",
+            "ARK_CHAT_URL": slow.url,
+            "ARK_API_KEY": "stand-in",
+            "LLM_ROUTER_EXPLORE": "0",
+        }
+    )
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from core.llm_client import aclose_llm_clients, allm_complete, allm_stream, llm_complete, llm_stream
+    from core.llm_router import get_router_stats
+
+    messages = [{"role": "user", "content": "你好"}]
+    failures: list[str] = []
+
+    # 同步调用方（摘要、情绪分析）的非流式调用与聊天流式调用交替进行
+    for _ in range(args.mixed):
+        if llm_complete(messages) != REPLY:
+            failures.append("mixed completion returned a wrong reply")
+        if "".join(llm_stream(messages)) != REPLY:
+            failures.append("mixed stream returned a wrong reply")
+    share = fast.stream_hits / max(1, fast.stream_hits + slow.stream_hits)
+    print(f"mixed: fast_streams={fast.stream_hits} slow_streams={slow.stream_hits} fast_share={share:.2f}")
+    if share < 0.8:
+        failures.append(f"completion latency leaked into TTFT routing: fast endpoint got {share:.0%} of streams")
+    fast.hits = slow.hits = 0
+
+    async def stream_once() -> str:
+        return "".join([delta async for delta in allm_stream(messages)])
+
+    async def run() -> None:
+        for _ in range(args.requests):
+            if await stream_once() != REPLY:
+                failures.append("healthy stream returned a wrong reply")
+        share = fast.hits / max(1, fast.hits + slow.hits)
+        print(f"healthy: fast={fast.hits} slow={slow.hits} fast_share={share:.2f}")
+        if share < 0.8:
+            failures.append(f"fast endpoint got only {share:.0%} of requests")
+
+        fast.fail = True
+        fast.hits = slow.hits = 0
+        replies = [await stream_once() for _ in range(5)]
+        print(f"failover: fast={fast.hits} slow={slow.hits}")
+        if any(reply != REPLY for reply in replies):
+            failures.append("stream did not fail over before the first token")
+        if await allm_complete(messages) != REPLY:
+            failures.append("completion did not fail over")
+        await aclose_llm_clients()
+
+    asyncio.run(run())
+    print(json.dumps(get_router_stats(), ensure_ascii=False, indent=2))
+    for failure in failures:
+        print("FAIL", failure)
+    print("check_llm_router_ok" if not failures else "check_llm_router_failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
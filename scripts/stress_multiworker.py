@@ -0,0 +1,136 @@
+"""多进程存储压测：模拟多个 worker 同时写同一批用户，检查历史记录与会话状态没有丢失。
+
+    python scripts/stress_multiworker.py --processes 4 --turns 50 --users 3 --backend json
+    python scripts/stress_multiworker.py --backend sqlite
+
+每个进程按轮次追加对话（append_chat_turn），并在会话锁（core.lock_manager）内
+对一个共享会话的 round_seq 自增；全部结束后重新读取存储：
+- 每个用户的历史必须包含分配给它的全部消息
+- 共享会话的 round_seq 必须等于总自增次数
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARED_CONV_KEY = "stress_user_0:shared:default"
+
+
+def _setup_env(workdir: str, backend: str) -> None:
+    os.environ.update(
+        {
+            "DATA_STORE_BACKEND": backend,
+            "DATA_STORE_MULTI_PROCESS": "1",
+            "USER_DATA_DIR": os.path.join(workdir, "user_data"),
+            "USER_DB_PATH": os.path.join(workdir, "user_data.db"),
+            "TURN_JOURNAL_DIR": os.path.join(workdir, "turn_journal"),
+            "DATA_STORE_LOCK_DIR": os.path.join(workdir, "locks"),
+        }
+    )
+    # 旧版 user_data.json 按相对路径查找，切到空目录避免导入仓库里的数据
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def _user_for(worker: int, turn: int, users: int) -> str:
+    return f"stress_user_{(worker + turn) % users}"
+
+
+def _worker(worker: int, turns: int, users: int, workdir: str, backend: str, start) -> None:
+    _setup_env(workdir, backend)
+    from core.conv_state import aensure_state, asave_state, next_round_id
+    from core.lock_manager import get_lock
+    from data_store import aappend_chat_turn, shutdown_data_store
+
+    async def run() -> None:
+        start.wait()
+        lock = get_lock(SHARED_CONV_KEY)
+        for turn in range(turns):
+            await aappend_chat_turn(
+                _user_for(worker, turn, users),
+                f"w{worker}-t{turn}",
+                f"reply-{worker}-{turn}",
+                max_messages=10 ** 6,
+            )
+            async with lock:
+                state = await aensure_state("stress_user_0", SHARED_CONV_KEY)
+                next_round_id(state)
+                await asave_state("stress_user_0", state)
+
+    asyncio.run(run())
+    shutdown_data_store()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--keep", action="store_true", help="保留临时数据目录")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="treehole-stress-")
+    cwd = os.getcwd()
+    _setup_env(workdir, args.backend)
+    ctx = multiprocessing.get_context("spawn")
+    start = ctx.Event()
+    procs = [
+        ctx.Process(target=_worker, args=(i, args.turns, args.users, workdir, args.backend, start))
+        for i in range(args.processes)
+    ]
+    for proc in procs:
+        proc.start()
+    time.sleep(1.0)
+    began = time.perf_counter()
+    start.set()
+    for proc in procs:
+        proc.join()
+    elapsed = time.perf_counter() - began
+
+    from core.conv_state import load_state
+    from data_store import load_user_data, shutdown_data_store
+
+    failures = [f"worker {i} exited with {proc.exitcode}" for i, proc in enumerate(procs) if proc.exitcode != 0]
+    for user in range(args.users):
+        user_id = f"stress_user_{user}"
+        history = load_user_data(user_id).get("history", [])
+        got = {item["content"] for item in history if item.get("role") == "user"}
+        expected = {
+            f"w{worker}-t{turn}"
+            for worker in range(args.processes)
+            for turn in range(args.turns)
+            if _user_for(worker, turn, args.users) == user_id
+        }
+        missing = expected - got
+        if missing or len(history) != len(expected) * 2:
+            failures.append(f"{user_id}: {len(missing)} missing, {len(history)} messages (expected {len(expected) * 2})")
+    state = load_state("stress_user_0", SHARED_CONV_KEY)
+    rounds = state.round_seq if state else 0
+    if rounds != args.processes * args.turns:
+        failures.append(f"round_seq {rounds} != {args.processes * args.turns}")
+
+    total = args.processes * args.turns
+    print(f"backend={args.backend} processes={args.processes} turns={total} elapsed={elapsed:.2f}s ({total / elapsed:.0f} turns/s)")
+    shutdown_data_store()
+    os.chdir(cwd)
+    if args.keep:
+        print(f"data kept in {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for failure in failures:
+        print("FAIL", failure)
+    print("stress_multiworker_ok" if not failures else "stress_multiworker_failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
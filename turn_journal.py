@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from typing import Any
+
+from core.file_lock import InterProcessLock
+
+# =========================================================
+# 对话轮次的追加日志（append-only journal）
+# - 每条记录一行 JSON，写入当前段文件 turns-<owner>-<段号>.log
+# - owner = <启动时间>-<pid>，实例存活期间一直持有 owner-<owner>.lock，
+#   多个 worker 共用同一目录时，拿得到锁的 owner 说明进程已退出，其日志段才需要恢复
+# - 组提交：攒够 commit_max_records 条或等待 commit_interval 秒后统一 fsync
+# - 崩溃时最后一行可能写了一半，扫描时直接丢弃
+# =========================================================
+
+_SEGMENT_PREFIX = "turns-"
+_SEGMENT_SUFFIX = ".log"
+_OWNER_PREFIX = "owner-"
+_OWNER_SUFFIX = ".lock"
+
+
+def _segment_owner(name: str) -> str | None:
+    if not (name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX)):
+        return None
+    parts = name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)].split("-")
+    # 旧版段文件名为 turns-<起始时间>-<pid>.log，没有段号
+    return "-".join(parts[:2])
+
+
+class JournalCommit:
+    __slots__ = ("_event", "error")
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.error: Exception | None = None
+
+    def _done(self, error: Exception | None = None) -> None:
+        self.error = error
+        self._event.set()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        if not self._event.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class TurnJournal:
+    def __init__(self, directory: str, commit_interval: float = 0.02, commit_max_records: int = 64):
+        self.directory = directory
+        self.commit_interval = max(0.0, commit_interval)
+        self.commit_max_records = max(1, commit_max_records)
+        os.makedirs(directory, exist_ok=True)
+        self.owner = f"{time.time_ns():020d}-{os.getpid()}"
+        self._owner_lock = InterProcessLock(self._owner_lock_path(self.owner))
+        self._owner_lock.acquire()
+        self._segment_no = 0
+        self._cond = threading.Condition()
+        self._pending: list[tuple[str, JournalCommit]] = []
+        self._file_lock = threading.Lock()
+        self._segment_path: str | None = None
+        self._segment_file = None
+        self._last_seq = 0
+        self._writer: threading.Thread | None = None
+        self._stats = {
+            "appends": 0,
+            "commits": 0,
+            "fsyncs": 0,
+            "commit_errors": 0,
+            "max_batch": 0,
+            "max_commit_ms": 0.0,
+            "rotations": 0,
+            "removed_segments": 0,
+            "orphan_segments": 0,
+        }
+
+    def _owner_lock_path(self, owner: str) -> str:
+        return os.path.join(self.directory, f"{_OWNER_PREFIX}{owner}{_OWNER_SUFFIX}")
+
+    def next_seq(self) -> int:
+        # 以纳秒时间戳为基础的单调序号，进程重启后依旧递增
+        with self._cond:
+            self._last_seq = max(self._last_seq + 1, time.time_ns())
+            return self._last_seq
+
+    def append(self, record: dict[str, Any]) -> JournalCommit:
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        commit = JournalCommit()
+        with self._cond:
+            self._pending.append((line, commit))
+            self._stats["appends"] += 1
+            self._ensure_writer()
+            self._cond.notify()
+        return commit
+
+    def _ensure_writer(self) -> None:
+        if self._writer is not None and self._writer.is_alive():
+            return
+        self._writer = threading.Thread(target=self._write_loop, name="turn-journal", daemon=True)
+        self._writer.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.commit_interval
+                while len(self._pending) < self.commit_max_records:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending
+                self._pending = []
+            self._commit(batch)
+
+    def _commit(self, batch: list[tuple[str, JournalCommit]]) -> None:
+        start = time.perf_counter()
+        error: Exception | None = None
+        try:
+            with self._file_lock:
+                f = self._open_segment()
+                f.write("".join(line for line, _ in batch))
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as exc:
+            error = exc
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._cond:
+            self._stats["commits"] += 1
+            if error is None:
+                self._stats["fsyncs"] += 1
+            else:
+                self._stats["commit_errors"] += 1
+            self._stats["max_batch"] = max(self._stats["max_batch"], len(batch))
+            self._stats["max_commit_ms"] = round(max(self._stats["max_commit_ms"], elapsed_ms), 3)
+        for _, commit in batch:
+            commit._done(error)
+
+    def _open_segment(self):
+        if self._segment_file is None:
+            self._segment_no += 1
+            name = f"{_SEGMENT_PREFIX}{self.owner}-{self._segment_no:06d}{_SEGMENT_SUFFIX}"
+            self._segment_path = os.path.join(self.directory, name)
+            self._segment_file = open(self._segment_path, "a", encoding="utf-8")
+        return self._segment_file
+
+    def flush(self, timeout: float | None = 5.0) -> None:
+        """等待当前已提交的记录全部落盘。"""
+        with self._cond:
+            if not self._pending:
+                return
+            commit = self._pending[-1][1]
+        commit.wait(timeout)
+
+    def rotate(self) -> list[str]:
+        """关闭当前段，之后的追加写入新段；返回本实例所有已关闭的段文件。"""
+        self.flush()
+        with self._file_lock:
+            if self._segment_file is not None:
+                self._segment_file.close()
+                self._segment_file = None
+                self._segment_path = None
+                with self._cond:
+                    self._stats["rotations"] += 1
+            return self.segment_paths()
+
+    def close(self) -> None:
+        """关闭当前段并释放 owner 锁，之后本实例不应再追加。"""
+        self.flush()
+        with self._file_lock:
+            if self._segment_file is not None:
+                self._segment_file.close()
+                self._segment_file = None
+                self._segment_path = None
+        self._owner_lock.release()
+        try:
+            os.unlink(self._owner_lock_path(self.owner))
+        except FileNotFoundError:
+            pass
+
+    def segment_paths(self) -> list[str]:
+        active = self._segment_path
+        paths = []
+        for name in sorted(os.listdir(self.directory)):
+            if _segment_owner(name) != self.owner:
+                continue
+            path = os.path.join(self.directory, name)
+            if path != active:
+                paths.append(path)
+        return paths
+
+    def orphan_segment_paths(self) -> list[str]:
+        """已退出（或崩溃）的其他实例留下的段文件，需要由当前实例恢复。"""
+        alive: dict[str, bool] = {}
+        paths = []
+        for name in sorted(os.listdir(self.directory)):
+            owner = _segment_owner(name)
+            if owner is None or owner == self.owner:
+                continue
+            if owner not in alive:
+                probe = InterProcessLock(self._owner_lock_path(owner))
+                alive[owner] = not probe.try_acquire()
+                probe.release()
+            if not alive[owner]:
+                paths.append(os.path.join(self.directory, name))
+        with self._cond:
+            self._stats["orphan_segments"] += len(paths)
+        return paths
+
+    def scan(self, paths: list[str] | None = None) -> list[dict[str, Any]]:
+        records: list[dict[str, Any]] = []
+        for path in paths if paths is not None else self.segment_paths():
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if not line.endswith("\n"):
+                            break
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        if isinstance(record, dict) and isinstance(record.get("seq"), int):
+                            records.append(record)
+            except FileNotFoundError:
+                continue
+        records.sort(key=lambda item: item["seq"])
+        if records:
+            with self._cond:
+                self._last_seq = max(self._last_seq, records[-1]["seq"])
+        return records
+
+    def remove(self, paths: list[str]) -> None:
+        owners = set()
+        for path in paths:
+            owners.add(_segment_owner(os.path.basename(path)))
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            with self._cond:
+                self._stats["removed_segments"] += 1
+        # 已退出实例的段全部清理后，顺带删除它的 owner 锁文件
+        owners.discard(self.owner)
+        owners.discard(None)
+        if not owners:
+            return
+        remaining = {_segment_owner(name) for name in os.listdir(self.directory)}
+        for owner in owners - remaining:
+            try:
+                os.unlink(self._owner_lock_path(owner))
+            except FileNotFoundError:
+                continue
+
+    def stats(self) -> dict[str, Any]:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        stats["avg_batch"] = round(stats["appends"] / stats["commits"], 2) if stats["commits"] else 0.0
+        stats["commit_interval_ms"] = round(self.commit_interval * 1000, 3)
+        stats["commit_max_records"] = self.commit_max_records
+        stats["owner"] = self.owner
+        return stats